@@ -0,0 +1,369 @@
+"""
+Buffered AccessLog writer.
+
+Request handlers hand access records to ``log_access``, which puts them on a
+bounded in-process queue. A daemon thread drains the queue and writes rows
+with ``bulk_create`` once ``BATCH_SIZE`` records are waiting or
+``FLUSH_INTERVAL`` seconds have passed, whichever comes first. Pending
+records are flushed at interpreter shutdown.
+
+When ``SYNCHRONOUS`` is set (the test runner sets it) every record is
+written in the calling thread, inside the caller's transaction.
+
+A batch that cannot be written in one transaction, say because one access
+is to an identity deleted in the meantime, is retried one row at a time;
+only the rows that still fail are dropped, each logged and counted.
+
+With ``COALESCE_WINDOW`` set, identical accesses (same identity, accessor,
+context, fields, IP and user agent) within that many seconds of the first
+one share a single row: the writer keeps the open rows in memory and
+upserts them with the new ``hit_count`` and ``last_seen`` on every flush,
+so a client polling every few seconds costs one row per window while the
+number of accesses stays exact.
+
+The background thread also folds written rows into the rollups (see
+rollups.py) every ``ROLLUP_INTERVAL`` seconds, so access statistics stay
+current without a cron job.
+"""
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, close_old_connections, transaction
+from django.utils import timezone
+
+from . import stats
+from .models import AccessLog
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'SYNCHRONOUS': False,
+    'QUEUE_SIZE': 10000,
+    'BATCH_SIZE': 500,
+    'FLUSH_INTERVAL': 1.0,
+    # What to do when the queue is full: 'block', 'drop' or 'sync'
+    'OVERFLOW': 'sync',
+    # Seconds over which identical accesses share one row; 0 writes a row per access
+    'COALESCE_WINDOW': 0,
+    # Open windows kept in memory; accesses past this many start uncoalesced rows
+    'COALESCE_MAX_KEYS': 10000,
+    # Seconds between roll-ups from the background thread; 0 leaves them to cron
+    'ROLLUP_INTERVAL': 60,
+}
+
+OVERFLOW_POLICIES = ('block', 'drop', 'sync')
+
+
+def get_options():
+    return {**DEFAULTS, **getattr(settings, 'IDENTITY_AUDIT', {})}
+
+
+def coalesce_window():
+    """How long after its first access a row can still gain hits"""
+    return timedelta(seconds=get_options()['COALESCE_WINDOW'])
+
+
+class CoalescingWindows:
+    """The rows whose coalescing window is still open, by access"""
+
+    def __init__(self, seconds, max_keys=10000):
+        self.length = timedelta(seconds=seconds)
+        self.max_keys = max_keys
+        self.rows = {}
+
+    @staticmethod
+    def key(entry):
+        return (
+            entry.identity_id, entry.accessed_by_id, entry.access_context, tuple(entry.accessed_fields),
+            bytes(entry.ip), entry.user_agent,
+        )
+
+    def coalesce(self, entries):
+        """
+        Fold ``entries`` into the open rows; returns ``(row, hits)`` pairs for
+        the rows to upsert, those that gained hits and those that start a new
+        window, with the hits they gained
+        """
+        changed = {}
+        gained = {}
+        for entry in entries:
+            key = self.key(entry)
+            row = self.rows.get(key)
+            if row is not None and entry.timestamp - row.timestamp < self.length:
+                row.hit_count += entry.hit_count
+                row.last_seen = max(row.last_seen or row.timestamp, entry.last_seen or entry.timestamp)
+            else:
+                row = entry
+                if key in self.rows or len(self.rows) < self.max_keys:
+                    self.rows[key] = row
+            changed[id(row)] = row
+            gained[id(row)] = gained.get(id(row), 0) + entry.hit_count
+        return [(row, gained[key]) for key, row in changed.items()]
+
+    def discard(self, row):
+        """Stop coalescing into ``row``, which could not be written"""
+        self.rows = {key: open_row for key, open_row in self.rows.items() if open_row is not row}
+
+    def expire(self, now):
+        """Forget the rows whose window has closed"""
+        closed = now - self.length
+        self.rows = {key: row for key, row in self.rows.items() if row.timestamp > closed}
+
+    def __len__(self):
+        return len(self.rows)
+
+
+class AccessLogWriter:
+    """Queue AccessLog rows and write them in batches off the request path"""
+
+    def __init__(self, synchronous=False, queue_size=10000, batch_size=500,
+                 flush_interval=1.0, overflow='sync', coalesce_window=0, coalesce_max_keys=10000,
+                 rollup_interval=60):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"overflow must be one of {OVERFLOW_POLICIES}, got '{overflow}'")
+
+        self.synchronous = synchronous
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.windows = CoalescingWindows(coalesce_window, coalesce_max_keys) if coalesce_window else None
+        self.rollup_interval = rollup_interval
+        self.counters = {
+            'written': 0, 'dropped': 0, 'sync_fallbacks': 0, 'failed': 0, 'coalesced': 0, 'rolled_up': 0,
+        }
+
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        # Coalesced rows are shared between batches, so only one batch is written at a time
+        self._write_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._next_rollup = 0.0
+
+    @classmethod
+    def from_settings(cls):
+        options = get_options()
+        return cls(
+            synchronous=options['SYNCHRONOUS'],
+            queue_size=options['QUEUE_SIZE'],
+            batch_size=options['BATCH_SIZE'],
+            flush_interval=options['FLUSH_INTERVAL'],
+            overflow=options['OVERFLOW'],
+            coalesce_window=options['COALESCE_WINDOW'],
+            coalesce_max_keys=options['COALESCE_MAX_KEYS'],
+            rollup_interval=options['ROLLUP_INTERVAL'],
+        )
+
+    def log(self, **fields):
+        """Record one access; ``fields`` are AccessLog constructor arguments"""
+        self.log_many([fields])
+
+    def log_many(self, records):
+        """
+        Record several accesses at once. In synchronous mode (and on the
+        ``sync`` overflow path) they are written with a single bulk insert.
+        """
+        now = timezone.now()
+        entries = [AccessLog(**{'timestamp': now, **fields}) for fields in records]
+        if not entries:
+            return
+
+        if self.synchronous:
+            self._write(entries)
+            return
+
+        self._ensure_started()
+        overflow = []
+        for entry in entries:
+            if self.overflow == 'block':
+                self.queue.put(entry)
+                continue
+            try:
+                self.queue.put_nowait(entry)
+            except queue.Full:
+                overflow.append(entry)
+
+        if overflow:
+            if self.overflow == 'drop':
+                self.counters['dropped'] += len(overflow)
+            else:
+                self.counters['sync_fallbacks'] += len(overflow)
+                self._write(overflow)
+
+    def flush(self):
+        """Write everything currently queued from the calling thread"""
+        while True:
+            batch = self._drain(self.batch_size)
+            if not batch:
+                return
+            self._write(batch)
+
+    def stop(self, timeout=5.0):
+        """Stop the background thread and flush whatever is left"""
+        self._stopping.set()
+        thread = self._thread
+        if thread is not None and thread.is_alive():
+            thread.join(timeout)
+        self._thread = None
+        self.flush()
+        self._stopping.clear()
+
+    def stats(self):
+        stats = {**self.counters, 'queued': self.queue.qsize()}
+        if self.windows is not None:
+            stats['open_windows'] = len(self.windows)
+        return stats
+
+    def _ensure_started(self):
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            # A forked worker inherits the attribute but not the thread
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(
+                    target=self._run, name='access-log-writer', daemon=True
+                )
+                self._thread.start()
+
+    def _run(self):
+        self._next_rollup = time.monotonic() + self.rollup_interval
+        try:
+            while not self._stopping.is_set():
+                batch = self._collect()
+                if batch:
+                    close_old_connections()
+                    self._write(batch)
+                self.roll_up_if_due()
+        finally:
+            connection.close()
+
+    def _collect(self):
+        """Block until a full batch is queued or the flush interval runs out"""
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self._stopping.is_set():
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def roll_up_if_due(self):
+        """Fold new rows into the rollups when ``rollup_interval`` has passed since the last time"""
+        if not self.rollup_interval or time.monotonic() < self._next_rollup:
+            return
+        self._next_rollup = time.monotonic() + self.rollup_interval
+        # rollups imports this module for the coalescing window
+        from . import rollups
+        try:
+            close_old_connections()
+            self.counters['rolled_up'] += rollups.roll_up()
+        except Exception:
+            # Another process may hold the checkpoints; the next interval retries
+            logger.exception('Failed to roll up access logs')
+
+    def _drain(self, limit):
+        batch = []
+        while len(batch) < limit:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        if self.windows is None:
+            return self._write_rows([(entry, entry.hit_count) for entry in batch])
+        with self._write_lock:
+            try:
+                self._write_rows(self.windows.coalesce(batch))
+            finally:
+                # Timed by the accesses themselves, so a replayed or delayed batch coalesces the same way
+                self.windows.expire(max(entry.timestamp for entry in batch))
+
+    def _write_rows(self, rows):
+        """
+        Write ``(row, hits)`` pairs in one transaction, or if that fails one
+        at a time, dropping and logging only the rows that cannot be written
+        """
+        try:
+            return self._save(rows)
+        except Exception as e:
+            error = e
+            if len(rows) > 1:
+                logger.warning('Failed to write %d access log entries at once, retrying one by one',
+                               len(rows), exc_info=True)
+        dropped = rows
+        if len(rows) > 1:
+            dropped = []
+            for row in rows:
+                try:
+                    self._save([row])
+                except Exception as e:
+                    error = e
+                    dropped.append(row)
+
+        for row, hits in dropped:
+            self.counters['failed'] += hits
+            if self.windows is not None:
+                self.windows.discard(row)
+            logger.error(
+                'Dropped access log entry (%d access(es) of identity %s by user %s in context %r at %s): %s',
+                hits, row.identity_id, row.accessed_by_id, row.access_context, row.timestamp, error,
+            )
+        if dropped and self.synchronous:
+            raise error
+
+    def _save(self, rows):
+        """
+        Insert rows starting a window and upsert those an earlier flush
+        wrote with their new ``hit_count`` and ``last_seen``
+        """
+        # Not ``pk is None``: an insert that was rolled back leaves its pk set
+        new = [row for row, _ in rows if not getattr(row, '_flushed', False)]
+        written = [row for row, _ in rows if getattr(row, '_flushed', False)]
+        hits = sum(hits for _, hits in rows)
+        try:
+            with transaction.atomic():
+                AccessLog.objects.bulk_create(new, batch_size=self.batch_size)
+                AccessLog.objects.bulk_create(
+                    written, batch_size=self.batch_size,
+                    update_conflicts=True, unique_fields=['id'], update_fields=['hit_count', 'last_seen'],
+                )
+                stats.increment('access_logs', hits)
+        except Exception:
+            # The rolled-back ids can be handed out again, to another writer's rows
+            for row in new:
+                row.pk = None
+                row._state.adding = True
+            raise
+        for row in new:
+            row._flushed = True
+        self.counters['written'] += hits
+        if self.windows is not None:
+            self.counters['coalesced'] += hits - len(new)
+
+
+access_log_writer = AccessLogWriter.from_settings()
+atexit.register(access_log_writer.stop)
+
+
+def log_access(**fields):
+    """Queue an AccessLog row for writing"""
+    access_log_writer.log(**fields)
+
+
+def log_accesses(records):
+    """Queue several AccessLog rows, given as dicts of constructor arguments"""
+    access_log_writer.log_many(records)
@@ -0,0 +1,814 @@
+"""
+Benchmark scenarios for the identity app.
+
+Each scenario seeds its own data inside a transaction that is rolled back
+afterwards, so running ``manage.py benchmark`` never leaves rows behind.
+"""
+import time
+
+from django.contrib.auth.models import User
+from django.db import connection, reset_queries
+from django.test.utils import CaptureQueriesContext
+
+from .models import Identity, ContextPriority, AccessLogRollup
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """Register a benchmark scenario under ``name``"""
+    def decorator(func):
+        BENCHMARKS[name] = func
+        return func
+    return decorator
+
+
+def measure(func, repeat=1):
+    """Run ``func`` ``repeat`` times, returning (seconds per call, queries per call)"""
+    reset_queries()
+    with CaptureQueriesContext(connection) as ctx:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            func()
+        elapsed = time.perf_counter() - start
+    return elapsed / repeat, len(ctx.captured_queries) / repeat
+
+
+def seed_users(count, contexts=('legal', 'social', 'professional'), prefix='bench'):
+    """Create ``count`` users with one identity per context, the first one primary"""
+    users = User.objects.bulk_create(
+        User(username=f'{prefix}{i}', email=f'{prefix}{i}@example.com') for i in range(count)
+    )
+    if users and users[0].pk is None:
+        users = list(User.objects.filter(username__startswith=prefix).order_by('id'))
+
+    Identity.objects.bulk_create(
+        Identity(
+            user=user,
+            context=context,
+            given_name=f'Given{user.pk}',
+            family_name=f'Family{user.pk}',
+            email=f'{context}{user.pk}@example.com',
+            bio='x' * 200,
+            is_primary=(j == 0),
+        )
+        for user in users
+        for j, context in enumerate(contexts)
+    )
+    return users
+
+
+def _legacy_resolve(user_id, context, locale):
+    """The original four-query fallback chain from ContextualIdentityView"""
+    user = User.objects.get(id=user_id)
+    identity = Identity.objects.filter(user=user, context=context, locale=locale, is_active=True).first()
+    if not identity:
+        identity = Identity.objects.filter(user=user, context=context, is_active=True).first()
+    if not identity:
+        identity = Identity.objects.filter(user=user, is_primary=True, is_active=True).first()
+    return identity
+
+
+@benchmark('resolution')
+def bench_resolution(rows, repeat, write):
+    """Context resolution: legacy fallback chain vs single-query ranking"""
+    from .resolution import resolve_identity
+
+    users = seed_users(rows)
+    ContextPriority.objects.create(user=users[0], context='social', priority=0)
+    user_id = users[-1].pk
+
+    # 'display' is missing, so the legacy chain walks all the way to primary
+    for label, func in (
+        ('legacy', lambda: _legacy_resolve(user_id, 'display', 'fr-FR')),
+        ('single-query', lambda: resolve_identity(user_id, 'display', 'fr-FR')),
+    ):
+        seconds, queries = measure(func, repeat)
+        write(f'{label:<14} {seconds * 1e6:10.1f} us/lookup {queries:5.1f} queries/lookup')
+
+
+@benchmark('identity-cache')
+def bench_identity_cache(rows, repeat, write):
+    """Cached vs uncached contextual lookups"""
+    from .cache import identity_cache, get_cached_identity
+    from .resolution import resolve_identity
+
+    users = seed_users(rows)
+    user_id = users[-1].pk
+    identity_cache.clear()
+
+    for label, func in (
+        ('uncached', lambda: resolve_identity(user_id, 'social', 'en-US')),
+        ('cached', lambda: get_cached_identity(user_id, 'social', 'en-US')),
+    ):
+        seconds, queries = measure(func, repeat)
+        write(f'{label:<14} {seconds * 1e6:10.1f} us/lookup {queries:5.1f} queries/lookup')
+    write(f'stats: {identity_cache.stats()}')
+
+
+@benchmark('search')
+def bench_search(rows, repeat, write):
+    """Admin identity search: icontains Q filter vs trigram index"""
+    from django.db.models import Q
+    from . import search
+
+    users = seed_users(rows)
+    search.rebuild()
+    target = users[len(users) // 2].pk
+    base = Identity.objects.select_related('user').order_by('-created_at', '-id')
+
+    def legacy(query):
+        return list(base.filter(
+            Q(given_name__icontains=query) |
+            Q(family_name__icontains=query) |
+            Q(email__icontains=query) |
+            Q(user__username__icontains=query)
+        )[:20])
+
+    def indexed(query):
+        return list(search.search(base, 'identity', query)[:20])
+
+    for query in (f'Family{target}', f'ily{target}', str(target), 'zzzz', 'family'):
+        for label, func in (('icontains', legacy), ('trigram', indexed)):
+            seconds, _ = measure(lambda: func(query), repeat)
+            write(f'{label:<10} {query!r:<16} {seconds * 1e3:10.2f} ms/query')
+
+    query = f'family{target}'
+    seconds, _ = measure(lambda: search.ranked_search('identity', query), repeat)
+    write(f'{"typeahead":<10} {query!r:<16} {seconds * 1e3:10.2f} ms/query')
+
+
+def _legacy_save_user_profile(sender, instance, **kwargs):
+    """The original post_save handler that re-saved the UserRole on every User save"""
+    if hasattr(instance, 'profile'):
+        instance.profile.save()
+
+
+@benchmark('login')
+def bench_login(rows, repeat, write):
+    """Session logins with and without the legacy UserRole re-save"""
+    from django.db.models.signals import post_save
+    from django.test import Client
+
+    user = User.objects.create_user(username='bench-login')
+    seed_users(rows)
+
+    def login():
+        Client().force_login(user)
+
+    def writes(queries):
+        return sum(1 for query in queries if query['sql'].startswith(('INSERT', 'UPDATE', 'DELETE')))
+
+    post_save.connect(_legacy_save_user_profile, sender=User, dispatch_uid='bench-legacy-profile')
+    try:
+        legacy = measure(login, repeat)
+        with CaptureQueriesContext(connection) as ctx:
+            login()
+        legacy_writes = writes(ctx.captured_queries)
+    finally:
+        post_save.disconnect(sender=User, dispatch_uid='bench-legacy-profile')
+
+    current = measure(login, repeat)
+    with CaptureQueriesContext(connection) as ctx:
+        login()
+    current_writes = writes(ctx.captured_queries)
+
+    for label, (seconds, queries), count in (
+        ('legacy', legacy, legacy_writes), ('current', current, current_writes),
+    ):
+        write(f'{label:<14} {1 / seconds:10.0f} logins/s {queries:5.1f} queries/login {count:3d} writes/login')
+
+
+@benchmark('batch-resolve')
+def bench_batch_resolve(rows, repeat, write):
+    """One contextual lookup request per user vs one batch request, at 1/100/1000 ids"""
+    from rest_framework.test import APIRequestFactory, force_authenticate
+    from .audit import access_log_writer
+    from .cache import identity_cache
+    from .views import ContextualIdentityView, ResolveIdentitiesView
+
+    users = seed_users(max(rows, 1000))
+    viewer = users[0]
+    factory = APIRequestFactory()
+    single_view = ContextualIdentityView.as_view()
+    batch_view = ResolveIdentitiesView.as_view()
+
+    def single(user_ids):
+        identity_cache.clear()
+        for user_id in user_ids:
+            request = factory.get(f'/api/v1/users/{user_id}/identity/', HTTP_ACCEPT_CONTEXT='social')
+            force_authenticate(request, viewer)
+            single_view(request, user_id=user_id)
+
+    def batch(user_ids):
+        request = factory.post('/api/v1/identities/resolve/', {'user_ids': user_ids, 'context': 'social'},
+                               format='json')
+        force_authenticate(request, viewer)
+        batch_view(request)
+
+    # Write access logs inside the benchmark transaction so they roll back
+    synchronous, access_log_writer.synchronous = access_log_writer.synchronous, True
+    try:
+        for size in (1, 100, 1000):
+            user_ids = [user.pk for user in users[:size]]
+            runs = max(1, repeat // size)
+            for label, func in (('per-user', single), ('batch', batch)):
+                seconds, queries = measure(lambda: func(user_ids), runs)
+                write(f'{label:<10} {size:5d} ids {seconds * 1e3:10.2f} ms/request-set {queries:7.1f} queries')
+    finally:
+        access_log_writer.synchronous = synchronous
+
+
+def _row_bytes(queryset, columns):
+    """Approximate bytes of column data ``queryset`` reads for ``columns``"""
+    return sum(len(str(value)) for row in queryset.values_list(*columns) for value in row)
+
+
+@benchmark('sparse-fields')
+def bench_sparse_fields(rows, repeat, write):
+    """Display-context lookups: every column vs projection-pruned columns"""
+    from . import projection
+    from .resolution import candidate_identities, pick_identity, resolve_identity
+
+    users = seed_users(rows, contexts=('display', 'social', 'professional'))
+    Identity.objects.update(bio='b' * 2000, admin_notes='n' * 2000, phone='+15550100')
+    user_id = users[-1].pk
+    all_columns = [field.attname for field in Identity._meta.concrete_fields]
+
+    def full():
+        identity = pick_identity(candidate_identities([user_id]), 'display', 'en-US')
+        return identity.get_contextual_data()
+
+    cases = (
+        ('all-columns', full, all_columns),
+        ('projection', lambda: resolve_identity(user_id, 'display', 'en-US').get_contextual_data(),
+         projection.columns(['display'])),
+        ('fields=full_name', lambda: resolve_identity(
+            user_id, 'display', 'en-US', ('full_name',)).get_contextual_data(None, ('full_name',)),
+         projection.columns(['display'], ('full_name',))),
+    )
+    candidates = Identity.objects.filter(user_id=user_id, is_active=True)
+    for label, func, columns in cases:
+        seconds, queries = measure(func, repeat)
+        size = _row_bytes(candidates, [name for name in columns if name != 'user'])
+        write(f'{label:<18} {seconds * 1e6:10.1f} us/lookup {queries:5.1f} queries {size:8d} bytes read')
+
+
+def _legacy_contextual_data(identity):
+    """The original if/elif ladder from Identity.get_contextual_data"""
+    data = {
+        'id': identity.id,
+        'context': identity.context,
+        'locale': identity.locale,
+        'full_name': identity.get_full_name(),
+        'visibility': identity.visibility,
+    }
+    if identity.context == 'legal':
+        data.update({
+            'given_name': identity.given_name,
+            'family_name': identity.family_name,
+            'middle_name': identity.middle_name,
+            'title': identity.title,
+            'suffix': identity.suffix,
+        })
+    elif identity.context == 'social':
+        data.update({
+            'preferred_name': identity.preferred_name or identity.given_name,
+            'nickname': identity.nickname,
+            'pronouns': identity.pronouns,
+            'avatar_url': identity.avatar_url,
+            'bio': identity.bio,
+        })
+    elif identity.context == 'professional':
+        data.update({
+            'given_name': identity.given_name,
+            'family_name': identity.family_name,
+            'title': identity.title,
+            'email': identity.email,
+            'website': identity.website,
+            'bio': identity.bio,
+        })
+    elif identity.context == 'display':
+        data.update({
+            'display_name': identity.display_name or identity.get_full_name(),
+            'pronouns': identity.pronouns,
+            'avatar_url': identity.avatar_url,
+        })
+    if identity.custom_attributes:
+        data['custom_attributes'] = identity.custom_attributes
+    return data
+
+
+@benchmark('projection')
+def bench_projection(rows, repeat, write):
+    """Serialize in-memory identities (use --rows 100000): if/elif ladder vs compiled projections"""
+    from .projection import project
+    from .serializers import ContextualIdentitySerializer
+
+    contexts = ('legal', 'social', 'professional', 'display')
+    identities = [
+        Identity(
+            id=i, context=contexts[i % 4], given_name=f'Given{i}', family_name=f'Family{i}',
+            preferred_name='Pref' if i % 3 else '', title='Dr.' if i % 5 == 0 else '',
+            pronouns='they/them', bio='x' * 200, custom_attributes={'n': i} if i % 7 == 0 else {},
+        )
+        for i in range(rows)
+    ]
+    assert all(project(identity) == _legacy_contextual_data(identity) for identity in identities)
+
+    runs = max(1, repeat // 100)
+    for label, func in (
+        ('if/elif', lambda: [_legacy_contextual_data(identity) for identity in identities]),
+        ('compiled', lambda: [project(identity) for identity in identities]),
+        ('serializer', lambda: ContextualIdentitySerializer(identities, many=True).data),
+    ):
+        seconds, _ = measure(func, runs)
+        write(f'{label:<12} {seconds * 1e3:10.1f} ms/{rows} identities {seconds / rows * 1e9:8.0f} ns/identity')
+
+
+@benchmark('fast-serialize')
+def bench_fast_serialize(rows, repeat, write):
+    """Identity listings (use --rows 10000): ModelSerializer over instances vs values() rows"""
+    from . import fastpath, projection
+    from .serializers import IdentitySerializer, ContextualIdentitySerializer
+
+    seed_users(max(1, rows // 3))
+    identities = Identity.objects.order_by('-created_at', '-id')
+    contexts = projection.all_contexts()
+
+    for label, func in (
+        # .all() so every call queries afresh instead of reusing a result cache
+        ('serializer', lambda: IdentitySerializer(identities.all(), many=True).data),
+        ('values', lambda: fastpath.serialize_identities(fastpath.identity_rows(identities))),
+        ('contextual', lambda: ContextualIdentitySerializer(identities.all(), many=True).data),
+        ('contextual-values',
+         lambda: fastpath.serialize_contextual(fastpath.contextual_rows(identities, contexts))),
+    ):
+        seconds, _ = measure(func, repeat)
+        write(f'{label:<18} {seconds * 1e3:9.1f} ms/listing {identities.count() / seconds:10.0f} rows/s')
+
+
+def seed_access_logs(count, batch_size=10000, spread=None, identities=1, user_agents=None):
+    """
+    Add ``count`` AccessLog rows against ``identities`` benchmark identities,
+    timestamped now or, with ``spread`` (a timedelta), evenly over that much
+    of the past, cycling through ``user_agents``
+    """
+    from django.utils import timezone
+    from .models import AccessLog
+
+    user = User.objects.get_or_create(username='bench-logger')[0]
+    targets = [
+        Identity.objects.get_or_create(
+            user=user, context='legal', locale=f'l{n}', defaults={'given_name': 'Log', 'family_name': 'Target'},
+        )[0]
+        for n in range(identities)
+    ]
+    user_agents = user_agents or ['Mozilla/5.0 (X11; Linux x86_64) Benchmark/1.0']
+    now = timezone.now()
+    step = spread / count if spread else None
+    for start in range(0, count, batch_size):
+        AccessLog.objects.bulk_create(
+            AccessLog(
+                identity=targets[i % identities], accessed_by=user, accessed_fields=['given_name', 'family_name'],
+                access_context=('legal', 'social')[i % 2], ip_address=f'10.0.{i % 256}.{i % 251}',
+                user_agent=user_agents[i % len(user_agents)],
+                timestamp=now - spread + step * i if spread else now,
+            )
+            for i in range(start, min(start + batch_size, count))
+        )
+
+
+@benchmark('streaming')
+def bench_streaming(rows, repeat, write):
+    """Peak traced memory exporting AccessLogs (use --rows 1000000): materialized vs streamed"""
+    import json
+    import tracemalloc
+
+    from . import fastpath, streaming
+    from .models import AccessLog
+
+    def peak(func):
+        tracemalloc.start()
+        try:
+            start = time.perf_counter()
+            size = func()
+            return tracemalloc.get_traced_memory()[1], size, time.perf_counter() - start
+        finally:
+            tracemalloc.stop()
+
+    def materialized():
+        serialize = fastpath.access_log_serializer()
+        return len(json.dumps([serialize(row) for row in fastpath.access_log_rows(AccessLog.objects.all())]))
+
+    def streamed(format):
+        response = streaming.stream(
+            fastpath.access_log_rows(AccessLog.objects.all()), fastpath.access_log_serializer(), format
+        )
+        return sum(len(chunk) for chunk in response.streaming_content)
+
+    seeded = 0
+    size = 1000
+    while size <= rows:
+        seed_access_logs(size - seeded)
+        seeded = size
+        runs = [('stream-json', lambda: streamed('json')), ('stream-ndjson', lambda: streamed('ndjson'))]
+        # Materializing a million rows under tracemalloc takes gigabytes; the trend is clear by then
+        if size <= 100000:
+            runs.insert(0, ('materialized', materialized))
+        for label, func in runs:
+            memory, body, seconds = peak(func)
+            write(f'{size:>8} rows {label:<14} peak {memory / 2 ** 20:8.2f} MiB '
+                  f'body {body / 2 ** 20:8.1f} MiB {seconds:7.2f} s')
+        size *= 10
+
+
+@benchmark('export')
+def bench_export(rows, repeat, write):
+    """Peak traced memory and throughput of AccessLog extracts (use --rows 1000000)"""
+    import tracemalloc
+
+    from . import exports
+
+    seeded = 0
+    size = 10000
+    while size <= rows:
+        seed_access_logs(size - seeded)
+        seeded = size
+        for format, compress in (('ndjson', True), ('csv', True), ('ndjson', False)):
+            tracemalloc.start()
+            start = time.perf_counter()
+            body = sum(len(chunk) for chunk in exports.render(exports.batches({}), format, compress))
+            seconds = time.perf_counter() - start
+            memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            label = format + ('.gz' if compress else '')
+            write(f'{size:>8} rows {label:<10} peak {memory / 2 ** 20:7.2f} MiB '
+                  f'body {body / 2 ** 20:8.1f} MiB {size / seconds:9.0f} rows/s')
+        size *= 10
+
+
+@benchmark('rollups')
+def bench_rollups(rows, repeat, write):
+    """Hourly access history: GROUP BY over raw AccessLog vs the incremental rollups"""
+    from datetime import timedelta
+
+    from django.db.models import Count
+    from django.db.models.functions import TruncHour
+    from django.utils import timezone
+
+    from . import rollups, retention
+    from .models import AccessLog
+
+    seed_access_logs(rows, spread=timedelta(days=90), identities=20)
+    identity_id = Identity.objects.filter(user__username='bench-logger').order_by('id').values_list('id', flat=True)[0]
+    since = timezone.now().replace(minute=0, second=0, microsecond=0) - timedelta(days=30)
+
+    seconds, queries = measure(rollups.roll_up)
+    write(f'roll-up        {rows / seconds:10.0f} rows/s {queries:6.0f} queries')
+    write(f'rollup rows    {AccessLogRollup.objects.count():10d} for {rows} access logs')
+
+    def raw():
+        return dict(
+            AccessLog.objects.filter(identity_id=identity_id, timestamp__gte=since)
+            .annotate(hour=TruncHour('timestamp')).values('hour').annotate(n=Count('id'))
+            .order_by().values_list('hour', 'n')
+        )
+
+    assert raw() == rollups.hourly_counts(identity=identity_id, since=since)
+    for label, func in (
+        ('raw group-by', raw),
+        ('rollups', lambda: rollups.hourly_counts(identity=identity_id, since=since)),
+    ):
+        seconds, queries = measure(func, repeat)
+        write(f'{label:<14} {seconds * 1e3:10.2f} ms/query {queries:5.1f} queries')
+
+    start = time.perf_counter()
+    deleted = retention.prune(keep_months=1)
+    write(f'prune          {deleted / (time.perf_counter() - start):10.0f} rows/s deleted {deleted}')
+
+
+# A few hundred distinct browser strings of typical length
+BENCH_USER_AGENTS = [
+    f'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) '
+    f'Chrome/{100 + i % 30}.0.{4000 + i}.{i % 100} Safari/537.36'
+    for i in range(300)
+]
+
+# AccessLog as it was stored before user agents were interned and IPs packed
+LEGACY_ACCESS_LOG = (
+    'CREATE TABLE "bench_legacy_accesslog" ("id" integer NOT NULL PRIMARY KEY AUTOINCREMENT, '
+    '"access_context" varchar(20) NOT NULL, "ip_address" char(39) NOT NULL, "user_agent" text NOT NULL, '
+    '"timestamp" datetime NOT NULL, "accessed_by_id" integer NOT NULL, "identity_id" bigint NOT NULL, '
+    '"accessed_fields" text NOT NULL)',
+    'CREATE INDEX "bench_legacy_identity" ON "bench_legacy_accesslog" ("identity_id")',
+    'CREATE INDEX "bench_legacy_accessed_by" ON "bench_legacy_accesslog" ("accessed_by_id")',
+    'CREATE INDEX "bench_legacy_timestamp" ON "bench_legacy_accesslog" ("timestamp" DESC)',
+)
+
+
+def _sqlite_bytes(cursor, table):
+    """(table bytes, index bytes) of ``table`` from SQLite's dbstat"""
+    cursor.execute(
+        'SELECT name = %s, SUM(pgsize) FROM dbstat '
+        'WHERE name IN (SELECT name FROM sqlite_master WHERE tbl_name = %s) GROUP BY name = %s',
+        [table, table, table],
+    )
+    sizes = dict(cursor.fetchall())
+    return sizes.get(1, 0), sizes.get(0, 0)
+
+
+@benchmark('log-size')
+def bench_log_size(rows, repeat, write):
+    """AccessLog storage per row and projected to 10M rows: text columns vs interned agents and packed IPs"""
+    from . import compact
+    from .models import AccessLog, UserAgent
+
+    if connection.vendor != 'sqlite':
+        write('log-size reads page usage from SQLite dbstat; run it against an SQLite database')
+        return
+
+    compact.user_agents.clear()
+    start = time.perf_counter()
+    seed_access_logs(rows, user_agents=BENCH_USER_AGENTS)
+    write(f'insert         {rows / (time.perf_counter() - start):10.0f} rows/s '
+          f'interner {compact.user_agents.stats()}')
+
+    connection.ensure_connection()
+    connection.connection.create_function('bench_unpack_ip', 1, compact.unpack_ip, deterministic=True)
+    with connection.cursor() as cursor:
+        for statement in LEGACY_ACCESS_LOG:
+            cursor.execute(statement)
+        cursor.execute(
+            'INSERT INTO bench_legacy_accesslog (id, access_context, ip_address, user_agent, timestamp, '
+            'accessed_by_id, identity_id, accessed_fields) '
+            'SELECT log.id, log.access_context, bench_unpack_ip(log.ip), agent.value, log.timestamp, '
+            'log.accessed_by_id, log.identity_id, log.accessed_fields '
+            f'FROM {AccessLog._meta.db_table} log JOIN {UserAgent._meta.db_table} agent ON agent.id = log.agent_id'
+        )
+        layouts = (
+            ('text columns', _sqlite_bytes(cursor, 'bench_legacy_accesslog'), (0, 0)),
+            ('compact', _sqlite_bytes(cursor, AccessLog._meta.db_table),
+             _sqlite_bytes(cursor, UserAgent._meta.db_table)),
+        )
+
+    for label, (table, indexes), (lookup, lookup_indexes) in layouts:
+        per_row = table / rows
+        projected = (per_row + indexes / rows) * 10 ** 7 + lookup + lookup_indexes
+        write(f'{label:<14} {per_row:8.1f} bytes/row table {table / 2 ** 20:8.1f} MiB '
+              f'indexes {indexes / 2 ** 20:7.1f} MiB lookup {(lookup + lookup_indexes) / 2 ** 10:7.1f} KiB '
+              f'10M rows ~{projected / 2 ** 30:6.2f} GiB')
+
+
+@benchmark('coalesce')
+def bench_coalesce(rows, repeat, write):
+    """Audit rows for polling clients (100, one access each every 5 s): a row per access vs coalescing"""
+    from datetime import timedelta
+
+    from django.db.models import Count, Sum
+    from django.utils import timezone
+
+    from .audit import AccessLogWriter
+    from .models import AccessLog
+
+    user = User.objects.create(username='bench-poller')
+    identity = Identity.objects.create(user=user, context='social', given_name='Poll', family_name='Target')
+    clients = 100
+    start = timezone.now() - timedelta(seconds=5 * rows // clients)
+    records = [
+        {
+            'identity_id': identity.id, 'accessed_by_id': user.id, 'access_context': 'social',
+            'accessed_fields': ['contextual_data'], 'ip_address': f'10.1.0.{i % clients}',
+            'user_agent': BENCH_USER_AGENTS[i % clients], 'timestamp': start + timedelta(seconds=5 * (i // clients)),
+        }
+        for i in range(rows)
+    ]
+    batch_size = 500
+
+    for label, window in (('row per access', 0), ('window 60s', 60), ('window 300s', 300)):
+        AccessLog.objects.filter(identity=identity).delete()
+        # Synchronous, so each log_many call is written as one flushed batch
+        writer = AccessLogWriter(synchronous=True, batch_size=batch_size, coalesce_window=window)
+        started = time.perf_counter()
+        for offset in range(0, rows, batch_size):
+            writer.log_many(records[offset:offset + batch_size])
+        seconds = time.perf_counter() - started
+        written = AccessLog.objects.filter(identity=identity).aggregate(rows=Count('id'), hits=Sum('hit_count'))
+        write(f'{label:<15} {written["rows"]:9d} rows for {written["hits"]} accesses '
+              f'{rows / seconds:9.0f} accesses/s')
+
+
+@benchmark('cold-archive')
+def bench_cold_archive(rows, repeat, write):
+    """Bytes per row and query cost: AccessLog table, NDJSON.gz export, columnar segments (zlib, lzma)"""
+    import os
+    import shutil
+    import tempfile
+    from datetime import timedelta
+
+    from django.utils import timezone
+
+    from . import exports, rollups, segments
+    from .models import AccessLog
+
+    seed_access_logs(rows, spread=timedelta(days=365), identities=20, user_agents=BENCH_USER_AGENTS)
+    identity_id = Identity.objects.filter(user__username='bench-logger').order_by('id').values_list('id', flat=True)[0]
+    month_ago = timezone.now() - timedelta(days=60)
+    selective = {'identity_id': identity_id, 'timestamp__gte': month_ago - timedelta(days=30),
+                 'timestamp__lt': month_ago}
+
+    def count(batches):
+        return sum(len(batch) for batch in batches)
+
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            table, indexes = _sqlite_bytes(cursor, AccessLog._meta.db_table)
+        write(f'{"table":<16} {(table + indexes) / rows:8.1f} bytes/row (with indexes)')
+    start = time.perf_counter()
+    body = sum(len(chunk) for chunk in exports.render(exports.batches({}), 'ndjson', compress=True))
+    write(f'{"ndjson.gz":<16} {body / rows:8.1f} bytes/row {rows / (time.perf_counter() - start):9.0f} rows/s')
+    seconds, _ = measure(lambda: count(exports.batches(selective)), repeat)
+    matching = count(exports.batches(selective))
+    write(f'{"table query":<16} {seconds * 1e3:8.1f} ms for {matching} rows (one identity, one month)')
+
+    directory = tempfile.mkdtemp(prefix='bench-segments-')
+    try:
+        for codec in sorted(segments.CODECS):
+            start = time.perf_counter()
+            writer = segments.SegmentWriter(codec)
+            for batch in exports.batches({}):
+                writer.add(batch)
+            size = writer.write(os.path.join(directory, f'{codec}.als'))
+            seconds = time.perf_counter() - start
+            write(f'{"segment " + codec:<16} {size / rows:8.1f} bytes/row {rows / seconds:9.0f} rows/s written')
+
+        shutil.rmtree(directory)
+        # Archiving rolls up first; time the move on its own
+        rollups.roll_up()
+        start = time.perf_counter()
+        moved = segments.archive(older_than_days=1, directory=directory)
+        write(f'{"archive":<16} {moved:8d} rows moved {moved / (time.perf_counter() - start):9.0f} rows/s '
+              f'into {len(segments.segment_paths(directory))} segments')
+        assert count(segments.query(selective, directory)) == matching
+        for label, lookups in (('full scan', {}), ('segment query', selective)):
+            seconds, _ = measure(lambda: count(segments.query(lookups, directory)), repeat)
+            found = count(segments.query(lookups, directory))
+            write(f'{label:<16} {seconds * 1e3:8.1f} ms for {found} rows')
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+@benchmark('access-stats')
+def bench_access_stats(rows, repeat, write):
+    """30 days of one identity's access stats: GROUP BY over raw AccessLog vs the daily rollups, as the log grows"""
+    from datetime import timedelta
+    from unittest import mock
+
+    from django.db.models import Sum
+    from django.db.models.functions import TruncDate
+    from django.utils import timezone
+
+    from . import rollups
+    from .models import AccessLog
+
+    def raw(identity_id, since):
+        logs = AccessLog.objects.filter(identity_id=identity_id, timestamp__gte=since)
+        return (
+            list(logs.annotate(day=TruncDate('timestamp')).values('day', 'access_context')
+                 .annotate(n=Sum('hit_count')).order_by('day')),
+            list(logs.values('accessed_by_id').annotate(n=Sum('hit_count')).order_by('-n')[:10]),
+        )
+
+    for _ in range(2):
+        seed_access_logs(rows, spread=timedelta(days=90), identities=20)
+        # Every seeded row is committed, so none has to wait to settle
+        with mock.patch.object(rollups, 'SETTLE', timedelta(0)):
+            seconds, _queries = measure(rollups.roll_up)
+        write(f'{AccessLog.objects.count():>9} rows: roll-up {rows / seconds:8.0f} rows/s into 3 rollups')
+
+        identity_id = Identity.objects.filter(user__username='bench-logger').order_by('id').values_list('id', flat=True)[0]
+        since = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=30)
+        totals = (sum(row['n'] for row in raw(identity_id, since)[0]), rollups.access_stats(identity_id, since.date())['total'])
+        write(f'{"":>16}accesses since {since:%Y-%m-%d}: {totals[0]} raw, {totals[1]} rolled up')
+        for label, func in (
+            ('raw group-by', lambda: raw(identity_id, since)),
+            ('daily rollups', lambda: rollups.access_stats(identity_id, since.date())),
+        ):
+            seconds, queries = measure(func, repeat)
+            write(f'{"":>16}{label:<14} {seconds * 1e3:9.2f} ms {queries:4.1f} queries')
+
+
+@benchmark('set-primary')
+def bench_set_primary(rows, repeat, write):
+    """Primary identity switches per second, load-and-save vs set_primary, serial and from 4 threads"""
+    import os
+    import tempfile
+    import threading
+
+    from django.db import connections
+    from django.utils import timezone
+
+    # Threads need committed rows, so this runs on a scratch SQLite file
+    # instead of inside the rolled back transaction
+    alias = 'bench-primary'
+    directory = tempfile.TemporaryDirectory()
+    connections.settings[alias] = connections.configure_settings({
+        'default': connections.settings['default'],
+        alias: {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(directory.name, 'primary.sqlite3'),
+            'OPTIONS': {'timeout': 30},
+        },
+    })[alias]
+    identities = Identity.objects.db_manager(alias)
+    columns = [field.attname for field in Identity._meta.concrete_fields if not field.primary_key]
+
+    def legacy(user_id, identity_id):
+        """The original switch: clear, then load the target and write every column back"""
+        identities.filter(user_id=user_id, is_primary=True).update(is_primary=False, updated_at=timezone.now())
+        identity = identities.get(id=identity_id, user_id=user_id)
+        identity.is_primary = True
+        identity.updated_at = timezone.now()
+        # What save() sends, without the signal handlers that write to the default database
+        identities.filter(pk=identity.pk).update(**{name: getattr(identity, name) for name in columns})
+
+    def run(switch, threads, users):
+        errors = []
+
+        def worker(n):
+            try:
+                for i in range(repeat):
+                    user_id, ids = users[(n + i) % len(users)]
+                    try:
+                        switch(user_id, ids[(n + i) % len(ids)])
+                    except Exception as e:
+                        errors.append(e)
+            finally:
+                connections[alias].close()
+
+        workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+        start = time.perf_counter()
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        return threads * repeat / (time.perf_counter() - start), len(errors)
+
+    try:
+        with connections[alias].schema_editor() as editor:
+            editor.create_model(User)
+            editor.create_model(Identity)
+        User.objects.db_manager(alias).bulk_create(User(username=f'switch{i}') for i in range(rows))
+        user_ids = list(User.objects.using(alias).values_list('id', flat=True))
+        identities.bulk_create(
+            Identity(user_id=user_id, context=context, given_name='G', family_name='F', bio='x' * 200,
+                     is_primary=j == 0)
+            for user_id in user_ids
+            for j, context in enumerate(('legal', 'social', 'professional'))
+        )
+        by_user = {}
+        for identity_id, user_id in identities.order_by('id').values_list('id', 'user_id'):
+            by_user.setdefault(user_id, []).append(identity_id)
+        users = list(by_user.items())
+
+        for label, switch in (('load-and-save', legacy), ('set_primary', identities.set_primary)):
+            for threads, pool in ((1, users), (4, users[:4])):
+                rate, errors = run(switch, threads, pool)
+                primaries = identities.filter(is_primary=True).count()
+                write(f'{label:<14} {threads} thread(s) {rate:8.0f} switches/s {errors:5d} errors, '
+                      f'{len(users) - primaries} users without a primary')
+    finally:
+        connections[alias].close()
+        del connections.settings[alias]
+        directory.cleanup()
+
+
+@benchmark('partial-save')
+def bench_partial_save(rows, repeat, write):
+    """Saving a one-field edit to identities with a long bio and custom attributes: every column vs changed ones"""
+    users = seed_users(rows, contexts=('professional',), prefix='bench-save')
+    Identity.objects.filter(user__in=users).update(
+        bio='b' * 500, custom_attributes={f'attribute{i}': 'v' * 40 for i in range(50)},
+    )
+    identities = list(Identity.objects.filter(user__in=users))
+    columns = [field.name for field in Identity._meta.concrete_fields if not field.primary_key]
+
+    def edit(save):
+        def run():
+            for identity in identities:
+                identity.nickname = f'n{identity.version}'
+                save(identity)
+        return run
+
+    def every_column(identity):
+        # What save() sent before: the whole row, read version or not
+        identity.save(update_fields=columns)
+
+    for label, save in (('every column', every_column), ('changed only', lambda identity: identity.save())):
+        with CaptureQueriesContext(connection) as ctx:
+            start = time.perf_counter()
+            for _ in range(repeat):
+                edit(save)()
+            seconds = (time.perf_counter() - start) / (repeat * len(identities))
+        sent = sum(len(query['sql']) for query in ctx.captured_queries) / (repeat * len(identities))
+        write(f'{label:<13} {seconds * 1e6:8.1f} us/save {sent:8.0f} bytes of SQL per save')
@@ -0,0 +1,198 @@
+"""
+Read-through cache for resolved contextual identities.
+
+Two tiers sit in front of the database: a small per-process LRU and the
+shared Django cache backend. Every entry is stamped with a per-user version
+number kept in the shared tier; bumping that number (see ``signals.py``)
+makes all of the user's cached resolutions unreachable at once.
+
+Each worker remembers the versions it has read for ``VERSION_TTL`` seconds,
+so a local hit does no I/O at all; a bump made by another worker is seen once
+that copy expires, and the worker making it sees it straight away. The shared
+tier must be a cache every worker process sees (Redis or Memcached in
+``CACHES``). With no ``ALIAS`` the cache is off and every lookup resolves
+from the database.
+"""
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .resolution import resolve_identity
+
+DEFAULTS = {
+    'ALIAS': None,
+    'LOCAL_MAXSIZE': 1024,
+    'TIMEOUT': 300,
+    'VERSION_TTL': 2.0,
+}
+
+# Stored in place of None so a cached "no identity" is not mistaken for a miss
+NO_IDENTITY = 'identity:none'
+
+
+class LocalLRU:
+    """Thread-safe bounded LRU mapping, one per worker process"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+                return self._data[key]
+            except KeyError:
+                return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class IdentityCache:
+    """Versioned two-tier cache keyed by (user, context, locale)"""
+
+    def __init__(self, alias='default', local_maxsize=1024, timeout=300, version_ttl=2.0):
+        self.alias = alias
+        self.timeout = timeout
+        self.version_ttl = version_ttl
+        self.local = LocalLRU(local_maxsize)
+        # user id -> (version, monotonic expiry)
+        self.versions = LocalLRU(local_maxsize)
+        self.counters = {'local_hits': 0, 'shared_hits': 0, 'misses': 0, 'invalidations': 0}
+
+    @property
+    def shared(self):
+        return caches[self.alias]
+
+    @staticmethod
+    def version_key(user_id):
+        return f'identity:version:{user_id}'
+
+    @staticmethod
+    def entry_key(user_id, context, locale, version, fields=None):
+        # Negotiated requests pass preference tuples
+        context, locale = (
+            ','.join(value) if isinstance(value, (list, tuple)) else value or ''
+            for value in (context, locale)
+        )
+        key = f'identity:resolved:{user_id}:{context}:{locale}:{version}'
+        if fields is not None:
+            # Entries hold only the columns the field list needs
+            key += ':' + ','.join(fields)
+        return key
+
+    def get_version(self, user_id):
+        remembered = self.versions.get(user_id)
+        if remembered is not None and remembered[1] > time.monotonic():
+            return remembered[0]
+
+        key = self.version_key(user_id)
+        version = self.shared.get(key)
+        if version is None:
+            # Seed from the clock so a lost counter never reuses an old version
+            self.shared.add(key, time.time_ns(), timeout=None)
+            version = self.shared.get(key)
+        self._remember_version(user_id, version)
+        return version
+
+    def _remember_version(self, user_id, version):
+        self.versions.set(user_id, (version, time.monotonic() + self.version_ttl))
+
+    def invalidate_user(self, user_id):
+        """Bump the user's version so every cached resolution for them goes stale"""
+        if self.alias is None:
+            return
+        key = self.version_key(user_id)
+        try:
+            version = self.shared.incr(key)
+        except ValueError:
+            version = time.time_ns()
+            self.shared.set(key, version, timeout=None)
+        self._remember_version(user_id, version)
+        self.counters['invalidations'] += 1
+
+    def get_identity(self, user_id, context, locale=None, fields=None):
+        """Return the resolved identity (or None), loading it on a miss"""
+        if self.alias is None:
+            self.counters['misses'] += 1
+            return resolve_identity(user_id, context, locale, fields)
+
+        version = self.get_version(user_id)
+        key = self.entry_key(user_id, context, locale, version, fields)
+
+        value = self.local.get(key)
+        if value is not None:
+            self.counters['local_hits'] += 1
+            return self._unwrap(value)
+
+        value = self.shared.get(key)
+        if value is not None:
+            self.counters['shared_hits'] += 1
+        else:
+            self.counters['misses'] += 1
+            identity = resolve_identity(user_id, context, locale, fields)
+            value = NO_IDENTITY if identity is None else identity
+            self.shared.set(key, value, timeout=self.timeout)
+
+        self.local.set(key, value)
+        return self._unwrap(value)
+
+    @staticmethod
+    def _unwrap(value):
+        if value == NO_IDENTITY:
+            return None
+        # Callers get their own instance; the cached one is shared across requests
+        return copy.copy(value)
+
+    def clear(self):
+        """Drop the local tier and reset counters (shared entries expire on their own)"""
+        self.local.clear()
+        self.versions.clear()
+        self.local.evictions = 0
+        for name in self.counters:
+            self.counters[name] = 0
+
+    def stats(self):
+        return {
+            **self.counters,
+            'local_evictions': self.local.evictions,
+            'local_size': len(self.local),
+            'local_maxsize': self.local.maxsize,
+        }
+
+
+def _build_cache():
+    options = {**DEFAULTS, **getattr(settings, 'IDENTITY_CACHE', {})}
+    return IdentityCache(
+        alias=options['ALIAS'],
+        local_maxsize=options['LOCAL_MAXSIZE'],
+        timeout=options['TIMEOUT'],
+        version_ttl=options['VERSION_TTL'],
+    )
+
+
+identity_cache = _build_cache()
+
+
+def get_cached_identity(user_id, context, locale=None, fields=None):
+    """Cached equivalent of ``resolution.resolve_identity``"""
+    return identity_cache.get_identity(user_id, context, locale, fields)
@@ -0,0 +1,117 @@
+"""
+Compact AccessLog storage.
+
+A few hundred distinct user agents account for almost every AccessLog row,
+so rows reference an interned ``UserAgent`` instead of repeating the string.
+``UserAgentInterner`` maps strings to ids through a per-process LRU; misses
+are resolved with one lookup by digest and one conflict-ignoring insert per
+batch, whichever process gets there first. Ids are only cached once the
+transaction that may have created them commits, so a rolled-back insert
+never leaves a dangling id behind.
+
+IP addresses are stored packed: 4 bytes for IPv4, 16 for IPv6, empty when
+the client address could not be parsed.
+"""
+import hashlib
+import ipaddress
+from functools import lru_cache
+
+from django.apps import apps
+from django.conf import settings
+from django.db import transaction
+
+from .cache import LocalLRU
+
+DEFAULTS = {
+    'USER_AGENT_CACHE_SIZE': 1024,
+}
+
+
+def digest(value):
+    return hashlib.sha256(value.encode('utf-8')).hexdigest()
+
+
+def pack_ip(value):
+    """``value`` as packed bytes, ``b''`` when it is not an IP address"""
+    if not value:
+        return b''
+    try:
+        return ipaddress.ip_address(value.strip()).packed
+    except ValueError:
+        return b''
+
+
+@lru_cache(maxsize=4096)
+def _unpack(packed):
+    return str(ipaddress.ip_address(packed)) if packed else ''
+
+
+def unpack_ip(packed):
+    """The text form of a packed address (bytes or memoryview), '' when empty"""
+    return _unpack(bytes(packed)) if packed is not None else ''
+
+
+class UserAgentInterner:
+    """String -> ``UserAgent`` id, through a bounded per-process LRU"""
+
+    def __init__(self, maxsize=1024, model=None):
+        self.local = LocalLRU(maxsize)
+        self.counters = {'hits': 0, 'misses': 0, 'created': 0}
+        # Migrations pass their historical model
+        self._model = model
+
+    @classmethod
+    def from_settings(cls):
+        options = {**DEFAULTS, **getattr(settings, 'IDENTITY_AUDIT', {})}
+        return cls(maxsize=options['USER_AGENT_CACHE_SIZE'])
+
+    @property
+    def model(self):
+        return self._model or apps.get_model('identity', 'UserAgent')
+
+    def intern(self, value):
+        return self.intern_many([value])[value]
+
+    def intern_many(self, values):
+        """``{value: id}`` for every string in ``values``, creating missing ones"""
+        ids = {}
+        missing = {}
+        for value in set(values):
+            agent_id = self.local.get(value)
+            if agent_id is None:
+                missing[digest(value)] = value
+            else:
+                ids[value] = agent_id
+        self.counters['hits'] += len(ids)
+        if not missing:
+            return ids
+
+        self.counters['misses'] += len(missing)
+        found = self._lookup(missing)
+        if len(found) < len(missing):
+            created = [self.model(digest=key, value=value) for key, value in missing.items() if value not in found]
+            # Another writer may insert the same agent in between; its row wins
+            self.model.objects.bulk_create(created, ignore_conflicts=True)
+            self.counters['created'] += len(created)
+            found.update(self._lookup({obj.digest: obj.value for obj in created}))
+
+        transaction.on_commit(lambda: self._remember(found))
+        ids.update(found)
+        return ids
+
+    def _lookup(self, by_digest):
+        rows = self.model.objects.filter(digest__in=list(by_digest)).values_list('digest', 'id')
+        return {by_digest[key]: agent_id for key, agent_id in rows}
+
+    def _remember(self, found):
+        for value, agent_id in found.items():
+            self.local.set(value, agent_id)
+
+    def stats(self):
+        return {**self.counters, 'size': len(self.local), 'evictions': self.local.evictions}
+
+    def clear(self):
+        self.local.clear()
+
+
+user_agents = UserAgentInterner.from_settings()
@@ -0,0 +1,99 @@
+"""
+Conditional GET support for the identity endpoints.
+
+Responses carry a strong ETag derived from the (id, updated_at) pairs of the
+identities in the body plus a *variant* describing everything else that
+shapes it (serializer, requested context, what the viewer may see), and a
+Last-Modified of the newest ``updated_at``. Views check the request's
+validators before serializing, and where possible before loading full rows,
+so a matching ``If-None-Match`` costs at most one narrow query. Writes may
+send the ETag they read back in ``If-Match`` to make sure they only apply to
+that representation (see ``matches``).
+"""
+import hashlib
+
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date, parse_etags
+
+# Request headers that select a different representation of the same URL
+VARY_HEADERS = ('Accept-Context', 'Accept-Language', 'Authorization')
+
+# Columns needed to compute validators without loading the full row
+VALIDATOR_FIELDS = ('id', 'updated_at')
+
+
+def is_conditional(request):
+    """Whether the request carries validators worth checking before loading data"""
+    return 'HTTP_IF_NONE_MATCH' in request.META or 'HTTP_IF_MODIFIED_SINCE' in request.META
+
+
+def compute_etag(rows, *variant):
+    """Strong ETag over ``(id, updated_at)`` pairs and the representation variant"""
+    digest = hashlib.sha256()
+    for part in variant:
+        digest.update(f'{part}\x1f'.encode())
+    for pk, updated_at in rows:
+        digest.update(f'{pk}:{updated_at.isoformat()}\x1e'.encode())
+    return f'"{digest.hexdigest()[:32]}"'
+
+
+def last_modified(rows):
+    """Newest ``updated_at`` of ``rows`` as a Unix timestamp, or None if empty"""
+    timestamps = [updated_at.timestamp() for _, updated_at in rows]
+    return int(max(timestamps)) if timestamps else None
+
+
+def validators(identities):
+    """``(id, updated_at)`` pairs of already loaded identities or ``values()`` rows"""
+    return [
+        (identity['id'], identity['updated_at']) if isinstance(identity, dict)
+        else (identity.id, identity.updated_at)
+        for identity in identities
+    ]
+
+
+def matches(request, etag):
+    """Whether the request's ``If-Match`` (if any) accepts ``etag``"""
+    header = request.META.get('HTTP_IF_MATCH')
+    if header is None:
+        return True
+    tags = parse_etags(header)
+    return tags == ['*'] or etag in tags
+
+
+def not_modified(request, etag, modified=None):
+    """
+    The 304 (or 412) response the request's conditional headers call for,
+    or None if the full response should be sent.
+    """
+    response = get_conditional_response(request, etag=etag, last_modified=modified)
+    if response is not None:
+        add_validators(response, etag, modified)
+    return response
+
+
+def add_validators(response, etag, modified=None):
+    response['ETag'] = etag
+    if modified is not None:
+        response['Last-Modified'] = http_date(modified)
+    patch_vary_headers(response, VARY_HEADERS)
+    return response
+
+
+def precheck(request, queryset, *variant):
+    """
+    Answer a conditional request for the single row in ``queryset`` from its
+    validators alone. Returns the 304/412 response, or None to carry on.
+    """
+    if not is_conditional(request):
+        return None
+    rows = list(queryset.values_list(*VALIDATOR_FIELDS))
+    if not rows:
+        return None
+    return not_modified(request, compute_etag(rows, *variant), last_modified(rows))
+
+
+def respond(response, identities, *variant):
+    """Add validators computed from ``identities`` to ``response``"""
+    rows = validators(identities)
+    return add_validators(response, compute_etag(rows, *variant), last_modified(rows))
@@ -1,5 +1,4 @@
-from identity.models import UserRole
-from identity.views.utils import is_admin_user
+from identity.principal import get_principal
 
 
 def global_context(request):
@@ -9,5 +8,5 @@ def global_context(request):
     """
     return {
         'site_name': 'Identity Management System',
-        'is_admin': is_admin_user(request.user) if request.user.is_authenticated else False,
+        'is_admin': get_principal(request.user).can_access_admin_panel,
     }
@@ -0,0 +1,170 @@
+"""
+AccessLog extracts for compliance.
+
+Matching rows are read in keyset order over ``(timestamp, id)``, one batch at
+a time with the owner and accessor joined in, and rendered as CSV or NDJSON,
+gzip-compressed as they are produced. Only the current batch is ever held in
+memory, so an export's footprint is set by ``BATCH_SIZE`` however many rows
+match. Every row carries its ``id``: an interrupted export resumes with
+``after=<id of the last complete row received>``.
+
+Used by the admin export endpoint and ``manage.py export_access_logs``.
+"""
+import csv
+
+from django.db.models import F
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import compact, fastpath, streaming
+from .models import AccessLog
+from .pagination import KeysetPaginator
+
+BATCH_SIZE = 5000
+
+ORDERING = ('timestamp', 'id')
+
+# Output columns, in order; the joined ones come from the identity, accessor
+# and interned user agent, the IP is unpacked while rendering
+COLUMNS = (
+    'id', 'timestamp', 'identity_id', 'identity_user_id', 'accessed_by_id', 'accessed_by_username',
+    'access_context', 'accessed_fields', 'ip_address', 'user_agent', 'last_seen', 'hit_count',
+)
+JOINED_COLUMNS = {
+    'identity_user_id': F('identity__user_id'),
+    'accessed_by_username': F('accessed_by__username'),
+    **fastpath.ACCESS_LOG_COMPACT,
+}
+
+FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+# Filters accepted by ``parse_filters``, mapped to the lookups they apply
+FILTERS = {
+    'since': 'timestamp__gte',
+    'until': 'timestamp__lt',
+    'identity': 'identity_id',
+    'accessed_by': 'accessed_by_id',
+    'context': 'access_context',
+}
+
+
+class InvalidExport(Exception):
+    pass
+
+
+def _parse_datetime(name, value):
+    parsed = parse_datetime(value)
+    if parsed is None:
+        raise InvalidExport(f"'{name}' must be an ISO 8601 datetime, got '{value}'")
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+def parse_id(name, value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise InvalidExport(f"'{name}' must be an integer id, got '{value}'")
+
+
+def parse_filters(params):
+    """
+    Lookups for the filters set in ``params`` (query parameters or command
+    options, as strings). ``since`` is inclusive, ``until`` exclusive.
+    """
+    lookups = {}
+    for name, lookup in FILTERS.items():
+        value = params.get(name)
+        if value in (None, ''):
+            continue
+        if name in ('since', 'until'):
+            value = _parse_datetime(name, value)
+        elif name in ('identity', 'accessed_by'):
+            value = parse_id(name, value)
+        lookups[lookup] = value
+    return lookups
+
+
+def resume_position(after):
+    """The keyset position of AccessLog ``after``, to continue an export past it"""
+    position = AccessLog.objects.filter(pk=after).values(*ORDERING).first()
+    if position is None:
+        raise InvalidExport(f'Access log {after} does not exist; cannot resume after it')
+    return position
+
+
+def batches(lookups, position=None, batch_size=BATCH_SIZE):
+    """Lists of matching rows in ``ORDERING``, starting after ``position``"""
+    rows = AccessLog.objects.filter(**lookups).values(
+        *(name for name in COLUMNS if name not in JOINED_COLUMNS), **JOINED_COLUMNS
+    )
+    paginator = KeysetPaginator(rows, batch_size, ordering=ORDERING, salt='identity.exports')
+    cursor = paginator.encode_cursor(position) if position else None
+    while True:
+        page = paginator.get_page(cursor)
+        if page.object_list:
+            yield page.object_list
+        if not page.has_next():
+            return
+        cursor = page.next_cursor
+
+
+class _Echo:
+    """File-like object whose write() hands back the line csv.writer produced"""
+
+    def write(self, value):
+        return value
+
+
+def _ndjson(batches, serialize):
+    for batch in batches:
+        yield '\n'.join(streaming.dumps(serialize(row)) for row in batch) + '\n'
+
+
+def _csv(batches, serialize):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(COLUMNS)
+    for batch in batches:
+        lines = []
+        for row in batch:
+            data = serialize(row)
+            data['accessed_fields'] = streaming.dumps(data['accessed_fields'])
+            lines.append(writer.writerow([data[name] for name in COLUMNS]))
+        yield ''.join(lines)
+
+
+RENDERERS = {'csv': _csv, 'ndjson': _ndjson}
+
+
+def render(batches, format='ndjson', compress=True, progress=None):
+    """
+    The export body as an iterable of chunks (bytes when ``compress``).
+    ``progress(rows, last_id)`` is called after each batch is rendered.
+    """
+    to_representation = fastpath.datetime_formatter()
+
+    def serialize(row):
+        data = {name: row[name] for name in COLUMNS}
+        data['timestamp'] = to_representation(data['timestamp'])
+        data['last_seen'] = to_representation(data['last_seen'])
+        data['ip_address'] = compact.unpack_ip(data['ip_address'])
+        return data
+
+    def tracked():
+        exported = 0
+        for batch in batches:
+            yield batch
+            exported += len(batch)
+            if progress:
+                progress(exported, batch[-1]['id'])
+
+    chunks = RENDERERS[format](tracked(), serialize)
+    return streaming.gzip_stream(chunks) if compress else chunks
+
+
+def filename(format, compress=True):
+    return f'access-logs.{format}' + ('.gz' if compress else '')
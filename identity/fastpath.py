@@ -0,0 +1,116 @@
+"""
+Read-only fast path for the identity list endpoints and exports.
+
+Listings page (or stream, see ``streaming``) through ``values()`` rows
+holding exactly the serialized columns and build each output dict straight
+from the row, skipping model instantiation and DRF's per-field machinery. The output is identical to
+``IdentitySerializer`` and ``ContextualIdentitySerializer``; writes and
+single-object endpoints keep using the serializers.
+"""
+from operator import itemgetter
+
+from django.db.models import F
+from rest_framework import ISO_8601
+from rest_framework.settings import api_settings
+
+from . import compact, projection
+from .serializers import IdentitySerializer
+
+# IdentitySerializer.full_name has no model attribute behind it, so DRF leaves
+# it out of the output; so does the fast path
+IDENTITY_COLUMNS = tuple(name for name in IdentitySerializer.Meta.fields if name != 'full_name')
+
+# Columns whose representation differs from the stored value
+DATETIME_COLUMNS = ('created_at', 'updated_at')
+
+_read_identity = itemgetter(*IDENTITY_COLUMNS)
+
+
+def datetime_formatter():
+    """
+    ``DateTimeField.to_representation`` of IdentitySerializer with the current
+    timezone looked up once per listing instead of once per value
+    """
+    field = IdentitySerializer().fields[DATETIME_COLUMNS[0]]
+    zone = field.timezone if hasattr(field, 'timezone') else field.default_timezone()
+    if zone is None or getattr(field, 'format', api_settings.DATETIME_FORMAT) != ISO_8601:
+        return field.to_representation
+
+    def to_representation(value):
+        if not value:
+            return None
+        value = value.astimezone(zone).isoformat()
+        if value.endswith('+00:00'):
+            value = value[:-6] + 'Z'
+        return value
+    return to_representation
+
+
+def identity_rows(queryset):
+    """``queryset`` as ``values()`` rows for ``serialize_identities``"""
+    return queryset.values(*IDENTITY_COLUMNS)
+
+
+def identity_serializer():
+    """A function rendering one row from ``identity_rows``, as ``serialize_identities`` does"""
+    to_representation = datetime_formatter()
+
+    def serialize(row):
+        data = dict(zip(IDENTITY_COLUMNS, _read_identity(row)))
+        for name in DATETIME_COLUMNS:
+            data[name] = to_representation(data[name])
+        return data
+    return serialize
+
+
+def serialize_identities(rows):
+    """``IdentitySerializer(..., many=True).data`` for rows from ``identity_rows``"""
+    return list(map(identity_serializer(), rows))
+
+
+def contextual_rows(queryset, contexts, fields=None):
+    """
+    ``queryset`` as ``values()`` rows carrying the columns the projections of
+    ``contexts`` (narrowed to ``fields``) read
+    """
+    return queryset.values(*projection.columns(contexts, fields))
+
+
+def serialize_contextual(rows, fields=None):
+    """``ContextualIdentitySerializer(..., many=True).data`` for rows from ``contextual_rows``"""
+    return [projection.project_row(row, fields) for row in rows]
+
+
+# AccessLog rows as exported, foreign keys by id
+ACCESS_LOG_COLUMNS = (
+    'id', 'identity_id', 'accessed_by_id', 'access_context', 'accessed_fields',
+    'ip_address', 'user_agent', 'timestamp', 'last_seen', 'hit_count',
+)
+
+# Exported under their text names, decoded while serializing
+ACCESS_LOG_COMPACT = {
+    'ip_address': F('ip'),
+    'user_agent': F('agent__value'),
+}
+
+_read_access_log = itemgetter(*ACCESS_LOG_COLUMNS)
+
+
+def access_log_rows(queryset):
+    return queryset.values(
+        *(name for name in ACCESS_LOG_COLUMNS if name not in ACCESS_LOG_COMPACT), **ACCESS_LOG_COMPACT
+    )
+
+
+def access_log_serializer():
+    """A function rendering one row from ``access_log_rows`` as a dict"""
+    to_representation = datetime_formatter()
+
+    def serialize(row):
+        data = dict(zip(ACCESS_LOG_COLUMNS, _read_access_log(row)))
+        data['timestamp'] = to_representation(data['timestamp'])
+        data['last_seen'] = to_representation(data['last_seen'])
+        data['ip_address'] = compact.unpack_ip(data['ip_address'])
+        return data
+    return serialize
+
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from identity import retention, segments
+
+
+class Command(BaseCommand):
+    help = 'Move old access logs into compressed columnar segment files (query them with query_access_log_archive)'
+
+    def add_arguments(self, parser):
+        options = retention.get_options()
+        parser.add_argument(
+            '--older-than-days', type=int, default=options['COLD_AFTER_DAYS'],
+            help='Archive rows whose access is at least this many days old'
+        )
+        parser.add_argument('--dir', default=options['SEGMENT_DIR'], help='Segment directory')
+        parser.add_argument(
+            '--segment-rows', type=int, default=options['SEGMENT_ROWS'], help='Rows per segment file'
+        )
+        parser.add_argument('--codec', choices=sorted(segments.CODECS), default=options['SEGMENT_CODEC'])
+        parser.add_argument('--batch-size', type=int, default=options['BATCH_SIZE'], help='Rows per read and delete')
+        parser.add_argument(
+            '--pause', type=float, default=options['PAUSE'], help='Seconds to sleep between delete batches'
+        )
+
+    def handle(self, *args, **options):
+        if not options['dir']:
+            raise CommandError('No segment directory: pass --dir or set AUDIT_SEGMENT_DIR')
+        if options['older_than_days'] < 0:
+            raise CommandError('--older-than-days must not be negative')
+
+        def progress(path, rows, size):
+            self.stdout.write(f'{path}: {rows} rows, {size} bytes')
+
+        moved = segments.archive(
+            options['older_than_days'], options['dir'], options['segment_rows'], options['codec'],
+            options['batch_size'], options['pause'], progress,
+        )
+        self.stdout.write(self.style.SUCCESS(f"Archived {moved} access logs to {options['dir']}"))
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from identity import rollups
+
+
+class Command(BaseCommand):
+    help = (
+        'Fill the daily access rollups: recount the per-context days from the hourly rollups '
+        '(which outlive pruned logs) and the per-accessor days from the access logs still kept'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=rollups.BATCH_SIZE, help='Rows per transaction')
+        parser.add_argument(
+            '--skip-accessors', action='store_true',
+            help='Leave the per-accessor rollup as it is (it can only be rebuilt from the kept access logs)'
+        )
+
+    def handle(self, *args, **options):
+        # The daily rollup is derived from the hourly one, so bring that up to date first
+        rollups.roll_up(options['batch_size'], names=[rollups.HOURLY.name])
+        written = rollups.rebuild_daily(options['batch_size'])
+        self.stdout.write(f'Rebuilt {written} daily per-context rollups')
+        if not options['skip_accessors']:
+            rolled = rollups.rebuild_accessors(options['batch_size'])
+            self.stdout.write(f'Rebuilt the per-accessor rollups from {rolled} access logs')
+        self.stdout.write(self.style.SUCCESS(f'Daily rollups at id {rollups.checkpoint()}'))
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from identity.benchmarks import BENCHMARKS
+
+
+class Command(BaseCommand):
+    help = 'Run performance benchmarks against throwaway data (rolled back afterwards)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenarios', nargs='*', help='Scenarios to run (default: all)')
+        parser.add_argument('--rows', type=int, default=1000, help='Number of rows to seed')
+        parser.add_argument('--repeat', type=int, default=200, help='Iterations per measurement')
+
+    def handle(self, *args, **options):
+        names = options['scenarios'] or sorted(BENCHMARKS)
+        unknown = [name for name in names if name not in BENCHMARKS]
+        if unknown:
+            raise CommandError(
+                f"Unknown scenario(s): {', '.join(unknown)}. Available: {', '.join(sorted(BENCHMARKS))}"
+            )
+
+        for name in names:
+            self.stdout.write(self.style.MIGRATE_HEADING(f'{name} (rows={options["rows"]})'))
+            with transaction.atomic():
+                BENCHMARKS[name](options['rows'], options['repeat'], self.stdout.write)
+                transaction.set_rollback(True)
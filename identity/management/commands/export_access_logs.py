@@ -0,0 +1,54 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from identity import exports
+
+
+class Command(BaseCommand):
+    help = 'Export access logs as CSV or NDJSON in keyset order, in constant memory'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', help='Only rows at or after this ISO 8601 datetime')
+        parser.add_argument('--until', help='Only rows before this ISO 8601 datetime')
+        parser.add_argument('--identity', help='Only accesses to this identity id')
+        parser.add_argument('--accessed-by', dest='accessed_by', help='Only accesses by this user id')
+        parser.add_argument('--context', help='Only accesses in this context')
+        parser.add_argument('--format', choices=sorted(exports.FORMATS), default='ndjson')
+        parser.add_argument('--gzip', action='store_true', help='gzip the output (implied by a .gz --output)')
+        parser.add_argument('--output', '-o', help='File to write (default: stdout)')
+        parser.add_argument(
+            '--after', type=int,
+            help='Resume an interrupted export after the row with this id (the last complete row written)'
+        )
+        parser.add_argument('--batch-size', type=int, default=exports.BATCH_SIZE, help='Rows read per query')
+
+    def handle(self, *args, **options):
+        compress = options['gzip'] or (options['output'] or '').endswith('.gz')
+        try:
+            lookups = exports.parse_filters(options)
+            position = exports.resume_position(options['after']) if options['after'] else None
+        except exports.InvalidExport as e:
+            raise CommandError(str(e))
+
+        def progress(rows, last_id):
+            if options['verbosity'] >= 1:
+                self.stderr.write(f'{rows} rows exported, last id {last_id}')
+
+        chunks = exports.render(
+            exports.batches(lookups, position, options['batch_size']),
+            options['format'], compress, progress=progress,
+        )
+        if options['output']:
+            text = {} if compress else {'encoding': 'utf-8', 'newline': ''}
+            with open(options['output'], 'wb' if compress else 'w', **text) as out:
+                for chunk in chunks:
+                    out.write(chunk)
+            self.stderr.write(self.style.SUCCESS(f"Export written to {options['output']}"))
+        elif compress:
+            for chunk in chunks:
+                sys.stdout.buffer.write(chunk)
+            sys.stdout.buffer.flush()
+        else:
+            for chunk in chunks:
+                self.stdout.write(chunk, ending='')
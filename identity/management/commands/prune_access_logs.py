@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from identity import retention
+
+
+class Command(BaseCommand):
+    help = 'Delete (optionally archiving first) monthly access-log buckets past the retention period'
+
+    def add_arguments(self, parser):
+        options = retention.get_options()
+        parser.add_argument(
+            '--keep-months', type=int, default=options['KEEP_MONTHS'],
+            help='Whole months of raw access logs to keep besides the current one'
+        )
+        parser.add_argument(
+            '--archive-dir', default=options['ARCHIVE_DIR'],
+            help='Write each bucket here as gzipped NDJSON before deleting it'
+        )
+        parser.add_argument('--batch-size', type=int, default=options['BATCH_SIZE'], help='Rows per delete')
+        parser.add_argument(
+            '--pause', type=float, default=options['PAUSE'], help='Seconds to sleep between delete batches'
+        )
+        parser.add_argument('--dry-run', action='store_true', help='List the expired buckets without touching them')
+
+    def handle(self, *args, **options):
+        if options['keep_months'] < 0:
+            raise CommandError('--keep-months must not be negative')
+
+        before = retention.cutoff(options['keep_months'])
+        if options['dry_run']:
+            counts = retention.rolled_up_counts(before)
+            for month in retention.expired_buckets(before):
+                self.stdout.write(f'{month:%Y-%m}: about {counts.get(month, 0)} rows would be pruned')
+            return
+
+        def progress(month, deleted, path):
+            archived = f', archived to {path}' if path else ''
+            self.stdout.write(f'{month:%Y-%m}: deleted {deleted} rows{archived}')
+
+        deleted = retention.prune(
+            options['keep_months'], options['archive_dir'], options['batch_size'], options['pause'], progress,
+        )
+        self.stdout.write(self.style.SUCCESS(f'Pruned {deleted} access logs older than {before:%Y-%m-%d}'))
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from identity import exports, retention, segments
+
+
+class Command(BaseCommand):
+    help = 'Read archived access logs from the columnar segments as CSV or NDJSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir', default=retention.get_options()['SEGMENT_DIR'], help='Segment directory')
+        parser.add_argument('--since', help='Only rows at or after this ISO 8601 datetime')
+        parser.add_argument('--until', help='Only rows before this ISO 8601 datetime')
+        parser.add_argument('--identity', help='Only accesses to this identity id')
+        parser.add_argument('--accessed-by', dest='accessed_by', help='Only accesses by this user id')
+        parser.add_argument('--context', help='Only accesses in this context')
+        parser.add_argument('--format', choices=sorted(exports.FORMATS), default='ndjson')
+        parser.add_argument('--output', '-o', help='File to write (default: stdout)')
+        parser.add_argument('--list', action='store_true', help='List the segments and their ranges instead')
+
+    def handle(self, *args, **options):
+        if not options['dir']:
+            raise CommandError('No segment directory: pass --dir or set AUDIT_SEGMENT_DIR')
+        if options['list']:
+            return self.list_segments(options['dir'])
+        try:
+            lookups = exports.parse_filters(options)
+        except exports.InvalidExport as e:
+            raise CommandError(str(e))
+
+        chunks = exports.render(segments.query(lookups, options['dir']), options['format'], compress=False)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8', newline='') as out:
+                for chunk in chunks:
+                    out.write(chunk)
+        else:
+            for chunk in chunks:
+                self.stdout.write(chunk, ending='')
+
+    def list_segments(self, directory):
+        for path, footer in segments.footers(directory):
+            self.stdout.write(
+                f"{path}: {footer['rows']} rows, ids {footer['min_id']}-{footer['max_id']}, "
+                f"{segments.from_micros(footer['min_timestamp']):%Y-%m-%d %H:%M} to "
+                f"{segments.from_micros(footer['max_timestamp']):%Y-%m-%d %H:%M}, "
+                f"identities {footer['min_identity_id']}-{footer['max_identity_id']}, {footer['codec']}"
+            )
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from identity import search
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the trigram search index used by the admin identity and user search'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--kind', choices=sorted(search.SEARCH_FIELDS), action='append',
+            help='Only rebuild this kind (may be repeated; default: all)'
+        )
+        parser.add_argument('--batch-size', type=int, default=2000, help='Rows per bulk insert')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            counts = search.rebuild(options['kind'], batch_size=options['batch_size'])
+
+        for kind, count in counts.items():
+            self.stdout.write(f'{kind}: {count} trigram rows')
+        self.stdout.write(self.style.SUCCESS('Search index rebuilt'))
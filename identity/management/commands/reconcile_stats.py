@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from identity import stats
+
+
+class Command(BaseCommand):
+    help = 'Recount the dashboard statistics and repair any counters that have drifted'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Report drift without changing the stored counters'
+        )
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            if options['dry_run']:
+                stored = stats.get_counters()
+                drift = {
+                    name: (stored[name], value)
+                    for name, value in stats.actual_counts().items()
+                    if stored[name] != value
+                }
+            else:
+                drift = stats.reconcile()
+
+        for name, (stored, actual) in drift.items():
+            self.stdout.write(f'{name}: stored {stored}, actual {actual}')
+
+        if not drift:
+            self.stdout.write(self.style.SUCCESS('All counters are accurate'))
+        elif options['dry_run']:
+            self.stdout.write(self.style.WARNING(f'{len(drift)} counter(s) have drifted'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'Repaired {len(drift)} counter(s)'))
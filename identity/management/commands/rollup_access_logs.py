@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from identity import rollups
+
+
+class Command(BaseCommand):
+    help = 'Fold new access logs into the hourly and daily access rollups (safe to run from cron)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=rollups.BATCH_SIZE, help='Access logs per transaction')
+        parser.add_argument(
+            '--max-batches', type=int, help='Stop after this many batches per rollup (default: until caught up)'
+        )
+        parser.add_argument(
+            '--rollup', action='append', choices=sorted(rollups.ROLLUPS), dest='names',
+            help='Only this rollup (repeatable; default: all)'
+        )
+
+    def handle(self, *args, **options):
+        rolled = rollups.roll_up(options['batch_size'], options['max_batches'], options['names'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Rolled up {rolled} access logs (checkpoint at id {rollups.checkpoint()})'
+        ))
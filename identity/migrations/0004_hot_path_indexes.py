@@ -0,0 +1,33 @@
+# Generated by Django 4.2.7 on 2026-10-17 07:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('identity', '0003_accesslog_timestamp_default'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='accesslog',
+            index=models.Index(fields=['-timestamp'], name='accesslog_timestamp_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='identity',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['user', 'context'], name='identity_user_ctx_active_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='identity',
+            index=models.Index(condition=models.Q(('is_active', True), ('is_primary', True)), fields=['user'], name='identity_user_primary_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='identity',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['user', 'visibility'], name='identity_user_vis_active_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='identity',
+            index=models.Index(fields=['-created_at', '-id'], name='identity_created_idx'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+from django.conf import settings
+from django.db import migrations, models
+
+# auth.User belongs to another app, so the index is managed by hand here
+USER_DATE_JOINED_INDEX = models.Index(fields=['-date_joined', '-id'], name='user_date_joined_idx')
+
+
+def add_index(apps, schema_editor):
+    User = apps.get_model(settings.AUTH_USER_MODEL)
+    schema_editor.add_index(User, USER_DATE_JOINED_INDEX)
+
+
+def remove_index(apps, schema_editor):
+    User = apps.get_model(settings.AUTH_USER_MODEL)
+    schema_editor.remove_index(User, USER_DATE_JOINED_INDEX)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('identity', '0004_hot_path_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(add_index, remove_index),
+    ]
@@ -0,0 +1,61 @@
+# Generated by Django 4.2.7 on 2026-10-17 07:10
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def build_index(apps, schema_editor):
+    from identity.search import trigrams
+
+    Identity = apps.get_model('identity', 'Identity')
+    User = apps.get_model(settings.AUTH_USER_MODEL)
+    SearchTrigram = apps.get_model('identity', 'SearchTrigram')
+
+    def rows(kind, obj, values):
+        grams = set()
+        for value in values:
+            if value:
+                grams |= trigrams(value)
+        return [SearchTrigram(kind=kind, object_id=obj.pk, trigram=gram) for gram in grams]
+
+    documents = (
+        ('user', user, [user.username, user.email, user.first_name, user.last_name])
+        for user in User.objects.iterator(chunk_size=2000)
+    ), (
+        ('identity', identity, [identity.given_name, identity.family_name, identity.email, identity.user.username])
+        for identity in Identity.objects.select_related('user').iterator(chunk_size=2000)
+    )
+
+    batch = []
+    for source in documents:
+        for kind, obj, values in source:
+            batch += rows(kind, obj, values)
+            if len(batch) >= 2000:
+                SearchTrigram.objects.bulk_create(batch)
+                batch = []
+    SearchTrigram.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('identity', '0005_user_date_joined_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchTrigram',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('identity', 'Identity'), ('user', 'User')], max_length=10)),
+                ('object_id', models.BigIntegerField()),
+                ('trigram', models.CharField(max_length=3)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['kind', 'object_id'], name='searchtrigram_object_idx')],
+                'unique_together': {('kind', 'trigram', 'object_id')},
+            },
+        ),
+        migrations.RunPython(build_index, migrations.RunPython.noop),
+    ]
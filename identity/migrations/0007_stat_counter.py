@@ -0,0 +1,38 @@
+# Generated by Django 4.2.7 on 2026-10-17 07:32
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def seed_counters(apps, schema_editor):
+    User = apps.get_model(settings.AUTH_USER_MODEL)
+    Identity = apps.get_model('identity', 'Identity')
+    AccessLog = apps.get_model('identity', 'AccessLog')
+    StatCounter = apps.get_model('identity', 'StatCounter')
+
+    StatCounter.objects.bulk_create([
+        StatCounter(name='users', value=User.objects.count()),
+        StatCounter(name='identities', value=Identity.objects.count()),
+        StatCounter(name='unverified_identities', value=Identity.objects.filter(is_verified=False).count()),
+        StatCounter(name='access_logs', value=AccessLog.objects.count()),
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('identity', '0006_search_trigram'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StatCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(choices=[('users', 'Users'), ('identities', 'Identities'), ('unverified_identities', 'Unverified identities'), ('access_logs', 'API calls')], max_length=50, unique=True)),
+                ('value', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(seed_counters, migrations.RunPython.noop),
+    ]
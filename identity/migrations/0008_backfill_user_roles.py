@@ -0,0 +1,28 @@
+# Generated by Django 4.2.7 on 2026-10-17 08:05
+
+from django.conf import settings
+from django.db import migrations
+
+
+def create_missing_roles(apps, schema_editor):
+    # User saves no longer create a missing UserRole on the fly, so give every
+    # existing user one now
+    User = apps.get_model(settings.AUTH_USER_MODEL)
+    UserRole = apps.get_model('identity', 'UserRole')
+
+    UserRole.objects.bulk_create(
+        UserRole(user_id=user.pk, role='admin' if user.is_superuser else 'user')
+        for user in User.objects.filter(profile__isnull=True).only('pk', 'is_superuser').iterator()
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('identity', '0007_stat_counter'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_missing_roles, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 4.2.7 on 2026-10-17 08:29
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('identity', '0008_backfill_user_roles'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RollupCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('last_id', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='AccessLogRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('access_context', models.CharField(max_length=20)),
+                ('hour', models.DateTimeField()),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('identity', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='access_rollups', to='identity.identity')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['hour'], name='accesslogrollup_hour_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='accesslogrollup',
+            constraint=models.UniqueConstraint(fields=('identity', 'access_context', 'hour'), name='accesslogrollup_bucket_uniq'),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 4.2.7 on 2026-10-17 09:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('identity', '0009_access_log_rollups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserAgent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.CharField(max_length=64, unique=True)),
+                ('value', models.TextField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='accesslog',
+            name='agent',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='identity.useragent'),
+        ),
+        migrations.AddField(
+            model_name='accesslog',
+            name='ip',
+            field=models.BinaryField(default=b'', max_length=16),
+        ),
+        # Nullable until they are dropped, so the removal can be reversed
+        migrations.AlterField(
+            model_name='accesslog',
+            name='ip_address',
+            field=models.GenericIPAddressField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='accesslog',
+            name='user_agent',
+            field=models.TextField(null=True),
+        ),
+    ]
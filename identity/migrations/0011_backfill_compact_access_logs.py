@@ -0,0 +1,73 @@
+# Generated by Django 4.2.7 on 2026-10-17 09:12
+
+import hashlib
+import ipaddress
+
+from django.db import migrations
+
+BATCH_SIZE = 5000
+
+
+def _batches(queryset, *fields):
+    """``queryset`` rows as lists of ``fields`` tuples, in primary key order"""
+    last = 0
+    while True:
+        batch = list(queryset.filter(pk__gt=last).order_by('pk').values_list('pk', *fields)[:BATCH_SIZE])
+        if not batch:
+            return
+        yield batch
+        last = batch[-1][0]
+
+
+def _pack_ip(value):
+    try:
+        return ipaddress.ip_address((value or '').strip()).packed
+    except ValueError:
+        return b''
+
+
+def compact_access_logs(apps, schema_editor):
+    AccessLog = apps.get_model('identity', 'AccessLog')
+    UserAgent = apps.get_model('identity', 'UserAgent')
+
+    agents = {}
+    for batch in _batches(AccessLog.objects.all(), 'user_agent', 'ip_address'):
+        new = {value or '' for _, value, _ in batch} - agents.keys()
+        if new:
+            by_digest = {hashlib.sha256(value.encode('utf-8')).hexdigest(): value for value in new}
+            UserAgent.objects.bulk_create(
+                [UserAgent(digest=key, value=value) for key, value in by_digest.items()], ignore_conflicts=True
+            )
+            for key, agent_id in UserAgent.objects.filter(digest__in=list(by_digest)).values_list('digest', 'id'):
+                agents[by_digest[key]] = agent_id
+        AccessLog.objects.bulk_update(
+            [AccessLog(pk=pk, agent_id=agents[value or ''], ip=_pack_ip(ip)) for pk, value, ip in batch],
+            ['agent', 'ip'],
+        )
+
+
+def expand_access_logs(apps, schema_editor):
+    AccessLog = apps.get_model('identity', 'AccessLog')
+    agents = dict(apps.get_model('identity', 'UserAgent').objects.values_list('id', 'value'))
+
+    for batch in _batches(AccessLog.objects.all(), 'agent_id', 'ip'):
+        AccessLog.objects.bulk_update(
+            [
+                # Addresses that could not be parsed come back as the unspecified address
+                AccessLog(pk=pk, user_agent=agents.get(agent_id, ''),
+                          ip_address=str(ipaddress.ip_address(bytes(ip))) if ip else '0.0.0.0')
+                for pk, agent_id, ip in batch
+            ],
+            ['user_agent', 'ip_address'],
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('identity', '0010_compact_access_logs'),
+    ]
+
+    operations = [
+        migrations.RunPython(compact_access_logs, expand_access_logs),
+    ]
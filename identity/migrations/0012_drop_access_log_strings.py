@@ -0,0 +1,27 @@
+# Generated by Django 4.2.7 on 2026-10-17 09:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('identity', '0011_backfill_compact_access_logs'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='accesslog',
+            name='ip_address',
+        ),
+        migrations.RemoveField(
+            model_name='accesslog',
+            name='user_agent',
+        ),
+        migrations.AlterField(
+            model_name='accesslog',
+            name='agent',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='identity.useragent'),
+        ),
+    ]
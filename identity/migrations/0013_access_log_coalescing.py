@@ -0,0 +1,30 @@
+# Generated by Django 4.2.7 on 2026-10-17 10:04
+
+from django.db import migrations, models
+
+
+def copy_timestamps(apps, schema_editor):
+    # Every existing row is a single access
+    AccessLog = apps.get_model('identity', 'AccessLog')
+    AccessLog.objects.update(last_seen=models.F('timestamp'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('identity', '0012_drop_access_log_strings'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='accesslog',
+            name='hit_count',
+            field=models.PositiveIntegerField(default=1, editable=False),
+        ),
+        migrations.AddField(
+            model_name='accesslog',
+            name='last_seen',
+            field=models.DateTimeField(editable=False, null=True),
+        ),
+        migrations.RunPython(copy_timestamps, migrations.RunPython.noop),
+    ]
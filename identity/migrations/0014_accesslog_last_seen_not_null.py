@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-17 10:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('identity', '0013_access_log_coalescing'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='accesslog',
+            name='last_seen',
+            field=models.DateTimeField(editable=False),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 4.2.7 on 2026-10-17 09:05
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('identity', '0014_accesslog_last_seen_not_null'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AccessLogDailyRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('access_context', models.CharField(max_length=20)),
+                ('day', models.DateField()),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('identity', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_access_rollups', to='identity.identity')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='AccessorDailyRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('accessed_by', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('identity', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='accessor_rollups', to='identity.identity')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['accessed_by', 'day'], name='accessordailyrollup_user_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='accessordailyrollup',
+            constraint=models.UniqueConstraint(fields=('identity', 'accessed_by', 'day'), name='accessordailyrollup_uniq'),
+        ),
+        migrations.AddIndex(
+            model_name='accesslogdailyrollup',
+            index=models.Index(fields=['day'], name='accesslogdailyrollup_day_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='accesslogdailyrollup',
+            constraint=models.UniqueConstraint(fields=('identity', 'access_context', 'day'), name='accesslogdailyrollup_uniq'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 4.2.7 on 2026-10-17 09:17
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def demote_extra_primaries(apps, schema_editor):
+    """
+    Keep one primary per user before the constraint goes on: the active
+    one set most recently, which is what the last set-primary call meant
+    """
+    Identity = apps.get_model('identity', 'Identity')
+    users = (
+        Identity.objects.filter(is_primary=True).values('user_id')
+        .annotate(n=Count('id')).filter(n__gt=1).values_list('user_id', flat=True)
+    )
+    for user_id in users.iterator():
+        primaries = Identity.objects.filter(user_id=user_id, is_primary=True)
+        keep = primaries.order_by('-is_active', '-updated_at', '-id').values_list('id', flat=True)[0]
+        primaries.exclude(id=keep).update(is_primary=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('identity', '0015_daily_access_rollups'),
+    ]
+
+    operations = [
+        migrations.RunPython(demote_extra_primaries, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='identity',
+            name='identity_user_primary_idx',
+        ),
+        migrations.AddConstraint(
+            model_name='identity',
+            constraint=models.UniqueConstraint(condition=models.Q(('is_primary', True)), fields=('user',), name='identity_one_primary_per_user', violation_error_message='A user can have only one primary identity.'),
+        ),
+    ]
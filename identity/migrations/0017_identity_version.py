@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-17 09:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('identity', '0016_one_primary_identity'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='identity',
+            name='version',
+            field=models.PositiveIntegerField(default=1, editable=False),
+        ),
+    ]
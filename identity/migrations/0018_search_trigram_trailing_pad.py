@@ -0,0 +1,44 @@
+# Generated by Django 4.2.7 on 2026-10-17 11:02
+
+from django.conf import settings
+from django.db import migrations
+
+
+def add_last_character_grams(apps, schema_editor):
+    """
+    Fields are now padded with two trailing spaces, which adds one trigram
+    per value: its last character followed by the pad
+    """
+    Identity = apps.get_model('identity', 'Identity')
+    User = apps.get_model(settings.AUTH_USER_MODEL)
+    SearchTrigram = apps.get_model('identity', 'SearchTrigram')
+
+    documents = (
+        ('user', user.pk, [user.username, user.email, user.first_name, user.last_name])
+        for user in User.objects.iterator(chunk_size=2000)
+    ), (
+        ('identity', identity.pk, [identity.given_name, identity.family_name, identity.email, identity.user.username])
+        for identity in Identity.objects.select_related('user').iterator(chunk_size=2000)
+    )
+
+    batch = []
+    for source in documents:
+        for kind, object_id, values in source:
+            grams = {f'{value.lower()[-1]}  ' for value in values if value}
+            batch += [SearchTrigram(kind=kind, object_id=object_id, trigram=gram) for gram in grams]
+            if len(batch) >= 2000:
+                SearchTrigram.objects.bulk_create(batch, ignore_conflicts=True)
+                batch = []
+    SearchTrigram.objects.bulk_create(batch, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('identity', '0017_identity_version'),
+    ]
+
+    operations = [
+        migrations.RunPython(add_last_character_grams, migrations.RunPython.noop),
+    ]
@@ -1,7 +1,48 @@
-from django.db import models
+from django.db import connections, models, transaction
+from django.db.models import F
 from django.contrib.auth.models import User
 from django.core.validators import RegexValidator
+from django.utils import timezone
+import copy
 import json
+from . import projection
+
+
+class VersionConflict(Exception):
+    """A save found the row at a different version than the one it was read at"""
+
+
+class IdentityManager(models.Manager):
+    def set_primary(self, user_id, identity_id):
+        """
+        Make ``identity_id`` the only primary identity of ``user_id``; returns
+        False, changing nothing, when the user has no such identity.
+
+        The current primary is cleared before the new one is set: unique
+        indexes are checked row by row, so doing both in one UPDATE fails
+        whenever the new primary happens to be written first. Switches for
+        one user are serialized on the user row (SQLite serializes every
+        writer anyway), so concurrent calls leave exactly one primary.
+        """
+        now = timezone.now()
+        with transaction.atomic(using=self.db):
+            if connections[self.db].features.has_select_for_update:
+                list(User.objects.db_manager(self.db).select_for_update().filter(pk=user_id).values_list('pk'))
+            self.filter(user_id=user_id, is_primary=True).exclude(pk=identity_id).update(
+                is_primary=False, updated_at=now, version=F('version') + 1
+            )
+            if not self.filter(pk=identity_id, user_id=user_id).update(
+                is_primary=True, updated_at=now, version=F('version') + 1
+            ):
+                transaction.set_rollback(True, using=self.db)
+                return False
+
+        # update() sends no post_save, so invalidate like signals.py does.
+        # cache imports resolution, which imports this module.
+        from .cache import identity_cache
+        identity_cache.invalidate_user(user_id)
+        transaction.on_commit(lambda: identity_cache.invalidate_user(user_id), using=self.db)
+        return True
 
 
 class Identity(models.Model):
@@ -61,6 +102,8 @@ class Identity(models.Model):
     # Timestamps
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # Bumped by every write; a save only applies to the version it was read at
+    version = models.PositiveIntegerField(default=1, editable=False)
 
     # Admin-only fields
     admin_notes = models.TextField(blank=True, help_text="Admin-only notes")
@@ -74,85 +117,130 @@ class Identity(models.Model):
         related_name='verified_identities'
     )
 
+    objects = IdentityManager()
+
     class Meta:
         unique_together = ['user', 'context', 'locale']
         ordering = ['-is_primary', 'context', 'created_at']
+        constraints = [
+            # Also serves the primary fallback lookup
+            models.UniqueConstraint(
+                fields=['user'], condition=models.Q(is_primary=True), name='identity_one_primary_per_user',
+                violation_error_message='A user can have only one primary identity.',
+            ),
+        ]
+        indexes = [
+            # Contextual resolution and per-user listings only read active rows
+            models.Index(
+                fields=['user', 'context'], condition=models.Q(is_active=True),
+                name='identity_user_ctx_active_idx',
+            ),
+            models.Index(
+                fields=['user', 'visibility'], condition=models.Q(is_active=True),
+                name='identity_user_vis_active_idx',
+            ),
+            # Admin listings, newest first
+            models.Index(fields=['-created_at', '-id'], name='identity_created_idx'),
+        ]
+
+    # Column values as read from the database, None for unsaved instances;
+    # see changed_fields()
+    _loaded_values = None
 
     def __str__(self):
         return f"{self.get_full_name()} ({self.context})"
 
-    def get_full_name(self):
-        """Return the full name based on context preferences"""
-        if self.display_name:
-            return self.display_name
-
-        parts = []
-        if self.title:
-            parts.append(self.title)
-
-        if self.preferred_name and self.context in ['social', 'display']:
-            parts.append(self.preferred_name)
-        else:
-            parts.append(self.given_name)
-
-        if self.middle_name and self.context == 'legal':
-            parts.append(self.middle_name)
-
-        parts.append(self.family_name)
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = instance._snapshot()
+        return instance
+
+    def _snapshot(self, names=None):
+        # Read from __dict__ so deferred fields are never loaded; JSON is
+        # copied so changes made in place are still noticed
+        values = self.__dict__
+        names = [field.attname for field in self._meta.concrete_fields] if names is None else names
+        return {
+            name: copy.deepcopy(values[name]) if isinstance(values[name], (dict, list)) else values[name]
+            for name in names if name in values
+        }
 
-        if self.suffix:
-            parts.append(self.suffix)
+    def changed_fields(self):
+        """Names of the columns assigned a different value since they were read"""
+        loaded = self._loaded_values or {}
+        values = self.__dict__
+        return [
+            field.attname for field in self._meta.concrete_fields
+            if not field.primary_key and field.attname in values
+            and (field.attname not in loaded or loaded[field.attname] != values[field.attname])
+        ]
+
+    def save(self, *args, update_fields=None, **kwargs):
+        """
+        Save an identity read from the database with ``update_fields`` set to
+        the changed columns (or those given) plus ``updated_at`` and
+        ``version``, in an UPDATE that only matches the version it was read
+        at. Raises ``VersionConflict`` when another write got there first,
+        which like an IntegrityError leaves the enclosing atomic block
+        unusable; saving with nothing changed writes nothing.
+        """
+        if self._loaded_values is None or self._state.adding:
+            super().save(*args, update_fields=update_fields, **kwargs)
+            self._loaded_values = self._snapshot()
+            return
+
+        fields = set(self.changed_fields() if update_fields is None else update_fields)
+        fields.discard('version')
+        if not fields:
+            return
+        fields.update(('updated_at', 'version'))
+
+        read_version = self.version
+        self.version = read_version + 1
+        self._read_version = read_version
+        try:
+            super().save(*args, update_fields=fields, **kwargs)
+        except Exception:
+            self.version = read_version
+            raise
+        finally:
+            del self._read_version
+        self._loaded_values.update(self._snapshot(
+            [self._meta.get_field(name).attname for name in fields]
+        ))
+
+    def _do_update(self, base_qs, using, pk_val, values, update_fields, forced_update):
+        read_version = getattr(self, '_read_version', None)
+        if read_version is None:
+            return super()._do_update(base_qs, using, pk_val, values, update_fields, forced_update)
+        updated = super()._do_update(
+            base_qs.filter(version=read_version), using, pk_val, values, update_fields, forced_update
+        )
+        if not updated and base_qs.filter(pk=pk_val).exists():
+            raise VersionConflict(f'Identity {pk_val} is no longer at version {read_version}')
+        return updated
+
+    def refresh_from_db(self, using=None, fields=None):
+        super().refresh_from_db(using, fields)
+        if self._loaded_values is not None:
+            self._loaded_values.update(self._snapshot(
+                None if fields is None else [self._meta.get_field(name).attname for name in fields]
+            ))
 
-        return ' '.join(parts)
+    def get_full_name(self):
+        """Return the full name based on context preferences"""
+        return projection.compose_full_name(
+            self.context, self.display_name, self.title, self.preferred_name,
+            self.given_name, self.middle_name, self.family_name, self.suffix,
+        )
 
     def get_contextual_data(self, requesting_user=None, requested_fields=None):
-        """Return data appropriate for the context and requesting user"""
-        data = {
-            'id': self.id,
-            'context': self.context,
-            'locale': self.locale,
-            'full_name': self.get_full_name(),
-            'visibility': self.visibility,
-        }
-
-        # Determine what fields to include based on context
-        if self.context == 'legal':
-            data.update({
-                'given_name': self.given_name,
-                'family_name': self.family_name,
-                'middle_name': self.middle_name,
-                'title': self.title,
-                'suffix': self.suffix,
-            })
-        elif self.context == 'social':
-            data.update({
-                'preferred_name': self.preferred_name or self.given_name,
-                'nickname': self.nickname,
-                'pronouns': self.pronouns,
-                'avatar_url': self.avatar_url,
-                'bio': self.bio,
-            })
-        elif self.context == 'professional':
-            data.update({
-                'given_name': self.given_name,
-                'family_name': self.family_name,
-                'title': self.title,
-                'email': self.email,
-                'website': self.website,
-                'bio': self.bio,
-            })
-        elif self.context == 'display':
-            data.update({
-                'display_name': self.display_name or self.get_full_name(),
-                'pronouns': self.pronouns,
-                'avatar_url': self.avatar_url,
-            })
-
-        # Add custom attributes if they exist
-        if self.custom_attributes:
-            data['custom_attributes'] = self.custom_attributes
-
-        return data
+        """
+        Return data appropriate for the context and requesting user, limited
+        to ``requested_fields`` (within the context's projection) if given
+        """
+        return projection.project(self, requested_fields)
 
 
 class FieldPermission(models.Model):
@@ -195,19 +283,166 @@ class ContextPriority(models.Model):
         ordering = ['priority']
 
 
+class UserAgent(models.Model):
+    """A distinct user agent string, referenced by AccessLog rows (see compact.py)"""
+    digest = models.CharField(max_length=64, unique=True)
+    value = models.TextField()
+
+    def __str__(self):
+        return self.value
+
+
+class AccessLogManager(models.Manager):
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        AccessLog.prepare_rows(objs)
+        return super().bulk_create(objs, *args, **kwargs)
+
+
 class AccessLog(models.Model):
-    """Audit trail for identity access"""
+    """
+    Audit trail for identity access. The user agent is interned and the IP
+    packed; ``user_agent`` and ``ip_address`` read and write them as strings
+    and are accepted as constructor arguments.
+    """
     identity = models.ForeignKey(Identity, on_delete=models.CASCADE, related_name='access_logs')
     accessed_by = models.ForeignKey(User, on_delete=models.CASCADE)
     accessed_fields = models.JSONField(default=list)
     access_context = models.CharField(max_length=20)
-    ip_address = models.GenericIPAddressField()
-    user_agent = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Interned agents are never deleted, so the reverse lookup needs no index
+    agent = models.ForeignKey(UserAgent, on_delete=models.PROTECT, related_name='+', db_index=False)
+    # 4 bytes for IPv4, 16 for IPv6, empty when the address was not valid
+    ip = models.BinaryField(max_length=16, default=b'')
+    # Set when the access happens, not when the buffered writer flushes it.
+    # A row can stand for ``hit_count`` identical accesses (see audit.py's
+    # coalescing): ``timestamp`` is the first of them, ``last_seen`` the last.
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
+    last_seen = models.DateTimeField(editable=False)
+    hit_count = models.PositiveIntegerField(default=1, editable=False)
+
+    objects = AccessLogManager()
+
+    # Set through ``user_agent``, interned when the row is saved
+    _pending_user_agent = None
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['-timestamp'], name='accesslog_timestamp_idx'),
+        ]
 
     def __str__(self):
         return f"{self.accessed_by} accessed {self.identity} at {self.timestamp}"
 
+    @property
+    def user_agent(self):
+        if self._pending_user_agent is not None:
+            return self._pending_user_agent
+        return self.agent.value if self.agent_id else ''
+
+    @user_agent.setter
+    def user_agent(self, value):
+        self._pending_user_agent = value or ''
+
+    @property
+    def ip_address(self):
+        from .compact import unpack_ip
+        return unpack_ip(self.ip)
+
+    @ip_address.setter
+    def ip_address(self, value):
+        from .compact import pack_ip
+        self.ip = pack_ip(value)
+
+    @staticmethod
+    def prepare_rows(logs):
+        """
+        Fill in what ``logs`` need before they are written: ``last_seen``
+        defaults to ``timestamp`` and pending user agents are interned
+        """
+        from .compact import user_agents
+
+        for log in logs:
+            if log.last_seen is None:
+                log.last_seen = log.timestamp
+        pending = [log for log in logs if log._pending_user_agent is not None or log.agent_id is None]
+        if not pending:
+            return
+        ids = user_agents.intern_many(log.user_agent for log in pending)
+        for log in pending:
+            log.agent_id = ids[log.user_agent]
+
+    def save(self, *args, **kwargs):
+        self.prepare_rows([self])
+        super().save(*args, **kwargs)
+
+
+class AccessLogRollup(models.Model):
+    """Access counts per identity, context and hour, rolled up from AccessLog"""
+    identity = models.ForeignKey(Identity, on_delete=models.CASCADE, related_name='access_rollups')
+    access_context = models.CharField(max_length=20)
+    hour = models.DateTimeField()
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['identity', 'access_context', 'hour'], name='accesslogrollup_bucket_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['hour'], name='accesslogrollup_hour_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.identity_id}/{self.access_context} @ {self.hour}: {self.count}"
+
+
+class AccessLogDailyRollup(models.Model):
+    """Access counts per identity, context and day, rolled up from AccessLog"""
+    identity = models.ForeignKey(Identity, on_delete=models.CASCADE, related_name='daily_access_rollups')
+    access_context = models.CharField(max_length=20)
+    day = models.DateField()
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['identity', 'access_context', 'day'], name='accesslogdailyrollup_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['day'], name='accesslogdailyrollup_day_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.identity_id}/{self.access_context} on {self.day}: {self.count}"
+
+
+class AccessorDailyRollup(models.Model):
+    """Access counts per identity, accessing user and day, rolled up from AccessLog"""
+    identity = models.ForeignKey(Identity, on_delete=models.CASCADE, related_name='accessor_rollups')
+    # Covered by the (accessed_by, day) index
+    accessed_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+', db_index=False)
+    day = models.DateField()
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['identity', 'accessed_by', 'day'], name='accessordailyrollup_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['accessed_by', 'day'], name='accessordailyrollup_user_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.accessed_by_id} -> {self.identity_id} on {self.day}: {self.count}"
+
+
+class RollupCheckpoint(models.Model):
+    """How far a rollup has read its source table: the highest source id included"""
+    name = models.CharField(max_length=50, unique=True)
+    last_id = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.name}: {self.last_id}"
+
+
 class UserRole(models.Model):
     """Extended user profile with roles"""
     ROLE_CHOICES = [
@@ -235,3 +470,40 @@ class UserRole(models.Model):
     @property
     def can_access_admin_panel(self):
         return self.is_admin or self.can_manage_users
+
+
+class SearchTrigram(models.Model):
+    """Trigram index rows backing the admin identity and user search"""
+    KIND_CHOICES = [
+        ('identity', 'Identity'),
+        ('user', 'User'),
+    ]
+
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    object_id = models.BigIntegerField()
+    trigram = models.CharField(max_length=3)
+
+    class Meta:
+        unique_together = ['kind', 'trigram', 'object_id']
+        indexes = [
+            models.Index(fields=['kind', 'object_id'], name='searchtrigram_object_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.kind}:{self.object_id} '{self.trigram}'"
+
+
+class StatCounter(models.Model):
+    """Running totals for the dashboards, kept in step with the counted tables"""
+    NAME_CHOICES = [
+        ('users', 'Users'),
+        ('identities', 'Identities'),
+        ('unverified_identities', 'Unverified identities'),
+        ('access_logs', 'API calls'),
+    ]
+
+    name = models.CharField(max_length=50, choices=NAME_CHOICES, unique=True)
+    value = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.name}: {self.value}"
@@ -0,0 +1,109 @@
+"""
+Content negotiation for ``Accept-Context`` and ``Accept-Language``.
+
+Both headers take weighted lists (``social, legal;q=0.5`` or
+``fr-CH, fr;q=0.9, en;q=0.8``). Parsing turns a header into a tuple of
+values, most preferred first, which ``resolution`` ranks candidates against.
+Clients send the same handful of header strings over and over, so parsed
+results are memoized per distinct header in a bounded LRU; over-long headers
+are truncated first so hostile input can neither grow the cache entries nor
+make parsing expensive.
+"""
+import re
+from functools import lru_cache
+
+DEFAULT_CONTEXT = 'display'
+DEFAULT_LANGUAGE = 'en-US'
+
+# Parsed header strings kept per header type
+PARSE_CACHE_SIZE = 512
+
+# Longest header parsed and most values kept from it
+MAX_HEADER_LENGTH = 256
+MAX_VALUES = 8
+
+CONTEXT_VALUE = re.compile(r'^[a-z][a-z0-9_]{0,19}$')
+LANGUAGE_VALUE = re.compile(r'^(\*|[a-z]{1,8}(-[a-z0-9]{1,8})*)$')
+
+
+def parse_weighted(header):
+    """
+    ``(value, q)`` pairs of a comma separated header, highest q first and in
+    header order on ties. Values with q=0 or a malformed q are dropped.
+    """
+    items = []
+    for position, part in enumerate(header.split(',')):
+        value, *params = [piece.strip() for piece in part.split(';')]
+        if not value:
+            continue
+        quality = 1.0
+        for param in params:
+            name, _, raw = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(raw)
+                except ValueError:
+                    quality = -1.0
+        if 0 < quality <= 1:
+            items.append((-quality, position, value.lower()))
+    items.sort()
+    return [(value, -quality) for quality, _, value in items]
+
+
+def normalize_language(value):
+    """'fr-ch' -> 'fr-CH', matching how Identity.locale is stored"""
+    language, _, region = value.partition('-')
+    if region and len(region) == 2:
+        return f'{language}-{region.upper()}'
+    return value
+
+
+def _unique(values):
+    return tuple(dict.fromkeys(values))[:MAX_VALUES]
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _parse_contexts(header):
+    contexts = _unique(value for value, _ in parse_weighted(header) if CONTEXT_VALUE.match(value))
+    return contexts or (DEFAULT_CONTEXT,)
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _parse_languages(header):
+    languages = _unique(
+        normalize_language(value) for value, _ in parse_weighted(header) if LANGUAGE_VALUE.match(value)
+    )
+    return languages or (DEFAULT_LANGUAGE,)
+
+
+def truncate(header):
+    """``header`` cut to MAX_HEADER_LENGTH, dropping any value split by the cut"""
+    if len(header) <= MAX_HEADER_LENGTH:
+        return header
+    return header[:MAX_HEADER_LENGTH].rpartition(',')[0]
+
+
+def accepted_contexts(header):
+    """Contexts from an ``Accept-Context`` header, most preferred first"""
+    return _parse_contexts(truncate(header))
+
+
+def accepted_languages(header):
+    """Language ranges from an ``Accept-Language`` header, most preferred first"""
+    return _parse_languages(truncate(header))
+
+
+def negotiate(request):
+    """``(contexts, languages)`` requested by ``request``'s headers"""
+    return (
+        accepted_contexts(request.META.get('HTTP_ACCEPT_CONTEXT', DEFAULT_CONTEXT)),
+        accepted_languages(request.META.get('HTTP_ACCEPT_LANGUAGE', DEFAULT_LANGUAGE)),
+    )
+
+
+def cache_info():
+    """Hit/miss statistics of the parse caches"""
+    return {
+        'contexts': _parse_contexts.cache_info()._asdict(),
+        'languages': _parse_languages.cache_info()._asdict(),
+    }
@@ -8,6 +8,8 @@ from django.utils.decorators import method_decorator
 from django.views.decorators.cache import never_cache
 from django.views.decorators.csrf import csrf_protect
 from collections import defaultdict
+from . import projection
+from .cache import get_cached_identity
 from .models import Identity
 
 Application = get_application_model()
@@ -138,20 +140,8 @@ def oauth_user_info(request):
     selected_context = request.session.get('oauth_selected_context', 'display')
     
     try:
-        # Get the user's identity for the selected context
-        identity = Identity.objects.filter(
-            user=request.user,
-            context=selected_context,
-            is_active=True
-        ).first()
-        
-        if not identity:
-            # Fallback to primary identity
-            identity = Identity.objects.filter(
-                user=request.user,
-                is_primary=True,
-                is_active=True
-            ).first()
+        # Get the user's identity for the selected context (falls back to primary)
+        identity = get_cached_identity(request.user.id, selected_context)
         
         if not identity:
             return JsonResponse({
@@ -159,7 +149,7 @@ def oauth_user_info(request):
             }, status=404)
         
         # Return contextual data
-        user_data = identity.get_contextual_data(requesting_user=request.user)
+        user_data = projection.project(identity)
         user_data.update({
             'username': request.user.username,
             'email': request.user.email,
@@ -0,0 +1,61 @@
+"""
+Per-request principal.
+
+Role checks used to dereference ``user.profile`` (and re-evaluate the role
+properties) every time a decorator, view, context processor or permission
+class asked whether the user is an admin. A ``Principal`` wraps one user
+object, loads its ``UserRole`` at most once and memoizes every derived flag.
+It is stored on the user object itself, so every check made against the
+same ``request.user`` during a request shares it.
+"""
+from django.utils.functional import cached_property
+
+from .models import UserRole
+
+
+class Principal:
+    """The current user plus their role, with memoized permission flags"""
+
+    def __init__(self, user):
+        self.user = user
+
+    @cached_property
+    def role(self):
+        """The user's UserRole, or None for anonymous users and users without one"""
+        if not self.user.is_authenticated:
+            return None
+        try:
+            return self.user.profile
+        except UserRole.DoesNotExist:
+            return None
+
+    @cached_property
+    def is_admin(self):
+        if self.user.is_superuser:
+            return True
+        return self.role is not None and self.role.role == 'admin'
+
+    @cached_property
+    def can_manage_users(self):
+        if self.user.is_superuser:
+            return True
+        return self.role is not None and self.role.can_manage_users
+
+    @cached_property
+    def can_view_all_identities(self):
+        if self.user.is_superuser:
+            return True
+        return self.role is not None and self.role.can_view_all_identities
+
+    @cached_property
+    def can_access_admin_panel(self):
+        return self.is_admin or self.can_manage_users
+
+
+def get_principal(user):
+    """The Principal for ``user``, built on first use and cached on the user object"""
+    try:
+        return user._principal
+    except AttributeError:
+        principal = user._principal = Principal(user)
+        return principal
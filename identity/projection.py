@@ -0,0 +1,243 @@
+"""
+Context projections: which identity fields each context discloses.
+
+Projections are declared once, as data: an ordered field list per context
+plus a registry saying how each output field is read (a plain attribute or a
+computed value) and which columns it needs. At import time every projection
+is compiled into tuples of ``(key, getter)`` pairs, ``attrgetter`` for model
+instances and ``itemgetter`` for ``values()`` rows or the computed field's
+callable, so rendering an identity is one dict comprehension. That is about
+a quarter slower than the hand-written if/elif ladder it replaces (roughly
+0.5us per identity; only a dict display written out in the source builds a
+dict faster), in exchange for declaring each projection once.
+
+The same tables drive ``Identity.get_contextual_data``,
+``ContextualIdentitySerializer``, ``oauth_user_info`` and the ``.only()``
+column pruning in ``resolution``, so wide TEXT/JSON columns (``bio``,
+``admin_notes``, ``custom_attributes``) are never read for contexts that do
+not show them. A ``?fields=`` list narrows a projection; it never widens it.
+"""
+from collections import namedtuple
+from functools import lru_cache
+from operator import attrgetter, itemgetter, methodcaller
+
+# Fields every context discloses
+BASE_FIELDS = ('id', 'context', 'locale', 'full_name', 'visibility')
+
+# Fields disclosed on top of the base fields, per context
+CONTEXT_FIELDS = {
+    'legal': ('given_name', 'family_name', 'middle_name', 'title', 'suffix'),
+    'social': ('preferred_name', 'nickname', 'pronouns', 'avatar_url', 'bio'),
+    'professional': ('given_name', 'family_name', 'title', 'email', 'website', 'bio'),
+    'display': ('display_name', 'pronouns', 'avatar_url'),
+}
+
+# Disclosed in every context, but only when set
+OPTIONAL_FIELDS = ('custom_attributes',)
+
+# Fields that are always returned, whatever ?fields= asks for
+REQUIRED_FIELDS = ('id',)
+
+NAME_COLUMNS = (
+    'display_name', 'title', 'preferred_name', 'given_name', 'middle_name', 'family_name', 'suffix',
+)
+
+# Columns resolution, caching and validators need regardless of the projection
+RESOLUTION_COLUMNS = ('id', 'user', 'context', 'locale', 'is_primary', 'is_active', 'created_at', 'updated_at')
+
+# How to read an output field: ``getter`` computes it from an identity and
+# ``row_getter`` from a ``values()`` row; both are None for a plain column.
+# ``same_as`` names a field that always has the same value, so it is computed
+# once when both are shown.
+Field = namedtuple('Field', 'getter columns optional same_as row_getter', defaults=(False, None, None))
+
+
+def compose_full_name(context, display_name, title, preferred_name, given_name, middle_name, family_name, suffix):
+    """
+    Full name from an identity's name columns; ``Identity.get_full_name`` and
+    the ``values()`` row renderers both use it
+    """
+    if display_name:
+        return display_name
+
+    parts = []
+    if title:
+        parts.append(title)
+
+    if preferred_name and context in ['social', 'display']:
+        parts.append(preferred_name)
+    else:
+        parts.append(given_name)
+
+    if middle_name and context == 'legal':
+        parts.append(middle_name)
+
+    parts.append(family_name)
+
+    if suffix:
+        parts.append(suffix)
+
+    return ' '.join(parts)
+
+
+def _preferred_name(identity):
+    return identity.preferred_name or identity.given_name
+
+
+def _row_preferred_name(row):
+    return row['preferred_name'] or row['given_name']
+
+
+_full_name = methodcaller('get_full_name')
+_name_columns = itemgetter(*NAME_COLUMNS)
+
+
+def _row_full_name(row):
+    return compose_full_name(row['context'], *_name_columns(row))
+
+
+COMPUTED_FIELDS = {
+    'full_name': Field(_full_name, NAME_COLUMNS, row_getter=_row_full_name),
+    'preferred_name': Field(_preferred_name, ('preferred_name', 'given_name'), row_getter=_row_preferred_name),
+    # get_full_name() already returns display_name when it is set
+    'display_name': Field(_full_name, NAME_COLUMNS, same_as='full_name', row_getter=_row_full_name),
+}
+
+# Compiled projection: ``render(identity)`` and ``render_row(row)`` build the
+# contextual data dict, ``columns`` are the model columns they read
+Projection = namedtuple('Projection', 'render render_row columns')
+
+
+def field(name):
+    """The registry entry for output field ``name``"""
+    try:
+        return COMPUTED_FIELDS[name]
+    except KeyError:
+        return Field(None, (name,), name in OPTIONAL_FIELDS)
+
+
+def parse_fields(value):
+    """The ``?fields=`` parameter as a sorted tuple, or None if absent"""
+    if not value:
+        return None
+    return tuple(sorted({name.strip() for name in value.split(',') if name.strip()}))
+
+
+def allowed_fields(context):
+    """Every field ``context`` may disclose"""
+    return BASE_FIELDS + CONTEXT_FIELDS.get(context, ()) + OPTIONAL_FIELDS
+
+
+def select_fields(context, requested=None):
+    """Fields to disclose for ``context``, narrowed to ``requested`` if given"""
+    fields = allowed_fields(context)
+    if requested is None:
+        return fields
+    return tuple(name for name in fields if name in requested or name in REQUIRED_FIELDS)
+
+
+def _shown_later(obj):
+    # Placeholder keeping a ``same_as`` field's place in the dict until it is copied
+    return None
+
+
+def _compile_render(names, computed, read):
+    """
+    Render function for ``names``: ``computed`` names the ``Field`` attribute
+    holding the getter of a computed field, ``read`` makes the getter of a
+    plain column.
+    """
+    getters = []
+    same_as = []
+    optional = []
+    for name in names:
+        spec = field(name)
+        if spec.optional:
+            optional.append((name, read(name)))
+        elif spec.same_as in names:
+            getters.append((name, _shown_later))
+            same_as.append((name, spec.same_as))
+        elif name in COMPUTED_FIELDS:
+            getters.append((name, getattr(spec, computed)))
+        else:
+            getters.append((name, read(name)))
+    getters, same_as, optional = tuple(getters), tuple(same_as), tuple(optional)
+
+    def render(obj):
+        data = {key: get(obj) for key, get in getters}
+        for key, source in same_as:
+            data[key] = data[source]
+        for key, get in optional:
+            value = get(obj)
+            if value:
+                data[key] = value
+        return data
+
+    return render
+
+
+@lru_cache(maxsize=256)
+def compile_projection(context, requested=None):
+    """Compile the projection of ``context`` (narrowed to ``requested``)"""
+    names = select_fields(context, requested)
+    columns = {}
+    for name in names:
+        columns.update(dict.fromkeys(field(name).columns))
+    return Projection(
+        _compile_render(names, 'getter', attrgetter),
+        _compile_render(names, 'row_getter', itemgetter),
+        tuple(columns),
+    )
+
+
+# Full projections are compiled up front, called the way ``project`` calls
+# them: lru_cache keys ``f(a)`` and ``f(a, None)`` apart
+for _context in CONTEXT_FIELDS:
+    compile_projection(_context, None)
+
+
+def project(identity, requested=None):
+    """Contextual data of ``identity`` for its own context"""
+    return compile_projection(identity.context, requested).render(identity)
+
+
+def project_row(row, requested=None):
+    """``project`` for a ``values()`` row holding the projection's ``columns``"""
+    return compile_projection(row['context'], requested).render_row(row)
+
+
+def columns(contexts, requested=None):
+    """Columns needed to resolve and render identities of any of ``contexts``"""
+    needed = dict.fromkeys(RESOLUTION_COLUMNS)
+    for context in contexts:
+        needed.update(dict.fromkeys(compile_projection(context, requested).columns))
+    return tuple(needed)
+
+
+def all_contexts():
+    from .models import Identity
+    return [context for context, _ in Identity.CONTEXT_CHOICES]
+
+
+def load_columns(identities, requested=None):
+    """
+    Fill in any columns the identities' own projections need that were
+    deferred, e.g. when resolution fell back to a context that was not
+    requested. Issues at most one query for the whole batch.
+    """
+    from .models import Identity
+
+    missing = {}
+    for identity in identities:
+        deferred = set(columns([identity.context], requested)) & identity.get_deferred_fields()
+        if deferred:
+            missing[identity.pk] = (identity, deferred)
+    if not missing:
+        return identities
+
+    names = set().union(*(deferred for _, deferred in missing.values()))
+    for row in Identity.objects.filter(pk__in=missing).values('pk', *names):
+        identity, deferred = missing[row['pk']]
+        for name in deferred:
+            setattr(identity, name, row[name])
+    return identities
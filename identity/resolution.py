@@ -0,0 +1,151 @@
+from django.db.models import OuterRef, Subquery
+
+from . import projection
+from .models import Identity, ContextPriority
+
+# Resolution tiers, best first
+TIER_CONTEXT = 0     # a requested context, ranked by preference, then locale
+TIER_PRIORITY = 1    # context listed in the user's ContextPriority rows
+TIER_PRIMARY = 2     # primary identity
+
+
+def preferences(value):
+    """A single context/locale or a preference-ordered sequence of them, as a tuple"""
+    if value is None:
+        return ()
+    if isinstance(value, str):
+        return (value,)
+    return tuple(value)
+
+
+def locale_rank(locale, languages):
+    """
+    Position of the first language range matching ``locale`` (``len(languages)``
+    if none does). A range matches itself, its sublocales ('fr' matches
+    'fr-CH') and, for '*', anything.
+    """
+    for position, language in enumerate(languages):
+        if language == '*' or locale == language or locale.startswith(f'{language}-'):
+            return position
+    return len(languages)
+
+
+def candidate_identities(user_ids, columns=None):
+    """
+    All active identities for the given users, annotated with the owner's
+    ContextPriority for that identity's context, in a single query. With
+    ``columns``, every other column is deferred.
+    """
+    priority = ContextPriority.objects.filter(
+        user_id=OuterRef('user_id'),
+        context=OuterRef('context'),
+    ).values('priority')[:1]
+
+    # Ranking happens in Python, so skip the model's default ORDER BY
+    candidates = Identity.objects.filter(
+        user_id__in=user_ids,
+        is_active=True,
+    ).annotate(context_priority=Subquery(priority)).order_by()
+    if columns is not None:
+        candidates = candidates.only(*columns)
+    return candidates
+
+
+def pruned_candidates(user_ids, contexts, fields=None):
+    """
+    Candidates loading only the columns the requested contexts' projections
+    (narrowed to ``fields``) need; winners from other contexts are topped up
+    by ``projection.load_columns``.
+    """
+    return candidate_identities(user_ids, projection.columns(preferences(contexts), fields))
+
+
+def rank_identity(identity, context, locale=None):
+    """
+    Return a sort key for an identity, or None if it is not a candidate.
+
+    ``context`` and ``locale`` are single values or preference-ordered
+    sequences (see ``negotiation``). The key mirrors the original fallback
+    chain: the most preferred requested context, best locale first, then the
+    user's prioritised contexts, then the primary identity. Ties follow the
+    model's default ordering.
+    """
+    contexts = preferences(context)
+    languages = preferences(locale)
+    created = (identity.created_at, identity.id)
+    not_primary = not identity.is_primary
+
+    if identity.context in contexts:
+        return (
+            TIER_CONTEXT, contexts.index(identity.context),
+            locale_rank(identity.locale, languages), not_primary,
+        ) + created
+
+    priority = getattr(identity, 'context_priority', None)
+    if priority is not None:
+        return (TIER_PRIORITY, priority, locale_rank(identity.locale, languages), not_primary) + created
+
+    if identity.is_primary:
+        return (TIER_PRIMARY, identity.context) + created
+
+    return None
+
+
+def pick_identity(candidates, context, locale=None):
+    """Pick the best-ranked identity from an iterable of candidates in one pass"""
+    best = None
+    best_key = None
+    for identity in candidates:
+        key = rank_identity(identity, context, locale)
+        if key is not None and (best_key is None or key < best_key):
+            best, best_key = identity, key
+    return best
+
+
+def pick_identities(candidates, contexts, locale=None):
+    """Best identity for each of ``contexts`` (or None), in one pass over the candidates"""
+    best = dict.fromkeys(contexts)
+    keys = {}
+    for identity in candidates:
+        for context in contexts:
+            key = rank_identity(identity, context, locale)
+            if key is not None and (context not in keys or key < keys[context]):
+                best[context], keys[context] = identity, key
+    return best
+
+
+def resolve_identity(user_id, context, locale=None, fields=None):
+    """
+    Resolve the identity to disclose for a user in the given context, reading
+    only the columns its contextual data (limited to ``fields``) needs
+    """
+    identity = pick_identity(pruned_candidates([user_id], context, fields), context, locale)
+    if identity is not None:
+        projection.load_columns([identity], fields)
+    return identity
+
+
+def resolve_identities(user_ids, context, locale=None, fields=None):
+    """
+    Resolve identities for many users with a constant number of queries,
+    returning a dict of user id to identity. Users with nothing to disclose
+    are left out.
+    """
+    best = {}
+    for identity in pruned_candidates(user_ids, context, fields):
+        key = rank_identity(identity, context, locale)
+        if key is None:
+            continue
+        current = best.get(identity.user_id)
+        if current is None or key < current[0]:
+            best[identity.user_id] = (key, identity)
+    resolved = {user_id: identity for user_id, (key, identity) in best.items()}
+    projection.load_columns(resolved.values(), fields)
+    return resolved
+
+
+def resolve_contexts(user_id, contexts, locale=None, fields=None):
+    """Resolve one user's identity separately for each context, with one query"""
+    resolved = pick_identities(pruned_candidates([user_id], contexts, fields), contexts, locale)
+    projection.load_columns([identity for identity in resolved.values() if identity], fields)
+    return resolved
@@ -0,0 +1,160 @@
+"""
+AccessLog retention in monthly buckets.
+
+Raw access logs are kept for ``KEEP_MONTHS`` whole calendar months (plus the
+current one); older months are pruned bucket by bucket, optionally archived
+first as gzipped NDJSON via ``exports``. Deletes run in bounded batches, each
+in its own short transaction with an optional pause between them, so pruning
+a large month never holds a long lock or a huge transaction. Rollups are
+brought up to date before anything is deleted and rows not yet rolled up are
+never deleted, so ``rollups`` keep answering for pruned months.
+"""
+import os
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Sum
+from django.db.models.functions import TruncMonth
+from django.utils import timezone
+
+from . import exports, rollups, stats
+from .models import AccessLog, AccessLogRollup
+
+DEFAULTS = {
+    'KEEP_MONTHS': 12,
+    'BATCH_SIZE': 5000,
+    # Seconds to sleep between delete batches, to leave room for other writers
+    'PAUSE': 0.0,
+    # Directory to archive buckets to before deleting them, or None
+    'ARCHIVE_DIR': None,
+    # Columnar cold archive (segments.py): rows older than this many days move
+    # into compressed segment files of up to SEGMENT_ROWS rows in SEGMENT_DIR
+    'COLD_AFTER_DAYS': 90,
+    'SEGMENT_DIR': None,
+    'SEGMENT_ROWS': 100000,
+    'SEGMENT_CODEC': 'zlib',
+}
+
+
+def get_options():
+    return {**DEFAULTS, **getattr(settings, 'IDENTITY_RETENTION', {})}
+
+
+def month_start(value):
+    """Start of the calendar month containing ``value``, in the current timezone"""
+    return timezone.localtime(value).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_month(month):
+    return month_start(month + timedelta(days=32))
+
+
+def cutoff(keep_months, now=None):
+    """Start of the oldest month to keep"""
+    month = month_start(now or timezone.now())
+    for _ in range(keep_months):
+        month = month_start(month - timedelta(days=1))
+    return month
+
+
+def expired_buckets(before):
+    """Month starts of the buckets holding raw rows older than ``before``"""
+    oldest = AccessLog.objects.order_by('timestamp').values_list('timestamp', flat=True).first()
+    if oldest is None:
+        return []
+    months = []
+    month = month_start(oldest)
+    while month < before:
+        months.append(month)
+        month = next_month(month)
+    return months
+
+
+def rolled_up_counts(before):
+    """``{month: accesses}`` recorded by the rollups for months before ``before``"""
+    counts = (
+        AccessLogRollup.objects.filter(hour__lt=before)
+        .annotate(month=TruncMonth('hour'))
+        .values('month').annotate(n=Sum('count')).order_by()
+    )
+    return {month_start(row['month']): row['n'] for row in counts}
+
+
+def _archive_path(directory, month):
+    path = os.path.join(directory, f'access-logs-{month:%Y-%m}.ndjson.gz')
+    # A later run picking up stragglers must not overwrite the first archive
+    suffix = 1
+    while os.path.exists(path):
+        suffix += 1
+        path = os.path.join(directory, f'access-logs-{month:%Y-%m}-{suffix}.ndjson.gz')
+    return path
+
+
+def bucket_lookups(month, last_id):
+    """The rows of the bucket starting at ``month`` that are rolled up (id <= ``last_id``)"""
+    return {'timestamp__gte': month, 'timestamp__lt': next_month(month), 'id__lte': last_id}
+
+
+def archive_bucket(month, directory, last_id):
+    """
+    Write the rolled-up rows of the bucket starting at ``month`` to
+    ``directory`` as gzipped NDJSON; returns the path
+    """
+    path = _archive_path(directory, month)
+    lookups = bucket_lookups(month, last_id)
+    # Write under a temporary name so a partial archive is never mistaken for a complete one
+    partial = path + '.partial'
+    with open(partial, 'wb') as out:
+        for chunk in exports.render(exports.batches(lookups), 'ndjson', compress=True):
+            out.write(chunk)
+    os.replace(partial, path)
+    return path
+
+
+def delete_bucket(month, last_id, batch_size, pause=0.0):
+    """Delete the rows ``bucket_lookups`` selects in bounded batches; returns how many"""
+    return delete_rows(AccessLog.objects.filter(**bucket_lookups(month, last_id)), batch_size, pause)
+
+
+def delete_rows(queryset, batch_size, pause=0.0):
+    """
+    Delete the AccessLogs in ``queryset`` in bounded batches, each in its own
+    transaction with the access counter adjusted; returns how many
+    """
+    deleted = 0
+    while True:
+        rows = list(queryset.values_list('id', 'hit_count')[:batch_size])
+        if not rows:
+            return deleted
+        with transaction.atomic():
+            count, _ = AccessLog.objects.filter(id__in=[pk for pk, _ in rows]).delete()
+            stats.increment('access_logs', -sum(hits for _, hits in rows))
+        deleted += count
+        if pause:
+            time.sleep(pause)
+
+
+def prune(keep_months=None, archive_dir=None, batch_size=None, pause=None, progress=None):
+    """
+    Archive (if ``archive_dir``) and delete every bucket older than
+    ``keep_months``. ``progress(month, deleted, archive_path)`` is called
+    after each bucket. Returns the number of rows deleted.
+    """
+    options = get_options()
+    keep_months = options['KEEP_MONTHS'] if keep_months is None else keep_months
+    archive_dir = archive_dir or options['ARCHIVE_DIR']
+    batch_size = batch_size or options['BATCH_SIZE']
+    pause = options['PAUSE'] if pause is None else pause
+
+    rollups.roll_up()
+    last_id = rollups.checkpoint()
+    total = 0
+    for month in expired_buckets(cutoff(keep_months)):
+        path = archive_bucket(month, archive_dir, last_id) if archive_dir else None
+        deleted = delete_bucket(month, last_id, batch_size, pause)
+        total += deleted
+        if progress:
+            progress(month, deleted, path)
+    return total
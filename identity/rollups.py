@@ -0,0 +1,254 @@
+"""
+AccessLog rollups.
+
+Three tables count accesses rolled up from AccessLog:
+
+* ``AccessLogRollup``: per identity, context and hour
+* ``AccessLogDailyRollup``: per identity, context and day
+* ``AccessorDailyRollup``: per identity, accessing user and day
+
+Each has its own ``RollupCheckpoint`` (the highest AccessLog id already
+counted). ``roll_up`` folds in AccessLog rows past a checkpoint one bounded
+batch at a time, each batch and its checkpoint advance committed together,
+so it can run as often as wanted, is safe to interrupt and never counts a
+row twice. A batch stops at the first row younger than ``SETTLE`` (plus the
+audit coalescing window, during which a row can still gain hits) so a
+writer transaction that commits a lower id after a higher one is already
+visible is not skipped. A coalesced row counts its ``hit_count`` accesses
+in the hour and day of the first one. The background log writer runs it
+every ``IDENTITY_AUDIT['ROLLUP_INTERVAL']`` seconds; ``rollup_access_logs``
+does the same from cron.
+
+Historical questions are answered from the rollups; ``hourly_counts`` reads
+the tail past the checkpoint, normally a few minutes' worth, from AccessLog,
+while ``access_stats`` reads the daily rollups only, so its cost does not
+grow with the log.
+"""
+from collections import namedtuple
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Sum
+from django.db.models.functions import TruncDate, TruncHour
+from django.utils import timezone
+
+from .audit import coalesce_window
+from .models import (
+    AccessLog, AccessLogRollup, AccessLogDailyRollup, AccessorDailyRollup, RollupCheckpoint
+)
+
+# ``keys`` are AccessLog columns copied as they are, ``bucket`` the name and
+# expression of the time period they are counted in
+Rollup = namedtuple('Rollup', 'name model keys bucket')
+
+HOURLY = Rollup('access_log_hourly', AccessLogRollup, ('identity_id', 'access_context'), ('hour', TruncHour))
+DAILY = Rollup('access_log_daily', AccessLogDailyRollup, ('identity_id', 'access_context'), ('day', TruncDate))
+ACCESSORS = Rollup('accessor_daily', AccessorDailyRollup, ('identity_id', 'accessed_by_id'), ('day', TruncDate))
+
+ROLLUPS = {rollup.name: rollup for rollup in (HOURLY, DAILY, ACCESSORS)}
+
+CHECKPOINT = HOURLY.name
+
+BATCH_SIZE = 10000
+
+# Rows younger than this are left for a later run
+SETTLE = timedelta(minutes=5)
+
+
+def checkpoint(name=None):
+    """
+    Highest AccessLog id included in the ``name`` rollup, or without a name
+    in every rollup
+    """
+    names = [name] if name else list(ROLLUPS)
+    last_ids = dict(RollupCheckpoint.objects.filter(name__in=names).values_list('name', 'last_id'))
+    return min(last_ids.get(name, 0) for name in names)
+
+
+def _roll_up_batch(rollup, batch_size):
+    """Fold the next ``batch_size`` AccessLog rows into ``rollup``; returns how many"""
+    bucket, trunc = rollup.bucket
+    with transaction.atomic():
+        state, _ = RollupCheckpoint.objects.select_for_update().get_or_create(name=rollup.name)
+        settled = timezone.now() - SETTLE - coalesce_window()
+        ids = []
+        for pk, timestamp in (AccessLog.objects.filter(id__gt=state.last_id)
+                              .order_by('id').values_list('id', 'timestamp')[:batch_size]):
+            if timestamp >= settled:
+                break
+            ids.append(pk)
+        if not ids:
+            return 0
+
+        buckets = (
+            AccessLog.objects.filter(id__gt=state.last_id, id__lte=ids[-1])
+            .annotate(**{bucket: trunc('timestamp')})
+            .values(*rollup.keys, bucket)
+            .annotate(n=Sum('hit_count'))
+            .order_by()
+        )
+        counts = {tuple(row[key] for key in (*rollup.keys, bucket)): row['n'] for row in buckets}
+
+        existing = rollup.model.objects.filter(**{
+            'identity_id__in': {key[0] for key in counts},
+            f'{bucket}__gte': min(key[-1] for key in counts),
+            f'{bucket}__lte': max(key[-1] for key in counts),
+        })
+        updated = []
+        for row in existing:
+            key = tuple(getattr(row, name) for name in (*rollup.keys, bucket))
+            if key in counts:
+                row.count += counts.pop(key)
+                updated.append(row)
+        rollup.model.objects.bulk_update(updated, ['count'], batch_size=500)
+        rollup.model.objects.bulk_create(
+            [rollup.model(count=n, **dict(zip((*rollup.keys, bucket), key))) for key, n in counts.items()],
+            batch_size=500,
+        )
+
+        state.last_id = ids[-1]
+        state.save(update_fields=['last_id'])
+        return len(ids)
+
+
+def roll_up(batch_size=BATCH_SIZE, max_batches=None, names=None):
+    """
+    Bring the rollups (all, or those in ``names``) up to date; returns the
+    number of AccessLog rows folded into the one furthest behind
+    """
+    most = 0
+    for name in names or ROLLUPS:
+        total = 0
+        batches = 0
+        while max_batches is None or batches < max_batches:
+            rolled = _roll_up_batch(ROLLUPS[name], batch_size)
+            if not rolled:
+                break
+            total += rolled
+            batches += 1
+        most = max(most, total)
+    return most
+
+
+def rebuild_daily(batch_size=BATCH_SIZE):
+    """
+    Recount the per-context daily rollup from the hourly one, which keeps
+    the history of pruned and archived months, then catch up from
+    AccessLog; returns the number of daily rows written
+    """
+    with transaction.atomic():
+        # Neither checkpoint can move until the copy is committed
+        hourly = RollupCheckpoint.objects.select_for_update().get_or_create(name=HOURLY.name)[0]
+        daily = RollupCheckpoint.objects.select_for_update().get_or_create(name=DAILY.name)[0]
+        AccessLogDailyRollup.objects.all().delete()
+        days = (
+            AccessLogRollup.objects.annotate(day=TruncDate('hour'))
+            .values('identity_id', 'access_context', 'day')
+            .annotate(n=Sum('count'))
+            .order_by()
+        )
+        written = 0
+        batch = []
+        for row in days.iterator(chunk_size=batch_size):
+            batch.append(AccessLogDailyRollup(
+                identity_id=row['identity_id'], access_context=row['access_context'], day=row['day'], count=row['n'],
+            ))
+            if len(batch) >= batch_size:
+                AccessLogDailyRollup.objects.bulk_create(batch, batch_size=500)
+                written += len(batch)
+                batch = []
+        AccessLogDailyRollup.objects.bulk_create(batch, batch_size=500)
+        written += len(batch)
+        daily.last_id = hourly.last_id
+        daily.save(update_fields=['last_id'])
+    roll_up(batch_size, names=[DAILY.name])
+    return written
+
+
+def rebuild_accessors(batch_size=BATCH_SIZE):
+    """
+    Recount the per-accessor daily rollup from AccessLog. Only the rows
+    still in the table can be counted: pruned and archived months are lost.
+    Returns the number of AccessLog rows folded in.
+    """
+    with transaction.atomic():
+        state = RollupCheckpoint.objects.select_for_update().get_or_create(name=ACCESSORS.name)[0]
+        AccessorDailyRollup.objects.all().delete()
+        state.last_id = 0
+        state.save(update_fields=['last_id'])
+    return roll_up(batch_size, names=[ACCESSORS.name])
+
+
+def hourly_counts(identity=None, context=None, since=None, until=None):
+    """
+    ``{hour: accesses}`` from the rollups plus the not yet rolled up tail.
+    ``since`` and ``until`` select whole hours: an hour is included when it
+    starts at or after ``since`` and before ``until``.
+    """
+    filters = {}
+    if identity is not None:
+        filters['identity_id'] = identity
+    if context is not None:
+        filters['access_context'] = context
+
+    rollups = AccessLogRollup.objects.filter(**filters)
+    tail = AccessLog.objects.filter(id__gt=checkpoint(HOURLY.name), **filters).annotate(hour=TruncHour('timestamp'))
+    if since is not None:
+        rollups = rollups.filter(hour__gte=since)
+        tail = tail.filter(hour__gte=since)
+    if until is not None:
+        rollups = rollups.filter(hour__lt=until)
+        tail = tail.filter(hour__lt=until)
+
+    counts = dict(rollups.values('hour').annotate(n=Sum('count')).order_by().values_list('hour', 'n'))
+    for hour, n in tail.values('hour').annotate(n=Sum('hit_count')).order_by().values_list('hour', 'n'):
+        counts[hour] = counts.get(hour, 0) + n
+    return dict(sorted(counts.items()))
+
+
+def access_count(**filters):
+    """Total accesses matching ``hourly_counts`` filters"""
+    return sum(hourly_counts(**filters).values())
+
+
+def access_stats(identity=None, since=None, until=None, accessors=10):
+    """
+    Accesses per day and context, and the ``accessors`` users with the most
+    accesses, for one identity or all of them, on the days from ``since``
+    up to but excluding ``until`` (dates). Reads the daily rollups only, so
+    the most recent accesses show up once they have been rolled up.
+    """
+    filters = {}
+    if identity is not None:
+        filters['identity_id'] = identity
+    if since is not None:
+        filters['day__gte'] = since
+    if until is not None:
+        filters['day__lt'] = until
+
+    days = {}
+    contexts = {}
+    for day, context, n in (AccessLogDailyRollup.objects.filter(**filters)
+                            .values('day', 'access_context').annotate(n=Sum('count'))
+                            .order_by('day', 'access_context').values_list('day', 'access_context', 'n')):
+        entry = days.setdefault(day, {'day': day, 'total': 0, 'contexts': {}})
+        entry['total'] += n
+        entry['contexts'][context] = n
+        contexts[context] = contexts.get(context, 0) + n
+
+    top = (
+        AccessorDailyRollup.objects.filter(**filters)
+        .values('accessed_by_id', 'accessed_by__username')
+        .annotate(n=Sum('count'))
+        .order_by('-n', 'accessed_by_id')[:accessors]
+    ) if accessors else []
+
+    return {
+        'total': sum(contexts.values()),
+        'days': list(days.values()),
+        'contexts': contexts,
+        'accessors': [
+            {'id': row['accessed_by_id'], 'username': row['accessed_by__username'], 'count': row['n']}
+            for row in top
+        ],
+    }
@@ -0,0 +1,212 @@
+"""
+Trigram search index for the admin identity and user search.
+
+Each indexed object is stored as the set of lower-cased trigrams of its
+searchable fields, padded the way pg_trgm pads words, in ``SearchTrigram``.
+A search term is matched by intersecting the object ids of its rarest
+trigrams through the (kind, trigram, object_id) index, so selective searches
+never scan the identity or user table. The index is portable: plain tables
+and B-tree indexes work the same on SQLite and Postgres.
+
+Candidates are re-checked against the original ``icontains`` semantics, so
+results are exactly those of the old ``Q(...)`` filters (per search term).
+"""
+import re
+
+from django.contrib.auth.models import User
+from django.db.models import Q
+
+from .models import Identity, SearchTrigram
+
+# Searchable fields per kind; identity search also covers the owner's username
+SEARCH_FIELDS = {
+    'identity': ('given_name', 'family_name', 'email', 'user__username'),
+    'user': ('username', 'email', 'first_name', 'last_name'),
+}
+
+# Upper bound on candidates ranked in Python for typeahead
+MAX_CANDIDATES = 500
+
+# A trigram shared by this many objects is not worth an index lookup; terms
+# whose every trigram is that common fall back to the plain icontains filter
+SELECTIVE_LIMIT = 1000
+
+# How many of a term's rarest trigrams are intersected
+INTERSECT_GRAMS = 2
+
+WORD_BOUNDARY = re.compile(r'[\s@._-]+')
+
+
+def trigrams(text):
+    """
+    Trigrams of ``text``, padded so prefixes and suffixes get their own grams;
+    two trailing spaces so even the last character starts a gram
+    """
+    text = f'  {text.lower()}  '
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def document_values(kind, obj):
+    """Values of the searchable fields of ``obj``"""
+    if kind == 'identity':
+        return [obj.given_name, obj.family_name, obj.email, obj.user.username]
+    return [obj.username, obj.email, obj.first_name, obj.last_name]
+
+
+def document_trigrams(kind, obj):
+    grams = set()
+    for value in document_values(kind, obj):
+        if value:
+            grams |= trigrams(value)
+    return grams
+
+
+def index_object(kind, obj):
+    """
+    Bring the index rows for ``obj`` up to date, writing only what changed.
+    Returns True if any rows were written.
+    """
+    wanted = document_trigrams(kind, obj)
+    existing = set(
+        SearchTrigram.objects.filter(kind=kind, object_id=obj.pk).values_list('trigram', flat=True)
+    )
+
+    stale = existing - wanted
+    if stale:
+        SearchTrigram.objects.filter(kind=kind, object_id=obj.pk, trigram__in=stale).delete()
+
+    missing = wanted - existing
+    if missing:
+        SearchTrigram.objects.bulk_create(
+            SearchTrigram(kind=kind, object_id=obj.pk, trigram=gram) for gram in missing
+        )
+
+    return bool(stale or missing)
+
+
+def remove_object(kind, object_id):
+    SearchTrigram.objects.filter(kind=kind, object_id=object_id).delete()
+
+
+def source_queryset(kind):
+    if kind == 'identity':
+        return Identity.objects.select_related('user').order_by()
+    return User.objects.order_by()
+
+
+def rebuild(kinds=None, batch_size=2000):
+    """Drop and rebuild the index for ``kinds`` (default: all), returning row counts"""
+    counts = {}
+    for kind in kinds or SEARCH_FIELDS:
+        SearchTrigram.objects.filter(kind=kind).delete()
+        rows = []
+        written = 0
+        for obj in source_queryset(kind).iterator(chunk_size=batch_size):
+            rows.extend(
+                SearchTrigram(kind=kind, object_id=obj.pk, trigram=gram)
+                for gram in document_trigrams(kind, obj)
+            )
+            if len(rows) >= batch_size:
+                SearchTrigram.objects.bulk_create(rows, batch_size=batch_size)
+                written += len(rows)
+                rows = []
+        if rows:
+            SearchTrigram.objects.bulk_create(rows, batch_size=batch_size)
+            written += len(rows)
+        counts[kind] = written
+    return counts
+
+
+def split_terms(query):
+    return [term for term in query.lower().split() if term]
+
+
+def gram_frequency(kind, gram):
+    """Number of objects containing ``gram``, counted no higher than SELECTIVE_LIMIT"""
+    rows = SearchTrigram.objects.filter(kind=kind, trigram=gram)
+    return rows[:SELECTIVE_LIMIT].count()
+
+
+def term_candidates(kind, term):
+    """
+    Conditions restricting ``pk`` to objects whose index rows can contain
+    ``term``, or None if the term is too common for the index to help.
+
+    Only the rarest trigrams are intersected; the icontains re-check in
+    ``search`` removes any false positives.
+    """
+    rows = SearchTrigram.objects.filter(kind=kind)
+    if len(term) < 3:
+        # Every character is followed by the two-space trailing pad, so some
+        # trigram of a matching object starts with the term. A range keeps the
+        # lookup on the index where LIKE 'x%' would not on SQLite.
+        rows = rows.filter(trigram__gte=term, trigram__lt=term + '\uffff')
+        if rows[:SELECTIVE_LIMIT].count() >= SELECTIVE_LIMIT:
+            return None
+        return [Q(pk__in=rows.values('object_id'))]
+
+    grams = {term[i:i + 3] for i in range(len(term) - 2)}
+    frequencies = sorted((gram_frequency(kind, gram), gram) for gram in grams)
+    if frequencies[0][0] >= SELECTIVE_LIMIT:
+        return None
+    return [
+        Q(pk__in=rows.filter(trigram=gram).values('object_id'))
+        for frequency, gram in frequencies[:INTERSECT_GRAMS]
+        if frequency < SELECTIVE_LIMIT
+    ]
+
+
+def term_filter(kind, term):
+    """The original icontains predicate for one term"""
+    condition = Q()
+    for field in SEARCH_FIELDS[kind]:
+        condition |= Q(**{f'{field}__icontains': term})
+    return condition
+
+
+def search(queryset, kind, query):
+    """Restrict ``queryset`` to objects matching every term of ``query``"""
+    for term in split_terms(query):
+        for condition in term_candidates(kind, term) or []:
+            queryset = queryset.filter(condition)
+        queryset = queryset.filter(term_filter(kind, term))
+    return queryset
+
+
+def score(values, terms):
+    """
+    Rank key: per term, exact field > field prefix > word prefix > substring;
+    ties go to the object matching in more fields.
+    """
+    values = [value.lower() for value in values if value]
+    total = hits = 0
+    for term in terms:
+        best = 0
+        for value in values:
+            if value == term:
+                points = 4
+            elif value.startswith(term):
+                points = 3
+            elif any(word.startswith(term) for word in WORD_BOUNDARY.split(value)):
+                points = 2
+            elif term in value:
+                points = 1
+            else:
+                continue
+            best = max(best, points)
+            hits += 1
+        total += best
+    return total, hits
+
+
+def ranked_search(kind, query, limit=10):
+    """Best ``limit`` matches for ``query``, ranked for typeahead"""
+    terms = split_terms(query)
+    if not terms:
+        return []
+
+    candidates = list(search(source_queryset(kind), kind, query)[:MAX_CANDIDATES])
+    candidates.sort(
+        key=lambda obj: (score(document_values(kind, obj), terms), obj.pk), reverse=True
+    )
+    return candidates[:limit]
@@ -0,0 +1,468 @@
+"""
+Columnar cold archive for old access logs.
+
+``archive`` moves rolled-up AccessLog rows older than ``COLD_AFTER_DAYS``
+out of the database into append-only segment files under ``SEGMENT_DIR``.
+Each segment holds up to ``SEGMENT_ROWS`` rows, stored column by column in
+the ``exports.COLUMNS`` layout: integers and timestamps as little-endian
+int64 arrays, strings as a dictionary of distinct values plus an array of
+codes. Rows are in timestamp order. Every column is compressed on its own
+(zlib or lzma) and a footer records where the columns are, plus the
+segment's id, timestamp and identity id ranges::
+
+    MAGIC | column | column | ... | footer (JSON) | footer length (<I) | MAGIC
+
+``query`` reads segments through ``mmap``: only the footer is looked at for
+segments whose ranges cannot match, and only the columns needed for the
+filters and output are decompressed for the rest. It yields batches of rows
+shaped like ``exports.batches``, so ``exports.render`` turns them into the
+same CSV or NDJSON as a live export.
+
+A segment is complete once it has its final name; its rows are deleted
+afterwards in bounded batches. If a run dies in between, the next one
+deletes the leftovers of the last segment before archiving anything else,
+so no row ends up both in the database and in a segment. Run one archive
+at a time per directory.
+"""
+import json
+import lzma
+import mmap
+import os
+import re
+import struct
+import sys
+import zlib
+from array import array
+from bisect import bisect_left
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.utils import timezone
+
+from . import exports, retention, rollups
+from .models import AccessLog
+
+MAGIC = b'IDALSEG1'
+TRAILER = struct.Struct('<I8s')
+VERSION = 1
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+MICROSECOND = timedelta(microseconds=1)
+
+CODECS = {
+    'zlib': (lambda data: zlib.compress(data, 9), zlib.decompress),
+    'lzma': (lzma.compress, lzma.decompress),
+}
+
+# How each exported column is stored
+KINDS = {
+    'id': 'int',
+    'timestamp': 'datetime',
+    'identity_id': 'int',
+    'identity_user_id': 'int',
+    'accessed_by_id': 'int',
+    'accessed_by_username': 'str',
+    'access_context': 'str',
+    'accessed_fields': 'json',
+    'ip_address': 'bytes',
+    'user_agent': 'str',
+    'last_seen': 'datetime',
+    'hit_count': 'int',
+}
+
+# Filters ``query`` understands (the lookups ``exports.parse_filters`` builds)
+# and the columns they read; the time bounds are binary searches since a
+# segment's rows are in timestamp order, the rest equality tests
+TIME_FILTERS = ('timestamp__gte', 'timestamp__lt')
+FILTERS = {
+    'timestamp__gte': 'timestamp',
+    'timestamp__lt': 'timestamp',
+    'identity_id': 'identity_id',
+    'accessed_by_id': 'accessed_by_id',
+    'access_context': 'access_context',
+}
+
+SEGMENT_NAME = re.compile(r'^segment-(\d{8})\.als$')
+
+
+class InvalidSegment(Exception):
+    pass
+
+
+def to_micros(value):
+    return (value - EPOCH) // MICROSECOND
+
+
+def from_micros(value):
+    return EPOCH + value * MICROSECOND
+
+
+def _int64(values):
+    values = array('q', values)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+class _IntColumn:
+    """int64 values (timestamps as microseconds since the epoch)"""
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.values = array('q')
+
+    def add(self, value):
+        self.values.append(to_micros(value) if self.kind == 'datetime' else value)
+
+    def encode(self):
+        return _int64(self.values).tobytes()
+
+    @staticmethod
+    def decode(data, kind):
+        values = array('q')
+        values.frombytes(data)
+        if sys.byteorder == 'big':
+            values.byteswap()
+        return values
+
+
+class _DictColumn:
+    """Distinct values once, then a uint32 code per row"""
+    LENGTH = struct.Struct('<I')
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.codes = array('I')
+        self.dictionary = {}
+
+    def add(self, value):
+        if self.kind == 'json':
+            value = json.dumps(value, separators=(',', ':'))
+        elif self.kind == 'bytes':
+            value = bytes(value)
+        self.codes.append(self.dictionary.setdefault(value, len(self.dictionary)))
+
+    def encode(self):
+        parts = [self.LENGTH.pack(len(self.dictionary))]
+        for value in self.dictionary:
+            raw = value if self.kind == 'bytes' else value.encode('utf-8')
+            parts.append(self.LENGTH.pack(len(raw)))
+            parts.append(raw)
+        codes = array('I', self.codes)
+        if sys.byteorder == 'big':
+            codes.byteswap()
+        parts.append(codes.tobytes())
+        return b''.join(parts)
+
+    @classmethod
+    def decode(cls, data, kind):
+        """``(dictionary, codes)``; the dictionary holds the row values"""
+        (count,), offset = cls.LENGTH.unpack_from(data, 0), cls.LENGTH.size
+        dictionary = []
+        for _ in range(count):
+            (length,) = cls.LENGTH.unpack_from(data, offset)
+            offset += cls.LENGTH.size
+            raw = bytes(data[offset:offset + length])
+            offset += length
+            if kind == 'bytes':
+                dictionary.append(raw)
+            elif kind == 'json':
+                dictionary.append(json.loads(raw))
+            else:
+                dictionary.append(raw.decode('utf-8'))
+        codes = array('I')
+        codes.frombytes(data[offset:])
+        if sys.byteorder == 'big':
+            codes.byteswap()
+        return dictionary, codes
+
+
+def _column_type(kind):
+    return _IntColumn if kind in ('int', 'datetime') else _DictColumn
+
+
+class SegmentWriter:
+    """Collects rows from ``exports.batches`` column by column and writes one segment"""
+
+    def __init__(self, codec='zlib'):
+        if codec not in CODECS:
+            raise ValueError(f"codec must be one of {sorted(CODECS)}, got '{codec}'")
+        self.codec = codec
+        self.columns = {name: _column_type(kind)(kind) for name, kind in KINDS.items()}
+        self.rows = 0
+
+    def __len__(self):
+        return self.rows
+
+    def add(self, batch):
+        for name, column in self.columns.items():
+            add = column.add
+            for row in batch:
+                add(row[name])
+        self.rows += len(batch)
+
+    def footer(self):
+        ids = self.columns['id'].values
+        timestamps = self.columns['timestamp'].values
+        identities = self.columns['identity_id'].values
+        return {
+            'version': VERSION,
+            'codec': self.codec,
+            'rows': self.rows,
+            'min_id': min(ids), 'max_id': max(ids),
+            'min_timestamp': min(timestamps), 'max_timestamp': max(timestamps),
+            'min_identity_id': min(identities), 'max_identity_id': max(identities),
+        }
+
+    def write(self, path):
+        """Write the segment to ``path`` (via a temporary name); returns its size in bytes"""
+        compress = CODECS[self.codec][0]
+        footer = self.footer()
+        footer['columns'] = []
+        partial = path + '.partial'
+        with open(partial, 'wb') as out:
+            out.write(MAGIC)
+            offset = len(MAGIC)
+            for name, column in self.columns.items():
+                data = compress(column.encode())
+                out.write(data)
+                footer['columns'].append({'name': name, 'kind': column.kind, 'offset': offset, 'length': len(data)})
+                offset += len(data)
+            encoded = json.dumps(footer, separators=(',', ':')).encode('utf-8')
+            out.write(encoded)
+            out.write(TRAILER.pack(len(encoded), MAGIC))
+            size = offset + len(encoded) + TRAILER.size
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(partial, path)
+        return size
+
+
+def segment_paths(directory):
+    """Complete segments in ``directory``, oldest first"""
+    if not directory or not os.path.isdir(directory):
+        return []
+    names = sorted(name for name in os.listdir(directory) if SEGMENT_NAME.match(name))
+    return [os.path.join(directory, name) for name in names]
+
+
+def _next_path(directory):
+    paths = segment_paths(directory)
+    number = int(SEGMENT_NAME.match(os.path.basename(paths[-1])).group(1)) + 1 if paths else 1
+    return os.path.join(directory, f'segment-{number:08d}.als')
+
+
+def read_footer(buffer):
+    """The footer of the segment in ``buffer`` (an mmap or bytes)"""
+    if len(buffer) < len(MAGIC) + TRAILER.size or buffer[:len(MAGIC)] != MAGIC:
+        raise InvalidSegment('not an access log segment')
+    length, magic = TRAILER.unpack_from(buffer, len(buffer) - TRAILER.size)
+    if magic != MAGIC:
+        raise InvalidSegment('segment is truncated')
+    end = len(buffer) - TRAILER.size
+    footer = json.loads(bytes(buffer[end - length:end]))
+    if footer['version'] != VERSION:
+        raise InvalidSegment(f"unsupported segment version {footer['version']}")
+    return footer
+
+
+def _bound(lookups, name, convert=lambda value: value):
+    value = lookups.get(name)
+    return None if value is None else convert(value)
+
+
+def footer_matches(footer, lookups):
+    """False when no row of the segment can match ``lookups``"""
+    since = _bound(lookups, 'timestamp__gte', to_micros)
+    until = _bound(lookups, 'timestamp__lt', to_micros)
+    identity = lookups.get('identity_id')
+    if since is not None and footer['max_timestamp'] < since:
+        return False
+    if until is not None and footer['min_timestamp'] >= until:
+        return False
+    if identity is not None and not footer['min_identity_id'] <= identity <= footer['max_identity_id']:
+        return False
+    return True
+
+
+class _Segment:
+    """An open, memory-mapped segment"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        try:
+            # An empty file cannot be mapped; a truncated or corrupt one has no footer
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self.file.close()
+            raise
+        try:
+            self.footer = read_footer(self.map)
+        except Exception:
+            self.close()
+            raise
+        self.columns = {column['name']: column for column in self.footer['columns']}
+        self._decoded = {}
+
+    def column(self, name):
+        """``array`` of int64 for numeric columns, ``(dictionary, codes)`` otherwise"""
+        if name not in self._decoded:
+            self._decoded[name] = self._decode(name)
+        return self._decoded[name]
+
+    def _decode(self, name):
+        info = self.columns[name]
+        # Decompress straight from the mapping; the views must be released before it is closed
+        with memoryview(self.map) as whole, whole[info['offset']:info['offset'] + info['length']] as view:
+            data = CODECS[self.footer['codec']][1](view)
+        return _column_type(info['kind']).decode(data, info['kind'])
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _selected(segment, lookups):
+    """Positions of the rows matching ``lookups``"""
+    start, stop = 0, segment.footer['rows']
+    if any(lookup in lookups for lookup in TIME_FILTERS):
+        timestamps = segment.column('timestamp')
+        if 'timestamp__gte' in lookups:
+            start = bisect_left(timestamps, to_micros(lookups['timestamp__gte']))
+        if 'timestamp__lt' in lookups:
+            stop = bisect_left(timestamps, to_micros(lookups['timestamp__lt']))
+    positions = range(start, stop)
+
+    for lookup, value in lookups.items():
+        if lookup in TIME_FILTERS or not positions:
+            continue
+        name = FILTERS[lookup]
+        if KINDS[name] == 'int':
+            values = segment.column(name)
+            positions = [i for i in positions if values[i] == value]
+        else:
+            dictionary, codes = segment.column(name)
+            if value not in dictionary:
+                return []
+            code = dictionary.index(value)
+            positions = [i for i in positions if codes[i] == code]
+    return positions
+
+
+def scan(path, lookups, batch_size=exports.BATCH_SIZE):
+    """Batches of the rows of the segment at ``path`` matching ``lookups``"""
+    unknown = set(lookups) - set(FILTERS)
+    if unknown:
+        raise ValueError(f'unsupported archive filters: {sorted(unknown)}')
+    with _Segment(path) as segment:
+        if not footer_matches(segment.footer, lookups):
+            return
+        positions = _selected(segment, lookups)
+        if not positions:
+            return
+        columns = {name: segment.column(name) for name in KINDS}
+
+    def read(name, kind):
+        if kind == 'int':
+            return columns[name].__getitem__
+        if kind == 'datetime':
+            values = columns[name]
+            return lambda i: from_micros(values[i])
+        dictionary, codes = columns[name]
+        return lambda i: dictionary[codes[i]]
+
+    readers = [(name, read(name, kind)) for name, kind in KINDS.items()]
+    for start in range(0, len(positions), batch_size):
+        yield [
+            {name: reader(i) for name, reader in readers}
+            for i in positions[start:start + batch_size]
+        ]
+
+
+def footers(directory=None):
+    """``(path, footer)`` for every segment, read without touching the columns"""
+    for path in segment_paths(directory or retention.get_options()['SEGMENT_DIR']):
+        with _Segment(path) as segment:
+            yield path, segment.footer
+
+
+def query(lookups, directory=None, batch_size=exports.BATCH_SIZE):
+    """
+    Batches of archived rows matching ``lookups`` (as built by
+    ``exports.parse_filters``), segment by segment in archive order
+    """
+    directory = directory or retention.get_options()['SEGMENT_DIR']
+    for path in segment_paths(directory):
+        yield from scan(path, lookups, batch_size)
+
+
+def _delete_archived(ids, batch_size, pause):
+    deleted = 0
+    for start in range(0, len(ids), batch_size):
+        chunk = ids[start:start + batch_size]
+        deleted += retention.delete_rows(AccessLog.objects.filter(id__in=chunk), batch_size, pause)
+    return deleted
+
+
+def recover(directory, batch_size, pause=0.0):
+    """Delete rows of the newest segment still in the database; returns how many"""
+    paths = segment_paths(directory)
+    if not paths:
+        return 0
+    with _Segment(paths[-1]) as segment:
+        ids = segment.column('id').tolist()
+    return _delete_archived(ids, batch_size, pause)
+
+
+def archive(older_than_days=None, directory=None, segment_rows=None, codec=None, batch_size=None,
+            pause=None, progress=None):
+    """
+    Move rolled-up AccessLogs older than ``older_than_days`` into segments
+    in ``directory``. ``progress(path, rows, size)`` is called after each
+    segment. Returns the number of rows moved.
+    """
+    options = retention.get_options()
+    older_than_days = options['COLD_AFTER_DAYS'] if older_than_days is None else older_than_days
+    directory = directory or options['SEGMENT_DIR']
+    segment_rows = segment_rows or options['SEGMENT_ROWS']
+    codec = codec or options['SEGMENT_CODEC']
+    batch_size = batch_size or options['BATCH_SIZE']
+    pause = options['PAUSE'] if pause is None else pause
+    if not directory:
+        raise ValueError('No segment directory configured')
+    if codec not in CODECS:
+        raise ValueError(f"codec must be one of {sorted(CODECS)}, got '{codec}'")
+    os.makedirs(directory, exist_ok=True)
+
+    rollups.roll_up()
+    recover(directory, batch_size, pause)
+    lookups = {
+        'timestamp__lt': timezone.now() - timedelta(days=older_than_days),
+        'id__lte': rollups.checkpoint(),
+    }
+
+    moved = 0
+    writer = SegmentWriter(codec)
+
+    def flush():
+        path = _next_path(directory)
+        size = writer.write(path)
+        deleted = _delete_archived(writer.columns['id'].values.tolist(), batch_size, pause)
+        if progress:
+            progress(path, len(writer), size)
+        return deleted
+
+    for batch in exports.batches(lookups, batch_size=min(batch_size, segment_rows)):
+        writer.add(batch)
+        if len(writer) >= segment_rows:
+            moved += flush()
+            writer = SegmentWriter(codec)
+    if len(writer):
+        moved += flush()
+    return moved
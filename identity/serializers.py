@@ -1,5 +1,7 @@
 from rest_framework import serializers
 from django.contrib.auth.models import User
+from django.db import transaction
+from . import projection
 from .models import Identity, FieldPermission, ContextPriority
 
 
@@ -13,9 +15,9 @@ class IdentitySerializer(serializers.ModelSerializer):
             'middle_name', 'preferred_name', 'display_name', 'pronouns',
             'title', 'suffix', 'nickname', 'avatar_url', 'bio', 'website',
             'email', 'phone', 'custom_attributes', 'visibility',
-            'is_primary', 'full_name', 'created_at', 'updated_at'
+            'is_primary', 'full_name', 'created_at', 'updated_at', 'version'
         ]
-        read_only_fields = ['id', 'created_at', 'updated_at', 'full_name']
+        read_only_fields = ['id', 'created_at', 'updated_at', 'full_name', 'version']
 
     def validate(self, data):
         """Custom validation for identity data"""
@@ -34,7 +36,30 @@ class IdentitySerializer(serializers.ModelSerializer):
 
     def create(self, validated_data):
         validated_data['user'] = self.context['request'].user
-        return super().create(validated_data)
+        return self.save_with_primary(validated_data, super().create)
+
+    def update(self, instance, validated_data):
+        return self.save_with_primary(
+            validated_data, lambda data: super(IdentitySerializer, self).update(instance, data), instance
+        )
+
+    @staticmethod
+    def save_with_primary(validated_data, save, instance=None):
+        """
+        ``save`` the identity; becoming primary goes through
+        ``Identity.objects.set_primary`` so the old primary is demoted,
+        and only when ``instance`` is not primary already
+        """
+        promote = bool(validated_data.get('is_primary'))
+        if promote:
+            del validated_data['is_primary']
+            promote = instance is None or not instance.is_primary
+        with transaction.atomic():
+            identity = save(validated_data)
+            if promote:
+                Identity.objects.set_primary(identity.user_id, identity.pk)
+                identity.refresh_from_db(fields=['is_primary', 'updated_at', 'version'])
+        return identity
 
 
 class ContextualIdentitySerializer(serializers.ModelSerializer):
@@ -47,10 +72,19 @@ class ContextualIdentitySerializer(serializers.ModelSerializer):
 
     def to_representation(self, instance):
         """Override to return contextual data"""
-        request = self.context.get('request')
-        requesting_user = request.user if request else None
+        return projection.project(instance, self.context.get('fields'))
 
-        return instance.get_contextual_data(requesting_user)
+
+class ResolveIdentitiesSerializer(serializers.Serializer):
+    """Input of the batch contextual lookup; context and locale default to the request headers"""
+    MAX_USER_IDS = 1000
+
+    user_ids = serializers.ListField(
+        child=serializers.IntegerField(min_value=1), allow_empty=False, max_length=MAX_USER_IDS
+    )
+    context = serializers.CharField(max_length=20, required=False)
+    locale = serializers.CharField(max_length=10, required=False)
+    fields = serializers.ListField(child=serializers.CharField(max_length=50), required=False, max_length=50)
 
 
 class FieldPermissionSerializer(serializers.ModelSerializer):
@@ -1,11 +1,19 @@
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.db.models import Sum
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_init, post_save, post_delete, pre_delete
 from django.dispatch import receiver
 from django.contrib.auth.models import User
-from .models import UserRole
+from . import search, stats
+from .cache import identity_cache
+from .models import UserRole, Identity, ContextPriority, AccessLog
 
 
 @receiver(post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
+    # The role row is written once, here; later User saves (every login
+    # updates last_login) leave it alone. Code that changes the role saves
+    # the UserRole itself.
     if created:
         UserRole.objects.create(
             user=instance,
@@ -13,12 +21,96 @@ def create_user_profile(sender, instance, created, **kwargs):
         )
 
 
+@receiver([post_save, post_delete], sender=Identity)
+@receiver([post_save, post_delete], sender=ContextPriority)
+def invalidate_identity_cache(sender, instance, **kwargs):
+    # Bump now so this transaction never reads stale entries, and again after
+    # commit so readers that cached pre-commit rows in between are discarded
+    user_id = instance.user_id
+    identity_cache.invalidate_user(user_id)
+    transaction.on_commit(lambda: identity_cache.invalidate_user(user_id))
+
+
+@receiver(post_save, sender=Identity)
+def index_identity(sender, instance, update_fields=None, **kwargs):
+    # Saves write only the changed fields; most edits do not touch the index
+    if update_fields is not None and not set(update_fields) & set(search.SEARCH_FIELDS['identity']):
+        return
+    search.index_object('identity', instance)
+
+
+@receiver(post_delete, sender=Identity)
+def unindex_identity(sender, instance, **kwargs):
+    search.remove_object('identity', instance.pk)
+
+
 @receiver(post_save, sender=User)
-def save_user_profile(sender, instance, **kwargs):
-    if hasattr(instance, 'profile'):
-        instance.profile.save()
-    else:
-        UserRole.objects.create(
-            user=instance,
-            role='admin' if instance.is_superuser else 'user'
-        )
+def index_user(sender, instance, update_fields=None, **kwargs):
+    # Logins only touch last_login; skip anything that cannot change the index
+    if update_fields is not None and not set(update_fields) & set(search.SEARCH_FIELDS['user']):
+        return
+    if search.index_object('user', instance) and not kwargs.get('created'):
+        # Identity documents include the username
+        for identity in instance.identities.all():
+            search.index_object('identity', identity)
+
+
+@receiver(post_delete, sender=User)
+def unindex_user(sender, instance, **kwargs):
+    search.remove_object('user', instance.pk)
+
+
+@receiver(post_init, sender=Identity)
+def remember_verification(sender, instance, **kwargs):
+    # Read from __dict__ so deferred loads never trigger a query
+    instance._stats_verified = instance.__dict__.get('is_verified')
+
+
+@receiver(post_save, sender=Identity)
+def count_identity(sender, instance, created, **kwargs):
+    if created:
+        stats.increment('identities')
+        if not instance.is_verified:
+            stats.increment('unverified_identities')
+    elif instance._stats_verified is not None and instance._stats_verified != instance.is_verified:
+        stats.increment('unverified_identities', -1 if instance.is_verified else 1)
+    instance._stats_verified = instance.is_verified
+
+
+@receiver(post_delete, sender=Identity)
+def uncount_identity(sender, instance, **kwargs):
+    stats.increment('identities', -1)
+    if not instance.is_verified:
+        stats.increment('unverified_identities', -1)
+
+
+@receiver(post_save, sender=User)
+def count_user(sender, instance, created, **kwargs):
+    if created:
+        stats.increment('users')
+
+
+@receiver(post_delete, sender=User)
+def uncount_user(sender, instance, **kwargs):
+    stats.increment('users', -1)
+
+
+# The cascade deletes access logs without signals, so an identity's or a
+# user's logs are deleted and uncounted here first. A row reached through
+# both is gone by the second receiver and never counted twice.
+@receiver(pre_delete, sender=Identity)
+def uncount_identity_access_logs(sender, instance, **kwargs):
+    _delete_access_logs(identity=instance)
+
+
+@receiver(pre_delete, sender=User)
+def uncount_user_access_logs(sender, instance, **kwargs):
+    _delete_access_logs(accessed_by=instance)
+
+
+def _delete_access_logs(**lookups):
+    logs = AccessLog.objects.filter(**lookups)
+    hits = logs.aggregate(n=Coalesce(Sum('hit_count'), 0))['n']
+    if hits:
+        logs.delete()
+        stats.increment('access_logs', -hits)
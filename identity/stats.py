@@ -0,0 +1,62 @@
+"""
+Dashboard counters.
+
+Totals shown on the dashboards live in ``StatCounter`` rows that are adjusted
+with ``UPDATE ... SET value = value + n`` in the same transaction as the
+change they count, so reading them costs one small query however large the
+counted tables grow. Writes that bypass model signals (``bulk_create``,
+``QuerySet.update``/``delete``, raw SQL) can make them drift; the
+``reconcile_stats`` command recounts and repairs them.
+"""
+from django.contrib.auth.models import User
+from django.db.models import Count, F, Q, Sum
+from django.db.models.functions import Coalesce
+
+from .models import AccessLog, Identity, StatCounter
+
+COUNTERS = [name for name, _ in StatCounter.NAME_CHOICES]
+
+
+def increment(name, delta=1):
+    """Add ``delta`` to counter ``name``, creating it if needed"""
+    if not delta:
+        return
+    if not StatCounter.objects.filter(name=name).update(value=F('value') + delta):
+        StatCounter.objects.get_or_create(name=name)
+        StatCounter.objects.filter(name=name).update(value=F('value') + delta)
+
+
+def get_counters():
+    """All counters as a dict, missing ones reading as 0"""
+    values = dict.fromkeys(COUNTERS, 0)
+    values.update(StatCounter.objects.values_list('name', 'value'))
+    return values
+
+
+def actual_counts():
+    """The counters' true values, counted from the source tables"""
+    identities = Identity.objects.aggregate(
+        identities=Count('id'),
+        unverified_identities=Count('id', filter=Q(is_verified=False)),
+    )
+    return {
+        'users': User.objects.count(),
+        'identities': identities['identities'],
+        'unverified_identities': identities['unverified_identities'],
+        # Coalesced rows stand for hit_count accesses each
+        'access_logs': AccessLog.objects.aggregate(n=Coalesce(Sum('hit_count'), 0))['n'],
+    }
+
+
+def reconcile():
+    """
+    Overwrite every counter with its true value. Returns a dict of
+    ``name: (stored, actual)`` for the counters that had drifted.
+    """
+    stored = get_counters()
+    drift = {}
+    for name, value in actual_counts().items():
+        if stored[name] != value:
+            drift[name] = (stored[name], value)
+        StatCounter.objects.update_or_create(name=name, defaults={'value': value})
+    return drift
@@ -0,0 +1,25 @@
+"""
+Test runner for the project.
+
+Settings that only make sense for the test suite are applied here, for the
+whole run, instead of being guessed from the command line in settings.py.
+"""
+from django.conf import settings
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+from .audit import access_log_writer
+
+class TestRunner(DiscoverRunner):
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        # Access logs are written in the request's transaction, so tests see them
+        audit = {**getattr(settings, 'IDENTITY_AUDIT', {}), 'SYNCHRONOUS': True}
+        self._overrides = override_settings(IDENTITY_AUDIT=audit)
+        self._overrides.enable()
+        self._synchronous, access_log_writer.synchronous = access_log_writer.synchronous, True
+
+    def teardown_test_environment(self, **kwargs):
+        access_log_writer.synchronous = self._synchronous
+        self._overrides.disable()
+        super().teardown_test_environment(**kwargs)
@@ -1,11 +1,43 @@
+import csv
+import gzip
+import io
 import json
+import os
+import re
+import tempfile
+import threading
+import time
+import zlib
+from datetime import timedelta
+from unittest import mock
 
 from django.contrib.auth.models import User
-from django.test import TestCase, Client
+from django.core.cache import cache, caches
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, connection, connections, transaction
+from django.db.models import Q, Sum
+from django.core.management import call_command, CommandError
+from django.test import SimpleTestCase, TestCase, Client, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 from oauth2_provider.models import Application
+from rest_framework.renderers import JSONRenderer
 
-from .models import Identity, FieldPermission, UserRole
+from .audit import AccessLogWriter
+from .cache import LocalLRU, get_cached_identity, identity_cache
+from . import search, stats
+from .models import (
+    Identity, FieldPermission, UserRole, ContextPriority, AccessLog, AccessLogRollup, AccessLogDailyRollup,
+    AccessorDailyRollup, SearchTrigram, StatCounter, UserAgent, VersionConflict,
+)
+from . import compact, exports, fastpath, negotiation, projection, retention, rollups, segments, streaming
+from .pagination import KeysetPaginator, InvalidCursor
+from .context_processors import global_context
+from .principal import get_principal
+from .serializers import ContextualIdentitySerializer, IdentitySerializer, ResolveIdentitiesSerializer
+from .resolution import resolve_identity, candidate_identities
+from .views.utils import is_admin_user
 
 
 class IdentityModelTestCase(TestCase):
@@ -642,6 +674,2226 @@ class SecurityTestCase(TestCase):
         pass
 
 
+class ContextResolutionTestCase(TestCase):
+    """Test cases for single-query contextual identity resolution"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='resolver', password='testpass')
+
+        self.legal = Identity.objects.create(
+            user=self.user, context='legal', locale='en-US',
+            given_name='John', family_name='Doe', is_primary=True
+        )
+        self.social_en = Identity.objects.create(
+            user=self.user, context='social', locale='en-US',
+            given_name='Johnny', family_name='Doe'
+        )
+        self.social_fr = Identity.objects.create(
+            user=self.user, context='social', locale='fr-FR',
+            given_name='Jean', family_name='Doe'
+        )
+        self.professional = Identity.objects.create(
+            user=self.user, context='professional', locale='en-US',
+            given_name='John', family_name='Doe'
+        )
+
+    def test_exact_context_and_locale(self):
+        """Exact context+locale match wins"""
+        self.assertEqual(resolve_identity(self.user.id, 'social', 'fr-FR'), self.social_fr)
+
+    def test_context_any_locale(self):
+        """Falls back to the same context in another locale"""
+        self.assertEqual(resolve_identity(self.user.id, 'social', 'de-DE'), self.social_en)
+
+    def test_primary_fallback(self):
+        """Falls back to the primary identity when the context is missing"""
+        self.assertEqual(resolve_identity(self.user.id, 'display', 'en-US'), self.legal)
+
+    def test_inactive_identities_ignored(self):
+        """Inactive identities are never resolved"""
+        Identity.objects.filter(pk=self.legal.pk).update(is_active=False)
+        self.assertIsNone(resolve_identity(self.user.id, 'display', 'en-US'))
+
+    def test_context_priority_before_primary(self):
+        """ContextPriority rows are tried before the primary identity"""
+        ContextPriority.objects.create(user=self.user, context='professional', priority=1)
+        ContextPriority.objects.create(user=self.user, context='social', priority=2)
+
+        self.assertEqual(resolve_identity(self.user.id, 'display', 'en-US'), self.professional)
+        # Requested context still beats any priority
+        self.assertEqual(resolve_identity(self.user.id, 'legal', 'en-US'), self.legal)
+
+    def test_single_query(self):
+        """Resolution issues exactly one query"""
+        with self.assertNumQueries(1):
+            resolve_identity(self.user.id, 'display', 'fr-FR')
+
+    def test_view_uses_resolution(self):
+        """ContextualIdentityView resolves and distinguishes unknown users"""
+        self.client.login(username='resolver', password='testpass')
+
+        url = reverse('contextual-identity', kwargs={'user_id': self.user.id})
+        response = self.client.get(url, HTTP_ACCEPT_CONTEXT='social', HTTP_ACCEPT_LANGUAGE='fr-FR')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['id'], self.social_fr.id)
+
+        url = reverse('contextual-identity', kwargs={'user_id': 999999})
+        response = self.client.get(url, HTTP_ACCEPT_CONTEXT='social')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json()['error'], 'User not found')
+
+
+class IdentityCacheTestCase(TestCase):
+    """Test cases for the versioned two-tier identity cache"""
+
+    def setUp(self):
+        # Off unless a shared backend is configured; the default alias stands in for one here
+        patcher = mock.patch.object(identity_cache, 'alias', 'default')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        cache.clear()
+        identity_cache.clear()
+
+        self.user = User.objects.create_user(username='cached', password='testpass')
+        self.identity = Identity.objects.create(
+            user=self.user, context='social', given_name='Jane', family_name='Doe', is_primary=True
+        )
+
+    def test_read_through(self):
+        """Second lookup is served from the local tier without queries"""
+        self.assertEqual(get_cached_identity(self.user.id, 'social', 'en-US'), self.identity)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(get_cached_identity(self.user.id, 'social', 'en-US'), self.identity)
+
+        stats = identity_cache.stats()
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['local_hits'], 1)
+
+    def test_shared_tier_hit(self):
+        """A cold local tier falls through to the shared backend"""
+        get_cached_identity(self.user.id, 'social')
+        identity_cache.local.clear()
+
+        with self.assertNumQueries(0):
+            get_cached_identity(self.user.id, 'social')
+        self.assertEqual(identity_cache.stats()['shared_hits'], 1)
+
+    def test_local_hit_skips_shared_tier(self):
+        """A remembered version and a local entry need no shared cache round trip"""
+        get_cached_identity(self.user.id, 'social')
+
+        with mock.patch.object(caches['default'], 'get', side_effect=AssertionError('shared read')):
+            self.assertEqual(get_cached_identity(self.user.id, 'social'), self.identity)
+
+    def test_other_workers_see_bump_after_ttl(self):
+        """A version bumped elsewhere is picked up once the remembered copy expires"""
+        get_cached_identity(self.user.id, 'social')
+        Identity.objects.filter(pk=self.identity.pk).update(given_name='Janet')
+        cache.incr(identity_cache.version_key(self.user.id))
+
+        self.assertEqual(get_cached_identity(self.user.id, 'social').given_name, 'Jane')
+        with mock.patch('identity.cache.time.monotonic', return_value=time.monotonic() + 60):
+            self.assertEqual(get_cached_identity(self.user.id, 'social').given_name, 'Janet')
+
+    def test_disabled_without_alias(self):
+        """With no shared backend every lookup resolves from the database"""
+        with mock.patch.object(identity_cache, 'alias', None):
+            get_cached_identity(self.user.id, 'social')
+            with self.assertNumQueries(1):
+                self.assertEqual(get_cached_identity(self.user.id, 'social'), self.identity)
+        self.assertEqual(identity_cache.stats()['local_size'], 0)
+
+    def test_save_invalidates(self):
+        """Saving an identity bumps the user's version"""
+        get_cached_identity(self.user.id, 'social')
+
+        self.identity.given_name = 'Janet'
+        self.identity.save()
+
+        self.assertEqual(get_cached_identity(self.user.id, 'social').given_name, 'Janet')
+
+    def test_context_priority_invalidates(self):
+        """Creating or deleting a ContextPriority invalidates cached fallbacks"""
+        legal = Identity.objects.create(
+            user=self.user, context='legal', given_name='Jane', family_name='Doe'
+        )
+        self.assertEqual(get_cached_identity(self.user.id, 'display'), self.identity)
+
+        priority = ContextPriority.objects.create(user=self.user, context='legal', priority=0)
+        self.assertEqual(get_cached_identity(self.user.id, 'display'), legal)
+
+        priority.delete()
+        self.assertEqual(get_cached_identity(self.user.id, 'display'), self.identity)
+
+    def test_negative_result_cached(self):
+        """A missing identity is cached too, and cleared by a new identity"""
+        other = User.objects.create_user(username='empty')
+        self.assertIsNone(get_cached_identity(other.id, 'social'))
+
+        with self.assertNumQueries(0):
+            self.assertIsNone(get_cached_identity(other.id, 'social'))
+
+        created = Identity.objects.create(user=other, context='social', given_name='E', family_name='M')
+        self.assertEqual(get_cached_identity(other.id, 'social'), created)
+
+    def test_local_eviction(self):
+        """The local tier is bounded and counts evictions"""
+        lru = LocalLRU(maxsize=2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual(lru.get('a'), 1)
+        self.assertEqual(lru.evictions, 1)
+
+
+class AccessLogWriterTestCase(TestCase):
+    """Test cases for the buffered AccessLog writer"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='audited', password='testpass')
+        self.identity = Identity.objects.create(
+            user=self.user, context='social', given_name='Ada', family_name='L', is_primary=True
+        )
+
+    def make_writer(self, **kwargs):
+        writer = AccessLogWriter(**kwargs)
+        # Drive the queue by hand instead of from the background thread
+        patcher = mock.patch.object(writer, '_ensure_started')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return writer
+
+    def log(self, writer):
+        writer.log(
+            identity_id=self.identity.id,
+            accessed_by_id=self.user.id,
+            accessed_fields=['contextual_data'],
+            access_context='social',
+            ip_address='127.0.0.1',
+            user_agent='tests',
+        )
+
+    def test_view_logs_synchronously_under_test(self):
+        """ContextualIdentityView rows are visible immediately in test mode"""
+        self.client.login(username='audited', password='testpass')
+        url = reverse('contextual-identity', kwargs={'user_id': self.user.id})
+        self.client.get(url, HTTP_ACCEPT_CONTEXT='social', HTTP_USER_AGENT='agent/1.0')
+
+        log = AccessLog.objects.get(identity=self.identity)
+        self.assertEqual(log.accessed_by, self.user)
+        self.assertEqual(log.user_agent, 'agent/1.0')
+
+    def test_flush_writes_one_batch(self):
+        """Queued rows are written with a single bulk insert and one counter update"""
+        # Past the first committed write the user agent id comes from the interner's cache
+        with self.captureOnCommitCallbacks(execute=True):
+            compact.user_agents.intern('tests')
+        self.addCleanup(compact.user_agents.clear)
+        writer = self.make_writer(batch_size=100)
+        for _ in range(5):
+            self.log(writer)
+        self.assertEqual(AccessLog.objects.count(), 0)
+
+        with CaptureQueriesContext(connection) as queries:
+            writer.flush()
+        statements = [query['sql'].split()[0] for query in queries if 'SAVEPOINT' not in query['sql']]
+        self.assertEqual(statements, ['INSERT', 'UPDATE'])
+        self.assertEqual(AccessLog.objects.count(), 5)
+        self.assertEqual(writer.stats()['written'], 5)
+
+    def test_failing_row_drops_only_itself(self):
+        """A batch the database rejects is retried row by row; only the bad row is lost, and logged"""
+        for coalesce_window in (0, 60):
+            AccessLog.objects.all().delete()
+            writer = self.make_writer(batch_size=100, coalesce_window=coalesce_window)
+            self.log(writer)
+            # accessed_by is NOT NULL
+            writer.log(identity_id=self.identity.id, accessed_by_id=None, access_context='legal', user_agent='bad')
+            self.log(writer)
+            with self.assertLogs('identity.audit', 'WARNING') as logs:
+                writer.flush()
+            self.assertEqual(AccessLog.objects.aggregate(n=Sum('hit_count'))['n'], 2)
+            self.assertEqual((writer.stats()['written'], writer.stats()['failed']), (2, 1))
+            [dropped] = [line for line in logs.output if line.startswith('ERROR')]
+            self.assertIn(f'identity {self.identity.id} by user None', dropped)
+
+    def test_rolled_back_rows_are_inserted_again(self):
+        """A retried row gets a fresh id instead of overwriting the row that reused its rolled-back one"""
+        for coalesce_window in (0, 60):
+            AccessLog.objects.all().delete()
+            writer = self.make_writer(batch_size=100, coalesce_window=coalesce_window)
+            self.log(writer)
+            writer.log(identity_id=self.identity.id, accessed_by_id=self.user.id, access_context='legal',
+                       user_agent='other')
+            concurrent = []
+
+            def another_writer(*args, **kwargs):
+                concurrent.append(AccessLog.objects.create(
+                    identity=self.identity, accessed_by=self.user, access_context='display', hit_count=7,
+                ))
+
+            # The batch's inserts succeed, then the transaction rolls back
+            with mock.patch('identity.stats.increment', side_effect=[RuntimeError, None, None]), \
+                    mock.patch('identity.audit.logger.warning', side_effect=another_writer):
+                writer.flush()
+            self.assertEqual(AccessLog.objects.get(pk=concurrent[0].pk).hit_count, 7)
+            self.assertEqual(
+                sorted(AccessLog.objects.values_list('access_context', 'hit_count')),
+                [('display', 7), ('legal', 1), ('social', 1)],
+            )
+            self.assertEqual((writer.stats()['written'], writer.stats()['failed']), (2, 0))
+
+    def test_failing_row_raises_when_synchronous(self):
+        writer = AccessLogWriter(synchronous=True)
+        with self.assertLogs('identity.audit', 'ERROR'), self.assertRaises(IntegrityError), transaction.atomic():
+            writer.log(identity_id=self.identity.id, accessed_by_id=None, access_context='legal', user_agent='bad')
+        self.assertEqual(writer.stats()['failed'], 1)
+
+    def test_overflow_drop(self):
+        """The drop policy discards and counts rows when the queue is full"""
+        writer = self.make_writer(queue_size=2, overflow='drop')
+        for _ in range(5):
+            self.log(writer)
+
+        self.assertEqual(writer.stats()['dropped'], 3)
+        writer.flush()
+        self.assertEqual(AccessLog.objects.count(), 2)
+
+    def test_overflow_sync(self):
+        """The sync policy writes overflowing rows in the calling thread"""
+        writer = self.make_writer(queue_size=2, overflow='sync')
+        for _ in range(5):
+            self.log(writer)
+
+        self.assertEqual(writer.stats()['sync_fallbacks'], 3)
+        self.assertEqual(AccessLog.objects.count(), 3)
+
+    def test_invalid_overflow_policy(self):
+        with self.assertRaises(ValueError):
+            AccessLogWriter(overflow='ignore')
+
+    def test_coalesces_repeated_accesses(self):
+        """Identical accesses within the window share one row counting all of them"""
+        writer = AccessLogWriter(synchronous=True, coalesce_window=60)
+        before = stats.get_counters()['access_logs']
+        start = timezone.now()
+        for second in (0, 10, 20):
+            writer.log(identity_id=self.identity.id, accessed_by_id=self.user.id, access_context='social',
+                       ip_address='10.0.0.1', user_agent='poller', timestamp=start + timedelta(seconds=second))
+        writer.log(identity_id=self.identity.id, accessed_by_id=self.user.id, access_context='social',
+                   ip_address='10.0.0.2', user_agent='poller', timestamp=start)
+
+        rows = list(AccessLog.objects.order_by('id').values_list('ip', 'hit_count', 'timestamp', 'last_seen'))
+        self.assertEqual([(bytes(ip), hits) for ip, hits, _, _ in rows], [(b'\n\x00\x00\x01', 3), (b'\n\x00\x00\x02', 1)])
+        self.assertEqual(rows[0][2:], (start, start + timedelta(seconds=20)))
+        self.assertEqual(stats.get_counters()['access_logs'] - before, 4)
+        self.assertEqual(writer.stats()['coalesced'], 2)
+        self.assertEqual(stats.reconcile(), {})
+
+    def test_coalescing_window_closes(self):
+        """An access past the window starts a new row; closed windows are forgotten"""
+        writer = AccessLogWriter(synchronous=True, coalesce_window=60)
+        start = timezone.now() - timedelta(seconds=30)
+        for second in (0, 30, 61, 90):
+            writer.log(identity_id=self.identity.id, accessed_by_id=self.user.id, access_context='social',
+                       user_agent='poller', timestamp=start + timedelta(seconds=second))
+        self.assertEqual(list(AccessLog.objects.order_by('id').values_list('hit_count', flat=True)), [2, 2])
+        self.assertEqual(writer.stats()['open_windows'], 1)
+        writer.windows.expire(start + timedelta(seconds=200))
+        self.assertEqual(writer.stats()['open_windows'], 0)
+
+    def test_coalesced_rows_are_upserted_per_flush(self):
+        """Later hits update the row already written with one upsert"""
+        writer = self.make_writer(batch_size=100, coalesce_window=60)
+        self.log(writer)
+        writer.flush()
+        for _ in range(4):
+            self.log(writer)
+        with CaptureQueriesContext(connection) as queries:
+            writer.flush()
+        upserts = [query['sql'] for query in queries if query['sql'].startswith('INSERT')]
+        self.assertEqual(len(upserts), 1)
+        self.assertIn('ON CONFLICT', upserts[0])
+        self.assertEqual(list(AccessLog.objects.values_list('hit_count', flat=True)), [5])
+
+    def test_coalescing_max_keys(self):
+        """Accesses past the open-window limit are written uncoalesced"""
+        writer = AccessLogWriter(synchronous=True, coalesce_window=60, coalesce_max_keys=1)
+        for context in ('social', 'legal', 'legal'):
+            writer.log(identity_id=self.identity.id, accessed_by_id=self.user.id, access_context=context,
+                       user_agent='poller')
+        self.assertEqual(AccessLog.objects.count(), 3)
+        self.assertEqual(writer.stats()['open_windows'], 1)
+
+
+class QueryPlanTestCase(TestCase):
+    """EXPLAIN the hot queries and fail if any of them falls back to a table scan"""
+
+    @classmethod
+    def setUpTestData(cls):
+        users = User.objects.bulk_create(User(username=f'plan{i}') for i in range(200))
+        Identity.objects.bulk_create(
+            Identity(
+                user=user, context=context, given_name='G', family_name='F',
+                visibility='public' if j % 2 else 'private', is_primary=(j == 0),
+            )
+            for user in users
+            for j, context in enumerate(['legal', 'social', 'professional'])
+        )
+        identity = Identity.objects.first()
+        AccessLog.objects.bulk_create(
+            AccessLog(
+                identity=identity, accessed_by=users[0], access_context='social',
+                ip_address='127.0.0.1', user_agent='tests',
+            )
+            for _ in range(500)
+        )
+        cls.user = users[100]
+
+    def lookups(self):
+        """Per-user queries; sorting the handful of matching rows is fine"""
+        user = self.user
+        return {
+            'resolution candidates': candidate_identities([user.id]),
+            'context lookup': Identity.objects.filter(user=user, context='social', is_active=True),
+            'primary lookup': Identity.objects.filter(user=user, is_primary=True, is_active=True),
+            'public identities': Identity.objects.filter(user=user, visibility='public', is_active=True),
+        }
+
+    def listings(self):
+        """Whole-table listings; these must walk an index in order, not sort"""
+        return {
+            'recent identities': Identity.objects.select_related('user').order_by('-created_at')[:10],
+            'identity management': Identity.objects.select_related('user').order_by('-created_at', '-id')[:20],
+            'recent access logs': AccessLog.objects.order_by('-timestamp')[:10],
+            'user management': User.objects.order_by('-date_joined', '-id')[:20],
+        }
+
+    def assertUsesIndex(self, name, queryset, allow_sort=True):
+        plan = queryset.explain()
+        if connection.vendor == 'sqlite':
+            lines = plan.splitlines()
+            bad = [
+                line for line in lines
+                if re.search(r'\bSCAN (identity_identity|identity_accesslog)\b', line) and 'USING' not in line
+            ]
+            if not allow_sort:
+                bad += [line for line in lines if 'USE TEMP B-TREE FOR ORDER BY' in line]
+            self.assertFalse(bad, f'{name} is not using an index:\n{plan}')
+        elif connection.vendor == 'postgresql':
+            self.assertNotIn('Seq Scan on identity_', plan, f'{name} is not using an index:\n{plan}')
+        else:
+            self.skipTest(f'No plan checks for {connection.vendor}')
+
+    def test_lookups_use_indexes(self):
+        for name, queryset in self.lookups().items():
+            with self.subTest(query=name):
+                self.assertUsesIndex(name, queryset)
+
+    def test_listings_use_ordered_indexes(self):
+        for name, queryset in self.listings().items():
+            with self.subTest(query=name):
+                self.assertUsesIndex(name, queryset, allow_sort=False)
+
+
+class KeysetPaginationTestCase(TestCase):
+    """Test cases for keyset (cursor) pagination"""
+
+    def setUp(self):
+        cache.clear()  # estimated counts are cached per query
+        self.user = User.objects.create_user(username='pager', password='testpass')
+        locales = ['en-US', 'fr-FR', 'de-DE', 'es-ES', 'it-IT']
+        contexts = ['legal', 'social', 'professional']
+        for locale in locales:
+            for context in contexts:
+                Identity.objects.create(
+                    user=self.user, context=context, locale=locale,
+                    given_name='P', family_name=locale, visibility='public'
+                )
+        self.queryset = Identity.objects.filter(user=self.user)
+
+    def walk(self, paginator):
+        seen = []
+        page = paginator.get_page()
+        pages = [page]
+        seen.extend(page)
+        while page.has_next():
+            page = paginator.get_page(page.next_cursor)
+            pages.append(page)
+            seen.extend(page)
+        return seen, pages
+
+    def test_forward_walk_covers_every_row_once(self):
+        paginator = KeysetPaginator(self.queryset, 4)
+        seen, pages = self.walk(paginator)
+
+        expected = list(self.queryset.order_by('-created_at', '-id'))
+        self.assertEqual(seen, expected)
+        self.assertEqual([len(page) for page in pages], [4, 4, 4, 3])
+        self.assertFalse(pages[0].has_previous())
+
+    def test_previous_cursor_returns_previous_page(self):
+        paginator = KeysetPaginator(self.queryset, 4)
+        first = paginator.get_page()
+        second = paginator.get_page(first.next_cursor)
+
+        back = paginator.get_page(second.previous_cursor)
+        self.assertEqual(list(back), list(first))
+        self.assertFalse(back.has_previous())
+        self.assertTrue(back.has_next())
+
+    def test_stable_under_concurrent_inserts(self):
+        """Rows inserted while paging do not shift later pages"""
+        paginator = KeysetPaginator(self.queryset, 5)
+        first = paginator.get_page()
+        expected_second = list(paginator.get_page(first.next_cursor))
+
+        Identity.objects.create(user=self.user, context='display', given_name='N', family_name='New')
+
+        self.assertEqual(list(paginator.get_page(first.next_cursor)), expected_second)
+
+    def test_tampered_cursor_rejected(self):
+        paginator = KeysetPaginator(self.queryset, 4)
+        cursor = paginator.get_page().next_cursor
+
+        with self.assertRaises(InvalidCursor):
+            paginator.get_page(cursor[:-2] + 'xx')
+        with self.assertRaises(InvalidCursor):
+            KeysetPaginator(self.queryset, 4, salt='other').get_page(cursor)
+
+    def test_no_count_query_unless_requested(self):
+        with self.assertNumQueries(1):
+            KeysetPaginator(self.queryset, 4).get_page()
+
+    def test_api_list_is_paginated(self):
+        self.client.login(username='pager', password='testpass')
+        url = reverse('identity-list-create')
+
+        data = self.client.get(url, {'page_size': 10, 'count': 'true'}).json()
+        self.assertEqual(len(data['results']), 10)
+        self.assertEqual(data['count'], 15)
+        self.assertIsNone(data['previous'])
+
+        data = self.client.get(data['next']).json()
+        self.assertEqual(len(data['results']), 5)
+        self.assertIsNone(data['next'])
+
+        response = self.client.get(url, {'cursor': 'bogus'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_user_identities_is_paginated(self):
+        self.client.login(username='pager', password='testpass')
+        url = reverse('user-identities', kwargs={'user_id': self.user.id})
+
+        data = self.client.get(url, {'page_size': 6}).json()
+        self.assertEqual(len(data['results']), 6)
+        self.assertIsNotNone(data['next'])
+
+    def test_admin_identity_management_pages(self):
+        User.objects.create_superuser(username='boss', password='boss', email='boss@example.com')
+        self.client.login(username='boss', password='boss')
+        url = reverse('identity-management')
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        page = response.context['page_obj']
+        self.assertEqual(len(page), 15)
+        self.assertEqual(page.count, 15)
+
+        # Invalid cursors fall back to the first page
+        response = self.client.get(url, {'cursor': 'bogus'})
+        self.assertEqual(response.status_code, 200)
+
+
+class SearchIndexTestCase(TestCase):
+    """Test cases for the trigram search index"""
+
+    def setUp(self):
+        self.alice = User.objects.create_user(
+            username='alice', email='alice@example.com', first_name='Alice', last_name='Liddell'
+        )
+        self.bob = User.objects.create_user(
+            username='bobby', email='bob@corp.io', first_name='Bob', last_name='Alison'
+        )
+        self.alice_identity = Identity.objects.create(
+            user=self.alice, context='legal', given_name='Alice', family_name='Liddell',
+            email='a.liddell@example.com'
+        )
+        self.bob_identity = Identity.objects.create(
+            user=self.bob, context='social', given_name='Robert', family_name='Alison'
+        )
+
+    def legacy_identity_search(self, query):
+        return Identity.objects.filter(
+            Q(given_name__icontains=query) |
+            Q(family_name__icontains=query) |
+            Q(email__icontains=query) |
+            Q(user__username__icontains=query)
+        )
+
+    def test_matches_legacy_filter(self):
+        """Single-term results are identical to the old icontains filter"""
+        for query in ['ali', 'AL', 'l', 'liddell', 'example.com', 'bobby', 'son', 'zzz']:
+            with self.subTest(query=query):
+                self.assertEqual(
+                    set(search.search(Identity.objects.all(), 'identity', query)),
+                    set(self.legacy_identity_search(query)),
+                )
+
+    def test_matches_last_character(self):
+        """A one-character term found only at the end of a field"""
+        xy = User.objects.create_user(username='xy')
+        self.assertEqual(set(search.search(User.objects.all(), 'user', 'y')), {xy, self.bob})
+        self.assertEqual(
+            set(search.search(Identity.objects.all(), 'identity', 'y')),
+            set(self.legacy_identity_search('y')),
+        )
+
+    def test_unselective_terms_fall_back_to_filter(self):
+        with mock.patch.object(search, 'SELECTIVE_LIMIT', 1):
+            self.assertIsNone(search.term_candidates('identity', 'ali'))
+            self.assertEqual(
+                set(search.search(Identity.objects.all(), 'identity', 'ali')),
+                set(self.legacy_identity_search('ali')),
+            )
+
+    def test_multiple_terms_are_anded(self):
+        results = search.search(User.objects.all(), 'user', 'ali son')
+        self.assertEqual(list(results), [self.bob])
+
+    def test_ranking_prefers_prefix_matches(self):
+        """'ali' is a prefix of Alice's fields but only a word prefix of Bob's surname"""
+        results = search.ranked_search('user', 'ali')
+        self.assertEqual(results, [self.alice, self.bob])
+
+        results = search.ranked_search('user', 'alison')
+        self.assertEqual(results, [self.bob])
+
+    def test_signals_keep_index_in_sync(self):
+        self.bob_identity.given_name = 'Zebediah'
+        self.bob_identity.save()
+        self.assertEqual(list(search.search(Identity.objects.all(), 'identity', 'zebed')), [self.bob_identity])
+        self.assertFalse(search.search(Identity.objects.all(), 'identity', 'robert').exists())
+
+        # Renaming a user reindexes their identities
+        self.bob.username = 'roberto'
+        self.bob.save()
+        self.assertEqual(list(search.search(Identity.objects.all(), 'identity', 'roberto')), [self.bob_identity])
+
+        self.bob_identity.delete()
+        self.assertFalse(SearchTrigram.objects.filter(kind='identity', object_id=self.bob_identity.pk).exists())
+
+    def test_login_does_not_touch_index(self):
+        self.alice.set_password('pw')
+        self.alice.save()
+        with mock.patch('identity.search.index_object') as index_object:
+            self.client.login(username='alice', password='pw')
+        index_object.assert_not_called()
+
+    def test_rebuild(self):
+        SearchTrigram.objects.all().delete()
+        counts = search.rebuild()
+        self.assertGreater(counts['identity'], 0)
+        self.assertEqual(list(search.search(User.objects.all(), 'user', 'corp')), [self.bob])
+
+    def test_admin_typeahead(self):
+        User.objects.create_superuser(username='root', password='root', email='root@example.com')
+        self.client.login(username='root', password='root')
+
+        data = self.client.get(reverse('admin-search-ajax'), {'q': 'lid', 'kind': 'identity'}).json()
+        self.assertEqual([row['id'] for row in data['results']], [self.alice_identity.id])
+
+        response = self.client.get(reverse('admin-search-ajax'), {'q': 'x', 'kind': 'nope'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_admin_identity_management_search(self):
+        User.objects.create_superuser(username='root', password='root', email='root@example.com')
+        self.client.login(username='root', password='root')
+
+        response = self.client.get(reverse('identity-management'), {'search': 'liddell'})
+        self.assertEqual(list(response.context['page_obj']), [self.alice_identity])
+
+
+class QueryCountTestCase(TestCase):
+    """Admin and dashboard pages issue a fixed number of queries regardless of row count"""
+
+    SIZES = (20, 200, 2000)
+
+    def setUp(self):
+        self.admin = User.objects.create_superuser(username='root', password='root', email='root@example.com')
+        self.client.login(username='root', password='root')
+
+    def seed(self, rows):
+        """Add ``rows`` users, each with an identity, plus ``rows`` identities and logs for the admin"""
+        users = User.objects.bulk_create(User(username=f'u{rows}-{i}') for i in range(rows))
+        Identity.objects.bulk_create(
+            Identity(user=user, context='social', given_name='G', family_name='F') for user in users
+        )
+        Identity.objects.bulk_create(
+            Identity(user=self.admin, context='social', locale=f'l{rows}-{i}', given_name='A', family_name='B', is_verified=i % 2 == 0)
+            for i in range(rows)
+        )
+        identity = Identity.objects.filter(user=self.admin).first()
+        AccessLog.objects.bulk_create(
+            AccessLog(identity=identity, accessed_by=self.admin, access_context='social',
+                      ip_address='127.0.0.1', user_agent='tests')
+            for _ in range(rows)
+        )
+
+
+    def assertConstantQueries(self, expected, url_name, **kwargs):
+        for rows in self.SIZES:
+            with self.subTest(rows=rows):
+                self.seed(rows)
+                with self.assertNumQueries(expected):
+                    response = self.client.get(reverse(url_name, kwargs=kwargs))
+                self.assertEqual(response.status_code, 200)
+                # Rows accumulate across sizes; drop the cached page count
+                cache.clear()
+
+    def test_dashboard(self):
+        # session, user, identities, counters
+        self.assertConstantQueries(4, 'dashboard')
+
+    def test_admin_dashboard(self):
+        # session, user, counters, daily and accessor rollups, recent identities, recent users + roles
+        self.assertConstantQueries(7, 'admin-dashboard')
+
+    def test_user_management(self):
+        # session, user, user + role, page of users with identity counts, count
+        self.assertConstantQueries(4, 'user-management')
+
+    def test_user_detail_admin(self):
+        # session, user, viewed user + role, identities
+        self.assertConstantQueries(4, 'user-detail-admin', user_id=self.admin.pk)
+
+
+class StatCounterTestCase(TestCase):
+    """Dashboard counters follow the tables they count"""
+
+    def setUp(self):
+        stats.reconcile()
+        self.before = stats.get_counters()
+
+    def delta(self):
+        after = stats.get_counters()
+        return {name: after[name] - self.before[name] for name in after if after[name] != self.before[name]}
+
+    def test_user_and_identity_lifecycle(self):
+        user = User.objects.create_user(username='counted', password='pw')
+        identity = Identity.objects.create(user=user, context='social', given_name='A', family_name='B')
+        self.assertEqual(self.delta(), {'users': 1, 'identities': 1, 'unverified_identities': 1})
+
+        identity.is_verified = True
+        identity.save()
+        identity.save()
+        self.assertEqual(self.delta(), {'users': 1, 'identities': 1})
+
+        # Cascades from the user delete fire per-row signals
+        user.delete()
+        self.assertEqual(self.delta(), {})
+
+    def test_login_does_not_count(self):
+        User.objects.create_user(username='counted', password='pw')
+        self.before = stats.get_counters()
+        self.client.login(username='counted', password='pw')
+        self.assertEqual(self.delta(), {})
+
+    def test_verify_identity_view(self):
+        admin = User.objects.create_superuser(username='root', password='root', email='root@example.com')
+        identity = Identity.objects.create(user=admin, context='legal', given_name='A', family_name='B')
+        self.client.login(username='root', password='root')
+        self.client.post(reverse('verify-identity', args=[identity.id]))
+        self.assertEqual(self.delta(), {'users': 1, 'identities': 1})
+
+    def test_access_log_writer(self):
+        user = User.objects.create_user(username='counted')
+        identity = Identity.objects.create(user=user, context='social', given_name='A', family_name='B')
+        self.before = stats.get_counters()
+        writer = AccessLogWriter(synchronous=False, batch_size=100)
+        for _ in range(3):
+            writer.log(identity_id=identity.id, accessed_by_id=user.id, access_context='social',
+                       ip_address='127.0.0.1', user_agent='tests')
+        writer.flush()
+        self.assertEqual(self.delta(), {'access_logs': 3})
+
+    def test_cascaded_access_logs_are_uncounted(self):
+        owner = User.objects.create_user(username='owner')
+        viewer = User.objects.create_user(username='viewer')
+        mine, theirs = (
+            Identity.objects.create(user=user, context='social', given_name='A', family_name='B')
+            for user in (owner, viewer)
+        )
+        for identity, accessed_by, hits in ((mine, owner, 2), (mine, viewer, 3), (theirs, owner, 4), (theirs, viewer, 5)):
+            AccessLog.objects.create(identity=identity, accessed_by=accessed_by, access_context='social', hit_count=hits)
+        stats.reconcile()
+
+        mine.delete()
+        self.assertEqual(stats.get_counters()['access_logs'], 9)
+        # Reached through both the viewer and their identity, counted once
+        viewer.delete()
+        self.assertEqual(stats.get_counters()['access_logs'], 0)
+        self.assertEqual(stats.reconcile(), {})
+
+    def test_reconcile_repairs_drift(self):
+        user = User.objects.create_user(username='counted')
+        Identity.objects.bulk_create([Identity(user=user, context='social', given_name='A', family_name='B')])
+        StatCounter.objects.filter(name='access_logs').update(value=-5)
+
+        drift = stats.reconcile()
+        self.assertEqual(set(drift), {'identities', 'unverified_identities', 'access_logs'})
+        self.assertEqual(stats.get_counters(), stats.actual_counts())
+        call_command('reconcile_stats', stdout=mock.MagicMock())
+        self.assertEqual(stats.get_counters(), stats.actual_counts())
+
+    def test_dashboard_reads_counters(self):
+        admin = User.objects.create_superuser(username='root', password='root', email='root@example.com')
+        self.client.login(username='root', password='root')
+        StatCounter.objects.filter(name='users').update(value=12345)
+        response = self.client.get(reverse('admin-dashboard'))
+        self.assertEqual(response.context['total_users'], 12345)
+
+
+class PrincipalTestCase(TestCase):
+    """Role checks load the requesting user's role once per request"""
+
+    def setUp(self):
+        self.manager = User.objects.create_user(username='manager', password='pw')
+        UserRole.objects.filter(user=self.manager).update(role='admin', can_manage_users=True)
+        self.client.login(username='manager', password='pw')
+
+    def role_loads(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return [
+            query['sql'] for query in queries
+            if 'identity_userrole' in query['sql'] and f'"auth_user"."id" = {self.manager.pk}' in query['sql']
+            or query['sql'].startswith('SELECT "identity_userrole"')
+        ]
+
+    def test_admin_pages_load_profile_once(self):
+        for name in ('dashboard', 'admin-dashboard', 'user-management', 'identity-management'):
+            with self.subTest(name=name):
+                loads = self.role_loads(reverse(name))
+                self.assertEqual(len(loads), 1)
+                # Loaded together with the session user
+                self.assertIn('JOIN "identity_userrole"', loads[0])
+
+    def test_flags_are_memoized(self):
+        user = User.objects.get(pk=self.manager.pk)
+        principal = get_principal(user)
+        with self.assertNumQueries(1):
+            for _ in range(3):
+                self.assertTrue(principal.is_admin)
+                self.assertTrue(principal.can_manage_users)
+                self.assertFalse(principal.can_view_all_identities)
+        self.assertIs(get_principal(user), principal)
+
+    def test_anonymous_and_roleless_users(self):
+        from django.contrib.auth.models import AnonymousUser
+        self.assertFalse(get_principal(AnonymousUser()).can_access_admin_panel)
+
+        user = User.objects.create_user(username='plain')
+        UserRole.objects.filter(user=user).delete()
+        user = User.objects.get(pk=user.pk)
+        self.assertIsNone(get_principal(user).role)
+        self.assertFalse(get_principal(user).is_admin)
+
+    def test_checks_share_principal(self):
+        request = mock.Mock(user=User.objects.select_related('profile').get(pk=self.manager.pk))
+        with self.assertNumQueries(0):
+            self.assertTrue(is_admin_user(request.user))
+            self.assertTrue(global_context(request)['is_admin'])
+            self.assertTrue(get_principal(request.user).can_access_admin_panel)
+
+
+class UserRoleLifecycleTestCase(TestCase):
+    """The UserRole row is written on user creation and when its own fields change"""
+
+    def role_writes(self, queries):
+        return [
+            query['sql'] for query in queries
+            if query['sql'].startswith(('INSERT', 'UPDATE', 'DELETE')) and 'identity_userrole' in query['sql']
+        ]
+
+    def test_created_once(self):
+        with CaptureQueriesContext(connection) as queries:
+            user = User.objects.create_user(username='fresh', password='pw')
+        self.assertEqual(len(self.role_writes(queries)), 1)
+        self.assertEqual(UserRole.objects.get(user=user).role, 'user')
+
+        admin = User.objects.create_superuser(username='boss', password='pw', email='boss@example.com')
+        self.assertEqual(admin.profile.role, 'admin')
+
+    def test_login_does_not_write_role(self):
+        User.objects.create_user(username='fresh', password='pw')
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(self.client.login(username='fresh', password='pw'))
+            self.client.get(reverse('dashboard'))
+        self.assertEqual(self.role_writes(queries), [])
+
+    def test_user_save_does_not_write_role(self):
+        user = User.objects.create_user(username='fresh')
+        user.first_name = 'Fresh'
+        with CaptureQueriesContext(connection) as queries:
+            user.save()
+        self.assertEqual(self.role_writes(queries), [])
+
+    def test_create_user_ajax_sets_role(self):
+        User.objects.create_superuser(username='boss', password='pw', email='boss@example.com')
+        self.client.login(username='boss', password='pw')
+        for username, role, writes in (('plain', 'user', 1), ('viewer', 'viewer', 2)):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post(
+                    reverse('create-user-ajax'),
+                    json.dumps({'username': username, 'email': f'{username}@example.com',
+                                'password': 'pw', 'role': role}),
+                    content_type='application/json',
+                )
+            self.assertTrue(response.json()['success'])
+            self.assertEqual(len(self.role_writes(queries)), writes)
+            self.assertEqual(UserRole.objects.get(user__username=username).role, role)
+
+
+class ConditionalGetTestCase(TestCase):
+    """Identity endpoints send validators and answer matching requests with 304"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='owner', password='pw')
+        self.other = User.objects.create_user(username='viewer', password='pw')
+        self.social = Identity.objects.create(
+            user=self.user, context='social', given_name='Ada', family_name='Lovelace',
+            visibility='public', is_primary=True,
+        )
+        self.legal = Identity.objects.create(
+            user=self.user, context='legal', given_name='Augusta', family_name='King', visibility='public',
+        )
+        self.client.login(username='owner', password='pw')
+        patcher = mock.patch.object(identity_cache, 'alias', 'default')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        identity_cache.clear()
+
+    def revalidate(self, url, **headers):
+        """Fetch ``url`` and replay it with its ETag, returning both responses"""
+        first = self.client.get(url, **headers)
+        self.assertEqual(first.status_code, 200)
+        self.assertIn('ETag', first)
+        with CaptureQueriesContext(connection) as queries:
+            second = self.client.get(url, HTTP_IF_NONE_MATCH=first['ETag'], **headers)
+        return first, second, queries
+
+    def test_detail_not_modified(self):
+        url = reverse('identity-detail', kwargs={'pk': self.social.id})
+        first, second, queries = self.revalidate(url)
+
+        self.assertEqual(second.status_code, 304)
+        self.assertEqual(second['ETag'], first['ETag'])
+        self.assertIn('Last-Modified', first)
+        for header in ('Accept-Context', 'Accept-Language', 'Authorization'):
+            self.assertIn(header, first['Vary'])
+        # Only the validator columns were read
+        self.assertFalse(any('"given_name"' in query['sql'] for query in queries))
+
+        self.social.bio = 'Analyst'
+        self.social.save()
+        third = self.client.get(url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(third.status_code, 200)
+        self.assertNotEqual(third['ETag'], first['ETag'])
+
+    def test_if_modified_since(self):
+        url = reverse('identity-detail', kwargs={'pk': self.social.id})
+        first = self.client.get(url)
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=first['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_contextual_not_modified(self):
+        url = reverse('contextual-identity', kwargs={'user_id': self.user.id})
+        first, second, queries = self.revalidate(url, HTTP_ACCEPT_CONTEXT='legal')
+        self.assertEqual(second.status_code, 304)
+        self.assertFalse(any('identity_identity' in query['sql'] for query in queries))
+
+        other = self.client.get(url, HTTP_ACCEPT_CONTEXT='social', HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(other.status_code, 200)
+        self.assertNotEqual(other['ETag'], first['ETag'])
+
+    def test_user_identities_not_modified(self):
+        url = reverse('user-identities', kwargs={'user_id': self.user.id})
+        first, second, _ = self.revalidate(url)
+        self.assertEqual(second.status_code, 304)
+
+        Identity.objects.create(user=self.user, context='professional', given_name='A', family_name='L')
+        third = self.client.get(url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(third.status_code, 200)
+        self.assertEqual(len(third.json()['results']), 3)
+
+        # Another viewer sees a different representation
+        self.client.login(username='viewer', password='pw')
+        fourth = self.client.get(url, HTTP_IF_NONE_MATCH=third['ETag'])
+        self.assertEqual(fourth.status_code, 200)
+
+    def test_set_primary_changes_demoted_etag(self):
+        url = reverse('identity-detail', kwargs={'pk': self.social.id})
+        etag = self.client.get(url)['ETag']
+        self.client.post(reverse('set-primary', kwargs={'identity_id': self.legal.id}))
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.json()['is_primary'])
+
+    def test_ajax_identity_data(self):
+        url = reverse('ajax-identity-data', kwargs={'identity_id': self.social.id})
+        first, second, _ = self.revalidate(url)
+        self.assertEqual(second.status_code, 304)
+        self.assertEqual(self.client.get(reverse('ajax-identity-data', kwargs={'identity_id': 999999}),
+                                         HTTP_IF_NONE_MATCH=first['ETag']).status_code, 404)
+
+
+class ResolveIdentitiesTestCase(TestCase):
+    """Batch contextual lookup matches the single-user endpoint in constant queries"""
+
+    def setUp(self):
+        self.viewer = User.objects.create_user(username='viewer', password='pw')
+        self.client.login(username='viewer', password='pw')
+        self.url = reverse('resolve-identities')
+
+    def seed(self, count):
+        users = User.objects.bulk_create(User(username=f'batch{count}-{i}') for i in range(count))
+        Identity.objects.bulk_create(
+            Identity(user=user, context=context, given_name=f'G{user.pk}', family_name='F',
+                     is_primary=context == 'legal')
+            for user in users for context in ('legal', 'social')
+        )
+        return [user.pk for user in users]
+
+    def resolve(self, user_ids, **extra):
+        return self.client.post(self.url, json.dumps({'user_ids': user_ids, **extra}),
+                                content_type='application/json', HTTP_USER_AGENT='batch/1.0')
+
+    def test_matches_single_lookup(self):
+        user_ids = self.seed(3)
+        ContextPriority.objects.create(user_id=user_ids[1], context='legal', priority=0)
+        Identity.objects.create(user_id=user_ids[2], context='professional', given_name='P', family_name='F')
+
+        for context in ('social', 'professional', 'display'):
+            response = self.resolve(user_ids, context=context)
+            self.assertEqual(response.status_code, 200)
+            results = response.json()['identities']
+            for user_id in user_ids:
+                single = self.client.get(reverse('contextual-identity', kwargs={'user_id': user_id}),
+                                         HTTP_ACCEPT_CONTEXT=context)
+                self.assertEqual(results[str(user_id)], single.json())
+
+    def test_constant_queries_and_single_insert(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            compact.user_agents.intern('batch/1.0')
+        self.addCleanup(compact.user_agents.clear)
+        counts = []
+        for size in (1, 10, 100):
+            user_ids = self.seed(size)
+            with CaptureQueriesContext(connection) as queries:
+                response = self.resolve(user_ids, context='social')
+            self.assertEqual(len(response.json()['identities']), size)
+            inserts = [query for query in queries if query['sql'].startswith('INSERT INTO "identity_accesslog"')]
+            self.assertEqual(len(inserts), 1)
+            counts.append(len(queries))
+        self.assertEqual(len(set(counts)), 1)
+
+        log = AccessLog.objects.latest('id')
+        self.assertEqual((log.access_context, log.user_agent, log.accessed_by_id),
+                         ('social', 'batch/1.0', self.viewer.pk))
+
+    def test_missing_and_duplicate_ids(self):
+        user_ids = self.seed(1)
+        response = self.resolve([user_ids[0], 999999, user_ids[0]], context='social')
+        self.assertEqual(list(response.json()['identities']), [str(user_ids[0])])
+        self.assertEqual(response.json()['not_found'], [999999])
+        self.assertEqual(AccessLog.objects.count(), 1)
+
+    def test_headers_supply_defaults(self):
+        user_ids = self.seed(1)
+        response = self.client.post(self.url, json.dumps({'user_ids': user_ids}),
+                                    content_type='application/json', HTTP_ACCEPT_CONTEXT='social')
+        self.assertEqual(response.json()['context'], 'social')
+        self.assertEqual(response.json()['identities'][str(user_ids[0])]['context'], 'social')
+
+    def test_rejects_bad_requests(self):
+        cap = ResolveIdentitiesSerializer.MAX_USER_IDS
+        for user_ids in ([], ['x'], list(range(1, cap + 2))):
+            with self.subTest(size=len(user_ids)):
+                self.assertEqual(self.resolve(user_ids).status_code, 400)
+        self.client.logout()
+        self.assertIn(self.resolve([1]).status_code, (401, 403))
+
+
+class NegotiationTestCase(TestCase):
+    """Weighted Accept-Context / Accept-Language negotiation"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='polyglot', password='pw')
+        self.legal = Identity.objects.create(
+            user=self.user, context='legal', locale='en-US', given_name='John', family_name='Doe', is_primary=True,
+        )
+        self.social_en = Identity.objects.create(
+            user=self.user, context='social', locale='en-US', given_name='Johnny', family_name='Doe',
+        )
+        self.social_fr = Identity.objects.create(
+            user=self.user, context='social', locale='fr-FR', given_name='Jean', family_name='Doe',
+        )
+        self.client.login(username='polyglot', password='pw')
+        self.url = reverse('contextual-identity', kwargs={'user_id': self.user.id})
+        identity_cache.clear()
+
+    def test_parse_weighted(self):
+        self.assertEqual(
+            negotiation.parse_weighted('fr-CH, fr;q=0.9, en;q=0.8, de;q=0, *;q=0.5, it;q=bad'),
+            [('fr-ch', 1.0), ('fr', 0.9), ('en', 0.8), ('*', 0.5)],
+        )
+        # Ties keep header order
+        self.assertEqual(negotiation.accepted_contexts('legal;q=0.5, social;q=0.5'), ('legal', 'social'))
+
+    def test_accepted_values(self):
+        self.assertEqual(negotiation.accepted_languages('fr-ch, fr;q=0.9, en;q=0.8'), ('fr-CH', 'fr', 'en'))
+        self.assertEqual(negotiation.accepted_languages(''), ('en-US',))
+        self.assertEqual(negotiation.accepted_contexts('Social, <script>, legal;q=0.2'), ('social', 'legal'))
+        self.assertEqual(negotiation.accepted_contexts(',,'), ('display',))
+
+    def test_long_headers_are_truncated(self):
+        header = ', '.join(f'ctx{i}' for i in range(200))
+        contexts = negotiation.accepted_contexts(header)
+        self.assertEqual(len(contexts), negotiation.MAX_VALUES)
+        truncated = negotiation.truncate(header)
+        self.assertLessEqual(len(truncated), negotiation.MAX_HEADER_LENGTH)
+        # The cut never leaves a partial value behind
+        self.assertIn(truncated.split(', ')[-1], header.split(', '))
+
+    def test_parse_cache(self):
+        header = 'social;q=0.7, legal'
+        negotiation.accepted_contexts(header)
+        before = negotiation.cache_info()['contexts']['hits']
+        negotiation.accepted_contexts(header)
+        self.assertEqual(negotiation.cache_info()['contexts']['hits'], before + 1)
+        self.assertEqual(negotiation.cache_info()['contexts']['maxsize'], negotiation.PARSE_CACHE_SIZE)
+
+    def test_language_ranges(self):
+        response = self.client.get(self.url, HTTP_ACCEPT_CONTEXT='social',
+                                   HTTP_ACCEPT_LANGUAGE='fr-CH, fr;q=0.9, en;q=0.8')
+        self.assertEqual(response.json()['id'], self.social_fr.id)
+
+        response = self.client.get(self.url, HTTP_ACCEPT_CONTEXT='social', HTTP_ACCEPT_LANGUAGE='de, en;q=0.5')
+        self.assertEqual(response.json()['id'], self.social_en.id)
+
+    def test_context_preference_beats_locale(self):
+        response = self.client.get(self.url, HTTP_ACCEPT_CONTEXT='professional, legal;q=0.8, social;q=0.5',
+                                   HTTP_ACCEPT_LANGUAGE='fr-FR')
+        self.assertEqual(response.json()['id'], self.legal.id)
+        response = self.client.get(self.url, HTTP_ACCEPT_CONTEXT='legal;q=0.4, social',
+                                   HTTP_ACCEPT_LANGUAGE='fr-FR')
+        self.assertEqual(response.json()['id'], self.social_fr.id)
+
+    def test_multiple_contexts(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url + '?multiple=true', HTTP_ACCEPT_CONTEXT='social, legal, display',
+                                       HTTP_ACCEPT_LANGUAGE='fr')
+        # Every context is resolved from one candidate query
+        self.assertEqual(sum('FROM "identity_identity"' in query['sql'] for query in queries), 1)
+        identities = response.json()['identities']
+        self.assertEqual(list(identities), ['social', 'legal', 'display'])
+        self.assertEqual(identities['social']['id'], self.social_fr.id)
+        self.assertEqual(identities['legal']['id'], self.legal.id)
+        # display falls back to the primary identity
+        self.assertEqual(identities['display']['id'], self.legal.id)
+        self.assertIn('ETag', response)
+
+
+class SparseFieldsTestCase(TestCase):
+    """?fields= narrows the context projection and the columns read"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='sparse', password='pw')
+        self.display = Identity.objects.create(
+            user=self.user, context='display', given_name='Grace', family_name='Hopper',
+            display_name='Amazing Grace', pronouns='she/her', bio='b' * 500, admin_notes='secret',
+        )
+        self.legal = Identity.objects.create(
+            user=self.user, context='legal', given_name='Grace', family_name='Hopper', middle_name='Brewster',
+            is_primary=True, custom_attributes={'rank': 'Rear Admiral'},
+        )
+        self.client.login(username='sparse', password='pw')
+        self.url = reverse('contextual-identity', kwargs={'user_id': self.user.id})
+        identity_cache.clear()
+
+    def test_fields_intersect_projection(self):
+        response = self.client.get(self.url + '?fields=display_name,bio,admin_notes,pronouns',
+                                   HTTP_ACCEPT_CONTEXT='display')
+        self.assertEqual(response.json(), {'id': self.display.id, 'display_name': 'Amazing Grace',
+                                           'pronouns': 'she/her'})
+
+    def test_unpruned_output_unchanged(self):
+        for identity in (self.display, self.legal):
+            with self.subTest(context=identity.context):
+                response = self.client.get(self.url, HTTP_ACCEPT_CONTEXT=identity.context)
+                self.assertEqual(response.json(), Identity.objects.get(pk=identity.pk).get_contextual_data())
+
+    def test_columns_are_pruned(self):
+        with CaptureQueriesContext(connection) as queries:
+            resolve_identity(self.user.id, 'display', fields=('display_name',))
+        self.assertEqual(len(queries), 1)
+        for column in ('"bio"', '"admin_notes"', '"custom_attributes"', '"phone"'):
+            self.assertNotIn(column, queries[0]['sql'])
+
+    def test_fallback_tops_up_columns(self):
+        # social is not present; the primary legal identity needs columns social does not
+        with CaptureQueriesContext(connection) as queries:
+            identity = resolve_identity(self.user.id, 'social', fields=('middle_name', 'custom_attributes'))
+        self.assertEqual(len(queries), 2)
+        with self.assertNumQueries(0):
+            data = identity.get_contextual_data(None, ('middle_name', 'custom_attributes'))
+        self.assertEqual(data, {'id': self.legal.id, 'middle_name': 'Brewster',
+                                'custom_attributes': {'rank': 'Rear Admiral'}})
+
+    def test_fields_are_part_of_cache_key_and_etag(self):
+        narrow = self.client.get(self.url + '?fields=pronouns', HTTP_ACCEPT_CONTEXT='display')
+        wide = self.client.get(self.url, HTTP_ACCEPT_CONTEXT='display')
+        self.assertNotIn('display_name', narrow.json())
+        self.assertIn('display_name', wide.json())
+        self.assertNotEqual(narrow['ETag'], wide['ETag'])
+
+    def test_list_and_batch_endpoints(self):
+        response = self.client.get(reverse('user-identities', kwargs={'user_id': self.user.id}) + '?fields=pronouns')
+        self.assertEqual(sorted(map(sorted, (item.keys() for item in response.json()['results']))),
+                         [['id'], ['id', 'pronouns']])
+
+        response = self.client.post(reverse('resolve-identities'),
+                                    json.dumps({'user_ids': [self.user.id], 'context': 'legal',
+                                                'fields': ['middle_name', 'bio']}),
+                                    content_type='application/json')
+        self.assertEqual(response.json()['identities'][str(self.user.id)],
+                         {'id': self.legal.id, 'middle_name': 'Brewster'})
+
+    def test_projection_columns(self):
+        self.assertNotIn('bio', projection.columns(['display', 'legal']))
+        self.assertIn('bio', projection.columns(['social']))
+        self.assertNotIn('bio', projection.columns(['social'], ('nickname',)))
+
+class ProjectionRegistryTestCase(TestCase):
+    """Compiled context projections match the old if/elif ladder"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='projected', password='pw')
+
+    def make(self, context, **fields):
+        return Identity(user=self.user, id=1, context=context, given_name='Ada', family_name='Lovelace',
+                        middle_name='King', title='Countess', preferred_name='Ada L.', pronouns='she/her',
+                        bio='Analyst', email='ada@example.com', **fields)
+
+    def test_matches_legacy_output(self):
+        from .benchmarks import _legacy_contextual_data
+        for context in projection.CONTEXT_FIELDS:
+            for extra in ({}, {'display_name': 'The Enchantress', 'custom_attributes': {'era': 1843}}):
+                with self.subTest(context=context, extra=extra):
+                    identity = self.make(context, **extra)
+                    data = identity.get_contextual_data()
+                    self.assertEqual(data, _legacy_contextual_data(identity))
+                    self.assertEqual(list(data), list(_legacy_contextual_data(identity)))
+
+    def test_display_full_name_computed_once(self):
+        identity = self.make('display')
+        with mock.patch.object(Identity, 'get_full_name', return_value='Ada') as get_full_name:
+            data = projection.project(identity)
+        self.assertEqual(get_full_name.call_count, 1)
+        self.assertEqual((data['full_name'], data['display_name']), ('Ada', 'Ada'))
+
+    def test_full_projections_precompiled(self):
+        for context in projection.CONTEXT_FIELDS:
+            self.assertIn('render', projection.compile_projection(context)._fields)
+        hits = projection.compile_projection.cache_info().hits
+        projection.project(self.make('legal'))
+        self.assertEqual(projection.compile_projection.cache_info().hits, hits + 1)
+
+    def test_serializer_shares_projection(self):
+        identity = self.make('professional')
+        self.assertEqual(ContextualIdentitySerializer(identity).data, projection.project(identity))
+        self.assertEqual(ContextualIdentitySerializer(identity, context={'fields': ('email',)}).data,
+                         {'id': 1, 'email': 'ada@example.com'})
+
+class FastPathSerializationTestCase(TestCase):
+    """values()-based listings render byte-for-byte what the serializers do"""
+    ROWS = 10000
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='bulk', password='pw')
+        User.objects.bulk_create(User(username=f'bulk{i}') for i in range(cls.ROWS // 4))
+        users = list(User.objects.filter(username__startswith='bulk').exclude(pk=cls.user.pk).order_by('id'))
+        contexts = ('legal', 'social', 'professional', 'display')
+        Identity.objects.bulk_create(
+            Identity(
+                user=user, context=context, given_name=f'Given{i}', family_name='Family',
+                middle_name='M' if i % 2 else '', preferred_name='Pref' if i % 3 else '',
+                display_name='Shown' if i % 5 == 0 else '', title='Dr.' if i % 7 == 0 else '',
+                suffix='Jr.' if i % 11 == 0 else '', bio='b' * (i % 50), pronouns='they/them',
+                custom_attributes={'n': i} if i % 4 == 0 else {}, is_primary=(j == 0),
+                visibility='public' if i % 2 else 'private',
+            )
+            for i, user in enumerate(users)
+            for j, context in enumerate(contexts)
+        )
+        Identity.objects.create(user=cls.user, context='legal', given_name='Own', family_name='Er')
+
+    def render(self, data):
+        return JSONRenderer().render(data)
+
+    def test_identity_rows_match_serializer(self):
+        identities = Identity.objects.order_by('-created_at', '-id')
+        self.assertEqual(identities.count(), self.ROWS + 1)
+        self.assertEqual(
+            self.render(fastpath.serialize_identities(fastpath.identity_rows(identities))),
+            self.render(IdentitySerializer(identities, many=True).data),
+        )
+
+    def test_contextual_rows_match_serializer(self):
+        identities = Identity.objects.order_by('-created_at', '-id')
+        contexts = projection.all_contexts()
+        for fields in (None, ('full_name', 'display_name', 'bio'), ('custom_attributes',)):
+            with self.subTest(fields=fields):
+                rows = fastpath.contextual_rows(identities, contexts, fields)
+                self.assertEqual(
+                    self.render(fastpath.serialize_contextual(rows, fields)),
+                    self.render(ContextualIdentitySerializer(identities, many=True, context={'fields': fields}).data),
+                )
+
+    def test_contextual_rows_read_only_projection_columns(self):
+        rows = fastpath.contextual_rows(Identity.objects.all(), ['display'])
+        self.assertNotIn('bio', rows.query.values_select)
+        self.assertNotIn('admin_notes', rows.query.values_select)
+
+    def test_list_endpoints_use_fast_path(self):
+        self.client.login(username='bulk', password='pw')
+        with mock.patch.object(IdentitySerializer, 'to_representation') as to_representation:
+            data = self.client.get(reverse('identity-list-create')).json()
+        to_representation.assert_not_called()
+        own = Identity.objects.get(user=self.user)
+        self.assertEqual(data['results'], [json.loads(self.render(IdentitySerializer(own).data))])
+
+        other = Identity.objects.filter(visibility='public').first().user
+        url = reverse('user-identities', kwargs={'user_id': other.id})
+        with mock.patch.object(ContextualIdentitySerializer, 'to_representation') as to_representation:
+            data = self.client.get(url, {'page_size': 2}).json()
+        to_representation.assert_not_called()
+        expected = [
+            identity.get_contextual_data()
+            for identity in Identity.objects.filter(user=other, visibility='public').order_by('-created_at', '-id')
+        ]
+        self.assertEqual(data['results'], expected[:2])
+        self.assertEqual(self.client.get(data['next']).json()['results'], expected[2:4])
+
+class StreamingResponseTestCase(TestCase):
+    """?stream= listings and the AccessLog export stream rows instead of materializing them"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='streamer', password='pw')
+        for i, context in enumerate(('legal', 'social', 'professional', 'display')):
+            Identity.objects.create(user=self.user, context=context, given_name=f'Given{i}', family_name='Stream',
+                                    bio='b', is_primary=(i == 0), custom_attributes={'i': i} if i % 2 else {})
+        self.client.login(username='streamer', password='pw')
+
+    def body(self, response):
+        self.assertTrue(response.streaming)
+        return b''.join(response.streaming_content).decode()
+
+    def test_identity_list_streams_json_array(self):
+        response = self.client.get(reverse('identity-list-create'), {'stream': 'json'})
+        self.assertEqual(response['Content-Type'], 'application/json')
+        identities = Identity.objects.filter(user=self.user).order_by('-created_at', '-id')
+        self.assertEqual(self.body(response), JSONRenderer().render(IdentitySerializer(identities, many=True).data).decode())
+
+    def test_user_identities_streams_ndjson(self):
+        url = reverse('user-identities', kwargs={'user_id': self.user.id})
+        response = self.client.get(url, {'stream': 'ndjson', 'fields': 'full_name,bio'})
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertIn('Accept-Context', response['Vary'])
+        identities = Identity.objects.filter(user=self.user).order_by('-created_at', '-id')
+        self.assertEqual(
+            [json.loads(line) for line in self.body(response).splitlines()],
+            [identity.get_contextual_data(requested_fields=('bio', 'full_name')) for identity in identities],
+        )
+
+    @override_settings(IDENTITY_STREAMING={'CHUNK_SIZE': 2, 'BATCH_SIZE': 1})
+    def test_rows_are_iterated_in_chunks(self):
+        rows = fastpath.identity_rows(Identity.objects.order_by('id'))
+        with mock.patch.object(type(rows), 'iterator', autospec=True, side_effect=lambda qs, chunk_size: iter(qs)) as it:
+            response = streaming.stream(rows, fastpath.identity_serializer(), 'ndjson')
+            chunks = list(response.streaming_content)
+        self.assertEqual(it.call_args.kwargs['chunk_size'], 2)
+        self.assertEqual(len(chunks), 4)
+
+    def test_empty_stream_is_valid_json(self):
+        self.assertEqual(''.join(streaming.json_array(iter(()), dict)), '[]')
+        self.assertEqual(''.join(streaming.ndjson(iter(()), dict)), '')
+        self.assertIsNone(streaming.requested_format(mock.Mock(GET={})))
+
+    def test_admin_exports_access_logs(self):
+        identity = Identity.objects.filter(user=self.user).first()
+        AccessLog.objects.bulk_create(
+            AccessLog(identity=identity, accessed_by=self.user, access_context='legal',
+                      ip_address='10.0.0.1', user_agent='test')
+            for _ in range(5)
+        )
+        User.objects.create_superuser(username='auditor', password='pw', email='auditor@example.com')
+        self.client.login(username='auditor', password='pw')
+        response = self.client.post(reverse('admin:identity_accesslog_changelist'), {
+            'action': 'export_ndjson', 'select_across': '1', 'index': '0',
+            '_selected_action': [AccessLog.objects.first().pk],
+        })
+        lines = [json.loads(line) for line in self.body(response).splitlines()]
+        self.assertEqual(len(lines), 5)
+        self.assertEqual(lines[0]['identity_id'], identity.id)
+        self.assertTrue(lines[0]['timestamp'].endswith('Z'))
+
+class AccessLogExportTestCase(TestCase):
+    """Keyset AccessLog extracts over HTTP and from the command line"""
+
+    def setUp(self):
+        self.owner = User.objects.create_user(username='owner', password='pw')
+        self.reader = User.objects.create_user(username='reader', password='pw')
+        self.legal = Identity.objects.create(user=self.owner, context='legal', given_name='A', family_name='B')
+        self.social = Identity.objects.create(user=self.owner, context='social', given_name='A', family_name='B')
+        start = timezone.now() - timedelta(days=7)
+        self.logs = AccessLog.objects.bulk_create(
+            AccessLog(
+                identity=self.legal if i % 2 else self.social, accessed_by=self.reader if i % 3 else self.owner,
+                access_context='legal' if i % 2 else 'social', accessed_fields=['given_name'],
+                ip_address='10.0.0.1', user_agent='agent, "quoted"', timestamp=start + timedelta(days=i),
+            )
+            for i in range(7)
+        )
+        self.logs = list(AccessLog.objects.order_by('timestamp', 'id'))
+        self.admin = User.objects.create_superuser(username='compliance', password='pw', email='c@example.com')
+
+    def ids(self, batches):
+        return [row['id'] for batch in batches for row in batch]
+
+    def test_batches_walk_keyset_order(self):
+        with self.assertNumQueries(3):
+            batches = list(exports.batches({}, batch_size=3))
+        self.assertEqual([len(batch) for batch in batches], [3, 3, 1])
+        self.assertEqual(self.ids(batches), [log.id for log in self.logs])
+        self.assertEqual(batches[0][0]['accessed_by_username'], self.logs[0].accessed_by.username)
+        self.assertEqual(batches[0][0]['identity_user_id'], self.owner.id)
+
+    def test_filters(self):
+        lookups = exports.parse_filters({
+            'since': self.logs[1].timestamp.isoformat(), 'until': self.logs[6].timestamp.isoformat(),
+            'identity': str(self.legal.id), 'accessed_by': str(self.reader.id), 'context': 'legal',
+        })
+        expected = [log.id for log in self.logs[1:6]
+                    if log.identity_id == self.legal.id and log.accessed_by_id == self.reader.id]
+        self.assertEqual(self.ids(exports.batches(lookups)), expected)
+        with self.assertRaises(exports.InvalidExport):
+            exports.parse_filters({'since': 'yesterday'})
+        with self.assertRaises(exports.InvalidExport):
+            exports.parse_filters({'identity': 'abc'})
+
+    def test_resume_after_row(self):
+        position = exports.resume_position(self.logs[3].id)
+        self.assertEqual(self.ids(exports.batches({}, position, batch_size=2)), [log.id for log in self.logs[4:]])
+        with self.assertRaises(exports.InvalidExport):
+            exports.resume_position(10 ** 9)
+
+    def test_http_export_is_gzipped_ndjson(self):
+        self.client.login(username='compliance', password='pw')
+        response = self.client.get(reverse('access-log-export'), {'context': 'social'})
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        self.assertIn('access-logs.ndjson.gz', response['Content-Disposition'])
+        lines = gzip.decompress(b''.join(response.streaming_content)).decode().splitlines()
+        rows = [json.loads(line) for line in lines]
+        self.assertEqual([row['id'] for row in rows], [log.id for log in self.logs if log.access_context == 'social'])
+        self.assertEqual(list(rows[0]), list(exports.COLUMNS))
+
+    def test_http_export_csv_and_resume(self):
+        self.client.login(username='compliance', password='pw')
+        response = self.client.get(reverse('access-log-export'),
+                                   {'format': 'csv', 'gzip': '0', 'after': self.logs[4].id})
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        rows = list(csv.reader(io.StringIO(b''.join(response.streaming_content).decode())))
+        self.assertEqual(rows[0], list(exports.COLUMNS))
+        self.assertEqual([int(row[0]) for row in rows[1:]], [log.id for log in self.logs[5:]])
+        self.assertEqual(rows[1][exports.COLUMNS.index('user_agent')], 'agent, "quoted"')
+        self.assertEqual(json.loads(rows[1][exports.COLUMNS.index('accessed_fields')]), ['given_name'])
+
+    def test_http_export_rejects_bad_input_and_non_admins(self):
+        self.client.login(username='compliance', password='pw')
+        url = reverse('access-log-export')
+        self.assertEqual(self.client.get(url, {'since': 'soon'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'after': 10 ** 9}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'format': 'xml'}).status_code, 400)
+
+        self.client.login(username='reader', password='pw')
+        self.assertEqual(self.client.get(url).status_code, 302)
+
+    def test_command_writes_gzip_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'logs.ndjson.gz')
+            err = io.StringIO()
+            call_command('export_access_logs', output=path, after=self.logs[1].id, batch_size=2, stderr=err)
+            with gzip.open(path, 'rt') as f:
+                ids = [json.loads(line)['id'] for line in f]
+        self.assertEqual(ids, [log.id for log in self.logs[2:]])
+        self.assertIn(f'5 rows exported, last id {self.logs[6].id}', err.getvalue())
+
+    def test_command_csv_to_stdout(self):
+        out = io.StringIO()
+        call_command('export_access_logs', format='csv', context='legal', verbosity=0, stdout=out)
+        rows = list(csv.reader(io.StringIO(out.getvalue())))
+        self.assertEqual(len(rows), 1 + sum(log.access_context == 'legal' for log in self.logs))
+        with self.assertRaises(CommandError):
+            call_command('export_access_logs', since='never', verbosity=0, stdout=io.StringIO())
+
+class AccessLogRetentionTestCase(TestCase):
+    """Incremental hourly rollups and bucketed retention of access logs"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='retained', password='pw')
+        self.identity = Identity.objects.create(user=self.user, context='legal', given_name='A', family_name='B')
+        self.now = timezone.now().replace(minute=30, second=0, microsecond=0)
+
+    def log(self, when, context='legal', count=1):
+        AccessLog.objects.bulk_create(
+            AccessLog(identity=self.identity, accessed_by=self.user, access_context=context,
+                      ip_address='10.0.0.1', user_agent='test', timestamp=when)
+            for _ in range(count)
+        )
+        stats.increment('access_logs', count)
+
+    def hour(self, when):
+        return when.replace(minute=0)
+
+    def test_roll_up_is_incremental(self):
+        old = self.now - timedelta(days=3)
+        self.log(old, count=3)
+        self.log(old, context='social', count=2)
+        self.assertEqual(rollups.roll_up(batch_size=2), 5)
+        self.assertEqual(rollups.roll_up(), 0)
+
+        self.log(old, count=4)
+        self.assertEqual(rollups.roll_up(), 4)
+        self.assertEqual(
+            set(AccessLogRollup.objects.values_list('access_context', 'hour', 'count')),
+            {('legal', self.hour(old), 7), ('social', self.hour(old), 2)},
+        )
+
+    def test_coalesced_rows_count_every_hit(self):
+        old = self.now - timedelta(days=2)
+        AccessLog.objects.bulk_create([
+            AccessLog(identity=self.identity, accessed_by=self.user, access_context='legal',
+                      user_agent='test', timestamp=old, last_seen=old + timedelta(seconds=50), hit_count=6),
+        ])
+        self.assertEqual(rollups.access_count(identity=self.identity.id), 6)
+        rollups.roll_up()
+        self.assertEqual(AccessLogRollup.objects.get().count, 6)
+        self.assertEqual(rollups.access_count(identity=self.identity.id), 6)
+
+    def test_fresh_rows_wait_to_settle(self):
+        self.log(self.now - timedelta(days=1))
+        self.log(timezone.now())
+        self.log(self.now - timedelta(days=1))
+        self.assertEqual(rollups.roll_up(), 1)
+        self.assertEqual(rollups.checkpoint(), AccessLog.objects.order_by('id').first().id)
+
+    def test_hourly_counts_add_unrolled_tail(self):
+        old = self.now - timedelta(days=2)
+        self.log(old, count=2)
+        rollups.roll_up()
+        self.log(old, count=1)
+        self.log(self.now, count=5)
+
+        counts = rollups.hourly_counts(identity=self.identity.id)
+        self.assertEqual(counts, {self.hour(old): 3, self.hour(self.now): 5})
+        self.assertEqual(rollups.access_count(context='legal', since=self.hour(self.now)), 5)
+        self.assertEqual(rollups.access_count(until=self.hour(self.now)), 3)
+
+    def test_history_reads_rollups_not_raw_rows(self):
+        self.log(self.now - timedelta(days=40), count=3)
+        rollups.roll_up()
+        with CaptureQueriesContext(connection) as queries:
+            rollups.hourly_counts(identity=self.identity.id)
+        raw = [q['sql'] for q in queries.captured_queries if 'identity_accesslog"' in q['sql']]
+        self.assertEqual(len(raw), 1)
+        self.assertIn('"identity_accesslog"."id" >', raw[0])
+
+    def test_prune_deletes_expired_buckets_in_batches(self):
+        cutoff = retention.cutoff(1, now=self.now)
+        expired = cutoff - timedelta(days=40)
+        self.log(expired, count=5)
+        self.log(cutoff - timedelta(hours=1), count=2)
+        self.log(cutoff + timedelta(hours=1), count=1)
+
+        with tempfile.TemporaryDirectory() as directory:
+            out = io.StringIO()
+            with mock.patch.object(retention, 'cutoff', return_value=cutoff):
+                call_command('prune_access_logs', keep_months=1, archive_dir=directory, batch_size=2, stdout=out)
+            archives = sorted(os.listdir(directory))
+            with gzip.open(os.path.join(directory, archives[0]), 'rt') as f:
+                archived = f.read().splitlines()
+
+        self.assertEqual(AccessLog.objects.count(), 1)
+        self.assertEqual(len(archives), 2)
+        self.assertEqual(len(archived), 5)
+        self.assertIn('Pruned 7 access logs', out.getvalue())
+        self.assertEqual(stats.get_counters()['access_logs'], 1)
+        # History survives in the rollups
+        self.assertEqual(rollups.access_count(identity=self.identity.id), 8)
+
+    def test_prune_keeps_rows_not_yet_rolled_up(self):
+        self.log(self.now - timedelta(days=400))
+        with mock.patch.object(rollups, 'roll_up', return_value=0):
+            self.assertEqual(retention.prune(keep_months=1), 0)
+        self.assertEqual(AccessLog.objects.count(), 1)
+
+    def test_dry_run_touches_nothing(self):
+        self.log(self.now - timedelta(days=400), count=2)
+        rollups.roll_up()
+        out = io.StringIO()
+        call_command('prune_access_logs', keep_months=1, dry_run=True, stdout=out)
+        self.assertIn('about 2 rows would be pruned', out.getvalue())
+        self.assertEqual(AccessLog.objects.count(), 2)
+
+    def test_cutoff_counts_whole_months(self):
+        now = timezone.now().replace(year=2026, month=3, day=15)
+        start = {'day': 1, 'hour': 0, 'minute': 0, 'second': 0, 'microsecond': 0}
+        self.assertEqual(retention.cutoff(0, now), now.replace(**start))
+        self.assertEqual(retention.cutoff(2, now), now.replace(month=1, **start))
+        self.assertEqual(retention.cutoff(3, now), now.replace(year=2025, month=12, **start))
+
+class CompactAccessLogTestCase(TestCase):
+    """Interned user agents and packed IP addresses on AccessLog"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='compact', password='pw')
+        self.identity = Identity.objects.create(user=self.user, context='legal', given_name='A', family_name='B')
+        self.addCleanup(compact.user_agents.clear)
+
+    def make(self, **fields):
+        return AccessLog(identity=self.identity, accessed_by=self.user, access_context='legal', **fields)
+
+    def test_ip_addresses_round_trip_packed(self):
+        for given, stored, length in (
+            ('192.168.0.1', '192.168.0.1', 4),
+            (' 10.0.0.1', '10.0.0.1', 4),
+            ('2001:db8::1', '2001:db8::1', 16),
+            ('::ffff:10.0.0.1', '::ffff:a00:1', 16),
+            ('unknown', '', 0),
+            (None, '', 0),
+        ):
+            log = AccessLog.objects.get(pk=AccessLog.objects.create(
+                identity=self.identity, accessed_by=self.user, access_context='legal', ip_address=given,
+            ).pk)
+            self.assertEqual(len(bytes(log.ip)), length)
+            self.assertEqual(log.ip_address, stored)
+
+    def test_user_agents_are_interned_once(self):
+        AccessLog.objects.bulk_create(
+            self.make(ip_address='10.0.0.1', user_agent=f'agent/{i % 3}') for i in range(30)
+        )
+        AccessLog.objects.create(identity=self.identity, accessed_by=self.user, access_context='legal',
+                                 user_agent='agent/1')
+        AccessLog.objects.create(identity=self.identity, accessed_by=self.user, access_context='legal')
+        self.assertEqual(UserAgent.objects.count(), 4)
+        self.assertEqual(
+            set(AccessLog.objects.values_list('agent__value', flat=True)), {'agent/0', 'agent/1', 'agent/2', ''},
+        )
+        log = AccessLog.objects.filter(agent__value='agent/2').first()
+        self.assertEqual(log.user_agent, 'agent/2')
+        self.assertEqual(log.agent.digest, compact.digest('agent/2'))
+
+    def test_ids_are_cached_once_committed(self):
+        interner = compact.UserAgentInterner(maxsize=2)
+        with self.captureOnCommitCallbacks(execute=False):
+            agent_id = interner.intern('rolled/back')
+        self.assertEqual(len(interner.local), 0)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(interner.intern('rolled/back'), agent_id)
+        with self.assertNumQueries(0):
+            self.assertEqual(interner.intern_many(['rolled/back']), {'rolled/back': agent_id})
+        self.assertEqual(interner.stats()['hits'], 1)
+        self.assertEqual(interner.stats()['created'], 1)
+
+    def test_exports_decode_compact_columns(self):
+        AccessLog.objects.bulk_create([
+            self.make(ip_address='2001:db8::1', user_agent='agent/6'),
+            self.make(ip_address='bogus', user_agent='agent/6'),
+        ])
+        serialize = fastpath.access_log_serializer()
+        rows = [serialize(row) for row in fastpath.access_log_rows(AccessLog.objects.order_by('id'))]
+        self.assertEqual([(row['ip_address'], row['user_agent']) for row in rows],
+                         [('2001:db8::1', 'agent/6'), ('', 'agent/6')])
+
+    def test_admin_lists_and_searches_by_ip(self):
+        AccessLog.objects.bulk_create([
+            self.make(ip_address='10.1.2.3', user_agent='agent/7'),
+            self.make(ip_address='10.9.9.9', user_agent='agent/7'),
+        ])
+        User.objects.create_superuser(username='auditor', password='pw', email='auditor@example.com')
+        self.client.login(username='auditor', password='pw')
+        url = reverse('admin:identity_accesslog_changelist')
+
+        response = self.client.get(url, {'q': '10.1.2.3'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['cl'].result_count, 1)
+        self.assertContains(response, '10.1.2.3')
+        self.assertNotContains(response, '10.9.9.9')
+        self.assertEqual(self.client.get(url, {'q': 'compact'}).context['cl'].result_count, 2)
+
+        log = AccessLog.objects.first()
+        detail = self.client.get(reverse('admin:identity_accesslog_change', args=[log.pk]))
+        self.assertContains(detail, 'agent/7')
+
+
+class ColdArchiveTestCase(TestCase):
+    """Columnar segment archive of old access logs and queries over it"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='cold', password='pw')
+        self.first = Identity.objects.create(user=self.user, context='legal', given_name='A', family_name='B')
+        self.second = Identity.objects.create(user=self.user, context='social', given_name='C', family_name='D')
+        self.old = timezone.now() - timedelta(days=200)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def log(self, identity, when, count=1, context='legal', ip_address='10.0.0.1'):
+        AccessLog.objects.bulk_create(
+            AccessLog(identity=identity, accessed_by=self.user, access_context=context, ip_address=ip_address,
+                      user_agent='agent/1', accessed_fields=['given_name'], timestamp=when + timedelta(minutes=i))
+            for i in range(count)
+        )
+        stats.increment('access_logs', count)
+
+    def export(self, batches):
+        return ''.join(exports.render(batches, 'ndjson', compress=False))
+
+    def test_archive_moves_old_rows(self):
+        self.log(self.first, self.old, count=4)
+        self.log(self.second, self.old + timedelta(hours=1), count=3, context='social', ip_address='2001:db8::1')
+        self.log(self.first, timezone.now() - timedelta(days=1), count=2)
+        cutoff = timezone.now() - timedelta(days=90)
+        expected = self.export(exports.batches({'timestamp__lt': cutoff}))
+
+        moved = segments.archive(older_than_days=90, directory=self.directory, segment_rows=3)
+        self.assertEqual(moved, 7)
+        self.assertEqual(len(segments.segment_paths(self.directory)), 3)
+        self.assertEqual(AccessLog.objects.count(), 2)
+        self.assertEqual(stats.reconcile(), {})
+        self.assertEqual(rollups.access_count(), 9)
+
+        self.assertEqual(self.export(segments.query({}, self.directory)), expected)
+
+    def test_query_filters_rows_and_skips_segments(self):
+        self.log(self.first, self.old, count=3)
+        self.log(self.second, self.old + timedelta(days=1), count=3, context='social')
+        segments.archive(older_than_days=90, directory=self.directory, segment_rows=3)
+
+        decompress = mock.Mock(side_effect=zlib.decompress)
+        with mock.patch.dict(segments.CODECS, {'zlib': (segments.CODECS['zlib'][0], decompress)}):
+            rows = [row for batch in segments.query({'identity_id': self.second.id}, self.directory) for row in batch]
+        self.assertEqual({row['identity_id'] for row in rows}, {self.second.id})
+        self.assertEqual(len(rows), 3)
+        # Only the second segment's columns were read
+        self.assertEqual(decompress.call_count, len(segments.KINDS))
+
+        def count(**lookups):
+            return sum(len(batch) for batch in segments.query(lookups, self.directory))
+
+        self.assertEqual(count(access_context='social'), 3)
+        self.assertEqual(count(access_context='display'), 0)
+        self.assertEqual(count(timestamp__gte=self.old + timedelta(minutes=1),
+                               timestamp__lt=self.old + timedelta(days=1, minutes=1)), 3)
+        self.assertEqual(count(accessed_by_id=self.user.id, identity_id=self.first.id), 3)
+        with self.assertRaises(ValueError):
+            count(ip_address='10.0.0.1')
+
+    def test_interrupted_archive_is_finished_next_run(self):
+        self.log(self.first, self.old, count=5)
+        with mock.patch.object(segments, '_delete_archived', side_effect=RuntimeError('killed')):
+            with self.assertRaises(RuntimeError):
+                segments.archive(older_than_days=90, directory=self.directory, segment_rows=10)
+        self.assertEqual(AccessLog.objects.count(), 5)
+
+        self.assertEqual(segments.archive(older_than_days=90, directory=self.directory, segment_rows=10), 0)
+        self.assertEqual(AccessLog.objects.count(), 0)
+        self.assertEqual(len(segments.segment_paths(self.directory)), 1)
+        self.assertEqual(sum(len(batch) for batch in segments.query({}, self.directory)), 5)
+
+    def test_lzma_and_invalid_segments(self):
+        self.log(self.first, self.old, count=2)
+        segments.archive(older_than_days=90, directory=self.directory, codec='lzma')
+        (path, footer), = segments.footers(self.directory)
+        self.assertEqual((footer['codec'], footer['rows']), ('lzma', 2))
+        with open(path, 'rb') as segment:
+            data = segment.read()
+        with self.assertRaises(segments.InvalidSegment):
+            segments.read_footer(data[:-4])
+        with self.assertRaises(segments.InvalidSegment):
+            segments.read_footer(b'not a segment at all')
+
+        # Opening a truncated segment closes what it opened before failing
+        with open(path, 'wb') as segment:
+            segment.write(data[:-4])
+        opened = []
+        with mock.patch('identity.segments.open', create=True,
+                        side_effect=lambda *args: opened.append(open(*args)) or opened[-1]):
+            with self.assertRaises(segments.InvalidSegment):
+                list(segments.footers(self.directory))
+        self.assertTrue(opened[0].closed)
+
+    def test_commands(self):
+        self.log(self.first, self.old, count=2)
+        self.log(self.second, self.old, count=1, context='social')
+        out = io.StringIO()
+        call_command('archive_access_logs', dir=self.directory, older_than_days=90, stdout=out)
+        self.assertIn('Archived 3 access logs', out.getvalue())
+
+        out = io.StringIO()
+        call_command('query_access_log_archive', dir=self.directory, format='csv', identity=str(self.first.id),
+                     stdout=out)
+        rows = list(csv.reader(io.StringIO(out.getvalue())))
+        self.assertEqual(rows[0], list(exports.COLUMNS))
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[1][exports.COLUMNS.index('ip_address')], '10.0.0.1')
+
+        out = io.StringIO()
+        call_command('query_access_log_archive', dir=self.directory, list=True, stdout=out)
+        self.assertIn('3 rows', out.getvalue())
+        with self.assertRaises(CommandError):
+            call_command('archive_access_logs', dir=None)
+
+
+class AccessStatsTestCase(TestCase):
+    """Daily access rollups and the statistics read from them"""
+
+    def setUp(self):
+        self.owner = User.objects.create_user(username='stats-owner', password='pw')
+        self.reader = User.objects.create_user(username='stats-reader', password='pw')
+        self.identity = Identity.objects.create(user=self.owner, context='legal', given_name='A', family_name='B')
+        self.today = timezone.now().replace(hour=12, minute=0, second=0, microsecond=0) - timedelta(days=1)
+        self.client = Client()
+
+    def log(self, when, accessed_by, context='legal', count=1, hits=1):
+        AccessLog.objects.bulk_create(
+            AccessLog(identity=self.identity, accessed_by=accessed_by, access_context=context,
+                      user_agent='test', timestamp=when, hit_count=hits)
+            for _ in range(count)
+        )
+
+    def url(self, identity=None, **params):
+        url = reverse('identity-access-stats', args=[identity or self.identity.id])
+        return url + ('?' + '&'.join(f'{k}={v}' for k, v in params.items()) if params else '')
+
+    def test_roll_up_fills_daily_rollups(self):
+        day = self.today - timedelta(days=2)
+        self.log(day, self.reader, count=2)
+        self.log(day + timedelta(hours=3), self.owner, context='social', hits=4)
+        self.log(self.today, self.reader)
+        self.assertEqual(rollups.roll_up(batch_size=2), 4)
+
+        self.assertEqual(
+            set(AccessLogDailyRollup.objects.values_list('access_context', 'day', 'count')),
+            {('legal', day.date(), 2), ('social', day.date(), 4), ('legal', self.today.date(), 1)},
+        )
+        self.assertEqual(
+            set(AccessorDailyRollup.objects.values_list('accessed_by_id', 'day', 'count')),
+            {(self.reader.id, day.date(), 2), (self.owner.id, day.date(), 4), (self.reader.id, self.today.date(), 1)},
+        )
+        self.assertEqual({rollups.checkpoint(name) for name in rollups.ROLLUPS}, {AccessLog.objects.latest('id').id})
+
+    def test_rollups_catch_up_independently(self):
+        self.log(self.today, self.reader, count=3)
+        rollups.roll_up(names=[rollups.HOURLY.name])
+        self.assertEqual(rollups.checkpoint(), 0)
+        self.assertEqual(rollups.roll_up(), 3)
+        self.assertEqual(AccessLogRollup.objects.get().count, 3)
+        self.assertEqual(AccessLogDailyRollup.objects.get().count, 3)
+
+    def test_backfill_rebuilds_pruned_history_from_hourly(self):
+        old = self.today - timedelta(days=60)
+        self.log(old, self.reader, count=3)
+        self.log(self.today, self.reader, count=2)
+        rollups.roll_up(names=[rollups.HOURLY.name])
+        AccessLog.objects.filter(timestamp=old).delete()
+        self.log(self.today, self.owner)
+
+        out = io.StringIO()
+        call_command('backfill_access_rollups', stdout=out)
+        self.assertIn('Rebuilt 2 daily per-context rollups', out.getvalue())
+        self.assertEqual(
+            dict(AccessLogDailyRollup.objects.values_list('day', 'count')), {old.date(): 3, self.today.date(): 3},
+        )
+        # Pruned rows cannot be attributed to accessors any more
+        self.assertEqual(
+            dict(AccessorDailyRollup.objects.values_list('accessed_by_id', 'count')), {self.reader.id: 2, self.owner.id: 1},
+        )
+        call_command('backfill_access_rollups', stdout=io.StringIO())
+        self.assertEqual(AccessLogDailyRollup.objects.get(day=self.today.date()).count, 3)
+
+    def test_endpoint_reads_only_rollups(self):
+        self.log(self.today, self.reader, count=2)
+        self.log(self.today, self.owner, context='social')
+        self.log(self.today - timedelta(days=1), self.reader)
+        rollups.roll_up()
+        self.log(self.today, self.reader, count=5)
+
+        self.client.login(username='stats-owner', password='pw')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url(accessors=1))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse([q for q in queries.captured_queries if 'identity_accesslog"' in q['sql']])
+
+        data = response.json()
+        self.assertEqual(data['total'], 4)
+        self.assertEqual(data['contexts'], {'legal': 3, 'social': 1})
+        self.assertEqual(data['days'][-1], {
+            'day': self.today.date().isoformat(), 'total': 3, 'contexts': {'legal': 2, 'social': 1},
+        })
+        self.assertEqual(data['accessors'], [{'id': self.reader.id, 'username': 'stats-reader', 'count': 3}])
+
+        response = self.client.get(self.url(since=self.today.date().isoformat()))
+        self.assertEqual(response.json()['total'], 3)
+
+    def test_endpoint_checks_owner_and_parameters(self):
+        self.client.login(username='stats-reader', password='pw')
+        self.assertEqual(self.client.get(self.url()).status_code, 404)
+
+        self.client.login(username='stats-owner', password='pw')
+        self.assertEqual(self.client.get(self.url(since='yesterday')).status_code, 400)
+        self.assertEqual(self.client.get(self.url(since='2026-01-10', until='2026-01-01')).status_code, 400)
+        self.assertEqual(self.client.get(self.url(since='2020-01-01', until='2026-01-01')).status_code, 400)
+        self.assertEqual(self.client.get(self.url(accessors=-1)).status_code, 400)
+        self.assertEqual(self.client.get(self.url(accessors=0)).json()['accessors'], [])
+
+        User.objects.create_superuser(username='stats-admin', password='pw')
+        self.client.login(username='stats-admin', password='pw')
+        self.assertEqual(self.client.get(self.url()).status_code, 200)
+
+    def test_admin_dashboard_shows_access_activity(self):
+        self.log(self.today, self.reader, count=2)
+        rollups.roll_up()
+        User.objects.create_superuser(username='stats-admin', password='pw')
+        self.client.login(username='stats-admin', password='pw')
+        response = self.client.get(reverse('admin-dashboard'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['access_stats']['total'], 2)
+        self.assertContains(response, 'Most Active Accessors')
+        self.assertContains(response, 'stats-reader')
+
+    def test_writer_rolls_up_on_its_interval(self):
+        writer = AccessLogWriter(rollup_interval=60)
+        self.log(self.today, self.reader)
+        with mock.patch('identity.audit.time.monotonic', return_value=1000.0):
+            writer.roll_up_if_due()
+            self.assertEqual(writer.stats()['rolled_up'], 1)
+            self.log(self.today, self.reader)
+            writer.roll_up_if_due()
+            self.assertEqual(writer.stats()['rolled_up'], 1)
+        with mock.patch('identity.audit.time.monotonic', return_value=1061.0):
+            writer.roll_up_if_due()
+        self.assertEqual(writer.stats()['rolled_up'], 2)
+        self.assertEqual(AccessLogDailyRollup.objects.get().count, 2)
+
+
+class PrimaryIdentityTestCase(TestCase):
+    """One primary identity per user, switched atomically"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='primary', password='pw')
+        self.legal, self.social, self.work = (
+            Identity.objects.create(user=self.user, context=context, given_name='A', family_name='B',
+                                    is_primary=context == 'social')
+            for context in ('legal', 'social', 'professional')
+        )
+        self.client = Client()
+        self.client.login(username='primary', password='pw')
+
+    def primaries(self, user=None):
+        return list(Identity.objects.filter(user=user or self.user, is_primary=True).values_list('id', flat=True))
+
+    def test_constraint_allows_one_primary(self):
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Identity.objects.filter(pk=self.legal.pk).update(is_primary=True)
+        self.legal.is_primary = True
+        with self.assertRaises(ValidationError):
+            self.legal.validate_constraints()
+
+    def test_switch_works_in_either_row_order(self):
+        # The new primary is written before and after the old one
+        for identity in (self.legal, self.work, self.social):
+            self.assertTrue(Identity.objects.set_primary(self.user.id, identity.id))
+            self.assertEqual(self.primaries(), [identity.id])
+
+    def test_switch_endpoint_is_narrow(self):
+        url = reverse('set-primary', kwargs={'identity_id': self.work.id})
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.primaries(), [self.work.id])
+        writes = [q['sql'] for q in queries.captured_queries if q['sql'].startswith('UPDATE "identity_identity"')]
+        self.assertEqual(len(writes), 2)
+        self.assertFalse([q for q in queries.captured_queries if 'SELECT "identity_identity"' in q['sql']])
+
+    def test_switch_to_someone_elses_identity_changes_nothing(self):
+        other = User.objects.create_user(username='other-primary', password='pw')
+        theirs = Identity.objects.create(user=other, context='legal', given_name='C', family_name='D')
+        response = self.client.post(reverse('set-primary', kwargs={'identity_id': theirs.id}))
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.primaries(), [self.social.id])
+        self.assertEqual(self.primaries(other), [])
+
+    def test_switch_invalidates_cached_resolution(self):
+        self.assertEqual(get_cached_identity(self.user.id, 'display').id, self.social.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            Identity.objects.set_primary(self.user.id, self.legal.id)
+        self.assertEqual(get_cached_identity(self.user.id, 'display').id, self.legal.id)
+
+    def test_serializer_and_ajax_demote_the_old_primary(self):
+        response = self.client.patch(
+            reverse('identity-detail', kwargs={'pk': self.legal.id}), {'is_primary': True},
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()['is_primary'])
+        self.assertEqual(self.primaries(), [self.legal.id])
+
+        response = self.client.post(reverse('identity-list-create'), {
+            'context': 'display', 'given_name': 'N', 'family_name': 'P', 'is_primary': True,
+        }, content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.primaries(), [response.json()['id']])
+
+        response = self.client.post(reverse('ajax-identity-update'), json.dumps({
+            'identity_id': self.work.id, 'bio': 'Works', 'is_primary': True,
+        }), content_type='application/json')
+        self.assertTrue(response.json()['success'])
+        self.assertEqual(self.primaries(), [self.work.id])
+        self.assertEqual(Identity.objects.get(pk=self.work.id).bio, 'Works')
+
+        self.client.post(reverse('ajax-identity-update'), json.dumps({
+            'identity_id': self.work.id, 'is_primary': False,
+        }), content_type='application/json')
+        self.assertEqual(self.primaries(), [])
+
+    def test_form_create_promotes_through_set_primary(self):
+        response = self.client.post(reverse('identity-create'), {
+            'context': 'display', 'given_name': 'F', 'family_name': 'P', 'is_primary': 'on',
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.primaries(), [response.json()['identity_id']])
+
+        response = self.client.post(reverse('identity-edit', kwargs={'identity_id': self.work.id}), {
+            'bio': 'Form', 'is_primary': 'true',
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.primaries(), [self.work.id])
+        self.assertEqual(response.json()['version'], Identity.objects.get(pk=self.work.id).version)
+
+    def test_ajax_save_of_primary_does_not_switch_again(self):
+        version = Identity.objects.get(pk=self.social.pk).version
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('ajax-identity-update'), json.dumps({
+                'identity_id': self.social.id, 'bio': 'Same primary', 'is_primary': True, 'version': version,
+            }), content_type='application/json')
+        self.assertEqual(response.json()['version'], version + 1)
+        writes = [q['sql'] for q in queries.captured_queries if q['sql'].startswith('UPDATE "identity_identity"')]
+        self.assertEqual(len(writes), 1)
+        self.assertEqual(self.primaries(), [self.social.id])
+
+    def test_api_save_of_primary_does_not_switch_again(self):
+        version = Identity.objects.get(pk=self.social.pk).version
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.patch(
+                reverse('identity-detail', kwargs={'pk': self.social.id}),
+                {'bio': 'Same primary', 'is_primary': True}, content_type='application/json',
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['version'], version + 1)
+        writes = [q['sql'] for q in queries.captured_queries if q['sql'].startswith('UPDATE "identity_identity"')]
+        self.assertEqual(len(writes), 1)
+        self.assertEqual(self.primaries(), [self.social.id])
+
+
+class PrimaryIdentityConcurrencyTestCase(SimpleTestCase):
+    """Concurrent switches from several threads against a file-backed SQLite database"""
+    alias = 'primary-concurrency'
+    threads = 8
+    switches = 25
+
+    def setUp(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('Exercises SQLite locking')
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        connections.settings[self.alias] = connections.configure_settings({
+            'default': connections.settings['default'],
+            self.alias: {
+                'ENGINE': 'django.db.backends.sqlite3',
+                'NAME': os.path.join(directory.name, 'primary.sqlite3'),
+                'OPTIONS': {'timeout': 30},
+            },
+        })[self.alias]
+        self.addCleanup(connections.settings.pop, self.alias)
+        self.addCleanup(lambda: connections[self.alias].close())
+
+        with connections[self.alias].schema_editor() as editor:
+            editor.create_model(User)
+            editor.create_model(Identity)
+        self.user = User.objects.db_manager(self.alias).bulk_create([User(username='racer')])[0]
+        Identity.objects.db_manager(self.alias).bulk_create(
+            Identity(user=self.user, context='legal', locale=f'l{n}', given_name='R', family_name='C',
+                     is_primary=n == 0)
+            for n in range(self.threads)
+        )
+
+    def test_concurrent_switches_leave_one_primary(self):
+        ids = list(Identity.objects.using(self.alias).values_list('id', flat=True))
+        barrier = threading.Barrier(self.threads)
+        errors = []
+
+        def switch(n):
+            try:
+                barrier.wait()
+                for i in range(self.switches):
+                    Identity.objects.db_manager(self.alias).set_primary(self.user.pk, ids[(n + i) % len(ids)])
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connections[self.alias].close()
+
+        workers = [threading.Thread(target=switch, args=(n,)) for n in range(self.threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(Identity.objects.using(self.alias).filter(is_primary=True).count(), 1)
+
+
+class IdentityVersionTestCase(TestCase):
+    """Saves write only the changed columns, and only over the version they read"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='versioned', password='pw')
+        self.identity = Identity.objects.create(
+            user=self.user, context='professional', given_name='Vera', family_name='Sion',
+            custom_attributes={'team': 'core'},
+        )
+        self.client = Client()
+        self.client.login(username='versioned', password='pw')
+        self.url = reverse('identity-detail', kwargs={'pk': self.identity.id})
+
+    def updates(self, queries):
+        return [q['sql'] for q in queries.captured_queries if q['sql'].startswith('UPDATE "identity_identity"')]
+
+    def test_update_writes_changed_columns_only(self):
+        identity = Identity.objects.get(pk=self.identity.pk)
+        identity.bio = 'Changed'
+        with CaptureQueriesContext(connection) as queries:
+            identity.save()
+        [sql] = self.updates(queries)
+        assignments = sql.split(' SET ')[1].split(' WHERE ')[0]
+        self.assertEqual(sorted(re.findall(r'"(\w+)" =', assignments)), ['bio', 'updated_at', 'version'])
+        self.assertIn('"version" = 1', sql.split(' WHERE ')[1])
+        self.assertEqual(identity.version, 2)
+        self.assertEqual(identity.changed_fields(), [])
+        self.assertEqual(Identity.objects.get(pk=identity.pk).custom_attributes, {'team': 'core'})
+
+    def test_changes_inside_json_are_noticed(self):
+        identity = Identity.objects.get(pk=self.identity.pk)
+        identity.custom_attributes['team'] = 'platform'
+        self.assertEqual(identity.changed_fields(), ['custom_attributes'])
+
+    def test_unchanged_save_writes_nothing(self):
+        identity = Identity.objects.get(pk=self.identity.pk)
+        identity.given_name = 'Vera'
+        with self.assertNumQueries(0):
+            identity.save()
+        self.assertEqual(identity.version, 1)
+
+    def test_stale_save_raises_and_keeps_version(self):
+        first = Identity.objects.get(pk=self.identity.pk)
+        second = Identity.objects.get(pk=self.identity.pk)
+        first.bio = 'First'
+        first.save()
+        second.nickname = 'Second'
+        with self.assertRaises(VersionConflict), transaction.atomic():
+            second.save()
+        self.assertEqual(second.version, 1)
+        stored = Identity.objects.get(pk=self.identity.pk)
+        self.assertEqual((stored.bio, stored.nickname, stored.version), ('First', '', 2))
+
+    def test_api_checks_if_match(self):
+        etag = self.client.get(self.url)['ETag']
+        response = self.client.patch(self.url, {'bio': 'One'}, content_type='application/json', HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['version'], 2)
+        self.assertNotEqual(response['ETag'], etag)
+
+        response = self.client.patch(self.url, {'bio': 'Two'}, content_type='application/json', HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['version'], 2)
+        self.assertEqual(Identity.objects.get(pk=self.identity.pk).bio, 'One')
+
+    def test_api_checks_body_version(self):
+        response = self.client.patch(self.url, {'bio': 'One', 'version': 3}, content_type='application/json')
+        self.assertEqual(response.status_code, 409)
+        response = self.client.patch(self.url, {'bio': 'One', 'version': 1}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['version'], 2)
+
+    def test_api_conflict_with_concurrent_write(self):
+        original = Identity.from_db
+
+        def read_then_overtaken(*args):
+            instance = original(*args)
+            Identity.objects.filter(pk=instance.pk).update(version=instance.version + 1)
+            return instance
+
+        with mock.patch.object(Identity, 'from_db', read_then_overtaken):
+            response = self.client.patch(self.url, {'bio': 'Late'}, content_type='application/json')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(Identity.objects.get(pk=self.identity.pk).bio, '')
+
+    def test_ajax_rejects_stale_version(self):
+        url = reverse('ajax-identity-update')
+        response = self.client.post(url, json.dumps({
+            'identity_id': self.identity.id, 'bio': 'Ajax', 'version': 1,
+        }), content_type='application/json')
+        self.assertEqual(response.json()['version'], 2)
+        response = self.client.post(url, json.dumps({
+            'identity_id': self.identity.id, 'bio': 'Stale', 'version': 1,
+        }), content_type='application/json')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(Identity.objects.get(pk=self.identity.pk).bio, 'Ajax')
+
+    def test_stale_version_without_changes_conflicts(self):
+        """A stale editor is told so even when it submits the stored values"""
+        Identity.objects.filter(pk=self.identity.pk).update(version=2)
+        response = self.client.post(reverse('ajax-identity-update'), json.dumps({
+            'identity_id': self.identity.id, 'given_name': 'Vera', 'version': 1,
+        }), content_type='application/json')
+        self.assertEqual(response.status_code, 409)
+
+        url = reverse('identity-edit', kwargs={'identity_id': self.identity.id})
+        response = self.client.post(url, {'given_name': 'Vera', 'version': 1})
+        self.assertEqual(response.status_code, 409)
+        response = self.client.post(url, {'given_name': 'Vera', 'version': 2})
+        self.assertEqual(response.json()['version'], 2)
+
+
 if __name__ == '__main__':
     import django
     django.setup()
@@ -4,10 +4,12 @@ from . import views
 # API URLs
 api_urlpatterns = [
     path('identities/', views.IdentityListCreateView.as_view(), name='identity-list-create'),
+    path('identities/resolve/', views.ResolveIdentitiesView.as_view(), name='resolve-identities'),
     path('identities/<int:pk>/', views.IdentityDetailView.as_view(), name='identity-detail'),
     path('users/<int:user_id>/identity/', views.ContextualIdentityView.as_view(), name='contextual-identity'),
     path('users/<int:user_id>/identities/', views.UserIdentitiesView.as_view(), name='user-identities'),
     path('identities/<int:identity_id>/set-primary/', views.set_primary_identity, name='set-primary'),
+    path('identities/<int:identity_id>/access-stats/', views.IdentityAccessStatsView.as_view(), name='identity-access-stats'),
     path('context-priorities/', views.ContextPriorityView.as_view(), name='context-priorities'),
 ]
 
@@ -38,6 +40,9 @@ admin_urlpatterns = [
     path('admin-panel/identities/<int:identity_id>/details/', views.identity_details_ajax, name='identity-details-ajax'),
     path('admin-panel/users/<int:user_id>/', views.user_detail_admin, name='user-detail-admin'),
     path('admin-panel/verify/<int:identity_id>/', views.verify_identity, name='verify-identity'),
+    path('admin-panel/cache-stats/', views.cache_stats_ajax, name='cache-stats-ajax'),
+    path('admin-panel/search/', views.admin_search_ajax, name='admin-search-ajax'),
+    path('admin-panel/access-logs/export/', views.export_access_logs, name='access-log-export'),
 ]
 
 urlpatterns = [
@@ -2,8 +2,10 @@ from .api import (
     IdentityListCreateView,
     IdentityDetailView,
     ContextualIdentityView,
+    ResolveIdentitiesView,
     UserIdentitiesView,
     set_primary_identity,
+    IdentityAccessStatsView,
     ContextPriorityView,
 )
 from .web import (
@@ -28,4 +30,7 @@ from .admin import (
     identity_details_ajax,
     create_user_ajax,
     toggle_user_status_ajax,
+    cache_stats_ajax,
+    admin_search_ajax,
+    export_access_logs,
 )
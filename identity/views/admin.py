@@ -1,37 +1,48 @@
 import json
+from datetime import timedelta
 
 from django.contrib.auth.decorators import user_passes_test, login_required
 from django.contrib.auth.models import User
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
 from django.shortcuts import render, get_object_or_404, redirect
+from django.db.models import Count
 from django.contrib import messages
-from django.core.paginator import Paginator
-from django.db.models import Q
 from django.views.decorators.http import require_http_methods
 
-from .utils import is_admin_user
+from .utils import is_admin_user, get_keyset_page
+from .. import exports, rollups, search, stats
+from ..cache import identity_cache
 from ..models import UserRole, Identity
 from django.utils import timezone
 
+ACCESS_STATS_DAYS = 14
+
 
 @user_passes_test(is_admin_user)
 def admin_dashboard(request):
     """Admin-only dashboard"""
     # Get statistics
-    total_users = User.objects.count()
-    total_identities = Identity.objects.count()
-    unverified_identities = Identity.objects.filter(is_verified=False).count()
+    counters = stats.get_counters()
 
     # Recent activity
     recent_identities = Identity.objects.select_related('user').order_by('-created_at')[:10]
-    recent_users = User.objects.order_by('-date_joined')[:10]
+    recent_users = User.objects.select_related('profile').order_by('-date_joined')[:10]
+
+    # Access activity over the last two weeks, from the daily rollups only
+    until = timezone.now().date() + timedelta(days=1)
+    access_stats = rollups.access_stats(since=until - timedelta(days=ACCESS_STATS_DAYS), until=until, accessors=5)
+    busiest = max((day['total'] for day in access_stats['days']), default=0)
+    for day in access_stats['days']:
+        day['percent'] = round(100 * day['total'] / busiest) if busiest else 0
 
     context = {
-        'total_users': total_users,
-        'total_identities': total_identities,
-        'unverified_identities': unverified_identities,
+        'total_users': counters['users'],
+        'total_identities': counters['identities'],
+        'unverified_identities': counters['unverified_identities'],
         'recent_identities': recent_identities,
         'recent_users': recent_users,
+        'access_stats': access_stats,
+        'access_stats_days': ACCESS_STATS_DAYS,
     }
     return render(request, 'admin_dashboard.html', context)
 
@@ -42,22 +53,15 @@ def user_management(request):
     search_query = request.GET.get('search', '')
     role_filter = request.GET.get('role', '')
 
-    users = User.objects.select_related('profile').order_by('-date_joined')
+    users = User.objects.select_related('profile').annotate(identity_count=Count('identities'))
 
     if search_query:
-        users = users.filter(
-            Q(username__icontains=search_query) |
-            Q(email__icontains=search_query) |
-            Q(first_name__icontains=search_query) |
-            Q(last_name__icontains=search_query)
-        )
+        users = search.search(users, 'user', search_query)
 
     if role_filter:
         users = users.filter(profile__role=role_filter)
 
-    paginator = Paginator(users, 20)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    page_obj = get_keyset_page(request, users, ordering=('-date_joined', '-id'), salt='user-management')
 
     context = {
         'page_obj': page_obj,
@@ -75,15 +79,10 @@ def identity_management(request):
     context_filter = request.GET.get('context', '')
     verification_filter = request.GET.get('verified', '')
 
-    identities = Identity.objects.select_related('user').order_by('-created_at')
+    identities = Identity.objects.select_related('user')
 
     if search_query:
-        identities = identities.filter(
-            Q(given_name__icontains=search_query) |
-            Q(family_name__icontains=search_query) |
-            Q(email__icontains=search_query) |
-            Q(user__username__icontains=search_query)
-        )
+        identities = search.search(identities, 'identity', search_query)
 
     if context_filter:
         identities = identities.filter(context=context_filter)
@@ -93,9 +92,7 @@ def identity_management(request):
     elif verification_filter == 'unverified':
         identities = identities.filter(is_verified=False)
 
-    paginator = Paginator(identities, 20)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    page_obj = get_keyset_page(request, identities, ordering=('-created_at', '-id'), salt='identity-management')
 
     context = {
         'page_obj': page_obj,
@@ -128,14 +125,15 @@ def verify_identity(request, identity_id):
 @user_passes_test(is_admin_user)
 def user_detail_admin(request, user_id):
     """Admin view of user details"""
-    user = get_object_or_404(User, id=user_id)
-    user_identities = Identity.objects.filter(user=user)
+    user = get_object_or_404(User.objects.select_related('profile'), id=user_id)
+    # Every identity is rendered anyway, so count from the fetched rows
+    user_identities = list(Identity.objects.filter(user=user))
 
     context = {
         'viewed_user': user,
         'user_identities': user_identities,
-        'total_identities': user_identities.count(),
-        'verified_identities': user_identities.filter(is_verified=True).count(),
+        'total_identities': len(user_identities),
+        'verified_identities': sum(1 for identity in user_identities if identity.is_verified),
     }
     return render(request, 'user_detail_admin.html', context)
 
@@ -157,9 +155,10 @@ def create_user_ajax(request):
         )
 
         # Update profile role
-        if hasattr(user, 'profile'):
-            user.profile.role = data.get('role', 'user')
-            user.profile.save()
+        role = data.get('role', 'user')
+        if user.profile.role != role:
+            user.profile.role = role
+            user.profile.save(update_fields=['role'])
 
         return JsonResponse({
             'success': True,
@@ -232,4 +231,69 @@ def identity_details_ajax(request, identity_id):
         return JsonResponse({
             'success': False,
             'error': str(e)
-        })
\ No newline at end of file
+        })
+
+
+@user_passes_test(is_admin_user)
+def cache_stats_ajax(request):
+    """Hit/miss/eviction counters for this worker's identity cache"""
+    return JsonResponse({
+        'success': True,
+        'stats': identity_cache.stats(),
+    })
+
+
+@user_passes_test(is_admin_user)
+def admin_search_ajax(request):
+    """Ranked typeahead over identities or users"""
+    query = request.GET.get('q', '')
+    kind = request.GET.get('kind', 'identity')
+    if kind not in search.SEARCH_FIELDS:
+        return JsonResponse({'success': False, 'error': f'Unknown kind: {kind}'}, status=400)
+
+    results = []
+    for obj in search.ranked_search(kind, query, limit=10):
+        if kind == 'identity':
+            results.append({
+                'id': obj.id,
+                'label': obj.get_full_name(),
+                'username': obj.user.username,
+                'email': obj.email,
+                'context': obj.context,
+            })
+        else:
+            results.append({
+                'id': obj.id,
+                'label': obj.get_full_name() or obj.username,
+                'username': obj.username,
+                'email': obj.email,
+            })
+
+    return JsonResponse({'success': True, 'results': results})
+
+
+@user_passes_test(is_admin_user)
+def export_access_logs(request):
+    """
+    Stream an AccessLog extract as gzipped NDJSON or CSV. Filters: since,
+    until, identity, accessed_by, context; resume with after=<last row id>.
+    """
+    format = request.GET.get('format', 'ndjson')
+    if format not in exports.FORMATS:
+        return JsonResponse({'success': False, 'error': f'Unknown format: {format}'}, status=400)
+    compress = request.GET.get('gzip', 'true').lower() not in ('0', 'false', 'no')
+
+    # Validate everything before the first byte is sent
+    try:
+        lookups = exports.parse_filters(request.GET)
+        after = request.GET.get('after')
+        position = exports.resume_position(exports.parse_id('after', after)) if after else None
+    except exports.InvalidExport as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=400)
+
+    response = StreamingHttpResponse(
+        exports.render(exports.batches(lookups, position), format, compress),
+        content_type='application/gzip' if compress else exports.FORMATS[format],
+    )
+    response['Content-Disposition'] = f'attachment; filename="{exports.filename(format, compress)}"'
+    return response
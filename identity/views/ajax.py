@@ -1,12 +1,14 @@
 import json
 
 from django.contrib.auth.decorators import login_required
+from django.db import transaction
 from django.http import JsonResponse
 from django.shortcuts import get_object_or_404
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 
-from ..models import Identity, FieldPermission
+from .. import conditional
+from ..models import Identity, FieldPermission, VersionConflict
 from ..serializers import (
     IdentitySerializer
 )
@@ -26,19 +28,42 @@ def update_identity_ajax(request):
         else:
             identity = Identity(user=request.user)
 
-        # Update fields
+        # Becoming primary demotes the current primary, so it is done
+        # separately, and only when the identity is not primary already
+        promote = data.pop('is_primary', None)
+        if promote is not None and not promote:
+            identity.is_primary = False
+        promote = promote and not identity.is_primary
+
+        # Only save over the version the editor was showing, even when
+        # nothing changed (save() would then return without checking)
+        version = data.pop('version', None)
+        if identity_id and version is not None and int(version) != identity.version:
+            raise VersionConflict(f'Identity {identity.id} is no longer at version {version}')
+
+        # Update fields; only the changed ones are written
         for field, value in data.items():
             if hasattr(identity, field) and field != 'identity_id':
                 setattr(identity, field, value)
 
-        identity.save()
+        with transaction.atomic():
+            identity.save()
+            if promote:
+                Identity.objects.set_primary(request.user.id, identity.id)
+                identity.refresh_from_db(fields=['version'])
 
         return JsonResponse({
             'success': True,
             'identity_id': identity.id,
-            'full_name': identity.get_full_name()
+            'full_name': identity.get_full_name(),
+            'version': identity.version
         })
 
+    except VersionConflict:
+        return JsonResponse({
+            'success': False,
+            'error': 'This identity was changed elsewhere. Reload it and try again.'
+        }, status=409)
     except Exception as e:
         return JsonResponse({'success': False, 'error': str(e)})
 
@@ -46,9 +71,14 @@ def update_identity_ajax(request):
 @login_required
 def get_identity_data(request, identity_id):
     """Get identity data for editing"""
-    identity = get_object_or_404(Identity, id=identity_id, user=request.user)
+    identities = Identity.objects.filter(id=identity_id, user=request.user)
+    response = conditional.precheck(request, identities, 'identity-ajax')
+    if response is not None:
+        return response
+
+    identity = get_object_or_404(identities)
     serializer = IdentitySerializer(identity)
-    return JsonResponse(serializer.data)
+    return conditional.respond(JsonResponse(serializer.data), [identity], 'identity-ajax')
 
 
 @csrf_exempt
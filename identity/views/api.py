@@ -1,16 +1,28 @@
+import functools
+from datetime import date, timedelta
+
 from django.contrib.auth.models import User
+from django.utils import timezone
+from django.utils.cache import patch_vary_headers
 from rest_framework import generics, status, permissions
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from ..models import Identity, ContextPriority, AccessLog
+from .. import conditional, fastpath, projection, rollups, streaming
+from ..models import Identity, ContextPriority, VersionConflict
+from ..pagination import KeysetCursorPagination
+from ..audit import log_access, log_accesses
+from ..cache import get_cached_identity
+from ..negotiation import negotiate
+from ..principal import get_principal
+from ..resolution import resolve_contexts, resolve_identities
 from ..permissions import (
     IsOwnerOrReadOnly, ContextBasedPermission, ReadScopePermission, WriteScopePermission
 )
 from ..serializers import (
     IdentitySerializer, ContextualIdentitySerializer,
-    ContextPrioritySerializer
+    ContextPrioritySerializer, ResolveIdentitiesSerializer
 )
 
 
@@ -20,10 +32,23 @@ class IdentityListCreateView(generics.ListCreateAPIView):
     """
     serializer_class = IdentitySerializer
     permission_classes = [permissions.IsAuthenticated, ReadScopePermission]
+    pagination_class = KeysetCursorPagination
 
     def get_queryset(self):
         return Identity.objects.filter(user=self.request.user)
 
+    def list(self, request, *args, **kwargs):
+        # Read-only fast path: serialize values() rows instead of model instances
+        rows = fastpath.identity_rows(self.filter_queryset(self.get_queryset()))
+        stream_format = streaming.requested_format(request)
+        if stream_format:
+            # ?stream= returns every row in one streamed body instead of a page
+            rows = rows.order_by(*self.pagination_class.ordering)
+            return streaming.stream(rows, fastpath.identity_serializer(), stream_format)
+
+        page = self.paginate_queryset(rows)
+        return self.get_paginated_response(fastpath.serialize_identities(page))
+
     def get_permissions(self):
         if self.request.method == 'POST':
             return [permissions.IsAuthenticated(), WriteScopePermission()]
@@ -40,6 +65,43 @@ class IdentityDetailView(generics.RetrieveUpdateDestroyAPIView):
     def get_queryset(self):
         return Identity.objects.filter(user=self.request.user)
 
+    def retrieve(self, request, *args, **kwargs):
+        # Compare validators before loading and serializing the full row
+        response = conditional.precheck(request, self.get_queryset().filter(pk=kwargs['pk']), 'identity')
+        if response is not None:
+            return response
+
+        instance = self.get_object()
+        serializer = self.get_serializer(instance)
+        return conditional.respond(Response(serializer.data), [instance], 'identity')
+
+    def update(self, request, *args, **kwargs):
+        """
+        Apply the changed fields only, and only to the version the client
+        read: named by ``If-Match`` (the ETag) or a ``version`` in the body.
+        A stale one, or a write that lands in between, is answered with 409.
+        """
+        instance = self.get_object()
+        etag = conditional.compute_etag(conditional.validators([instance]), 'identity')
+        if not conditional.matches(request, etag):
+            return self.conflict(instance, 'The identity has changed since it was read.')
+        version = request.data.get('version')
+        if version is not None and str(version) != str(instance.version):
+            return self.conflict(instance, f'The identity is at version {instance.version}, not {version}.')
+
+        serializer = self.get_serializer(instance, data=request.data, partial=kwargs.pop('partial', False))
+        serializer.is_valid(raise_exception=True)
+        try:
+            self.perform_update(serializer)
+        except VersionConflict:
+            instance.refresh_from_db(fields=['version'])
+            return self.conflict(instance, 'The identity was changed by another request.')
+        return conditional.respond(Response(serializer.data), [instance], 'identity')
+
+    @staticmethod
+    def conflict(instance, detail):
+        return Response({'detail': detail, 'version': instance.version}, status=status.HTTP_409_CONFLICT)
+
 
 class ContextualIdentityView(APIView):
     """
@@ -48,56 +110,83 @@ class ContextualIdentityView(APIView):
     permission_classes = [permissions.IsAuthenticated, ContextBasedPermission]
 
     def get(self, request, user_id):
-        # Parse context from header
-        context = request.META.get('HTTP_ACCEPT_CONTEXT', 'display')
-        locale = request.META.get('HTTP_ACCEPT_LANGUAGE', 'en-US')[:5]
-
-        # Get user
-        try:
-            user = User.objects.get(id=user_id)
-        except User.DoesNotExist:
-            return Response({'error': 'User not found'}, status=status.HTTP_404_NOT_FOUND)
+        # Weighted Accept-Context / Accept-Language lists, most preferred first
+        contexts, languages = negotiate(request)
+        # Sparse fieldset; only the columns it needs are read
+        fields = projection.parse_fields(request.query_params.get('fields'))
 
-        # Get identity for context
-        identity = Identity.objects.filter(
-            user=user,
-            context=context,
-            locale=locale,
-            is_active=True
-        ).first()
+        if request.query_params.get('multiple') in ('1', 'true'):
+            return self.get_multiple(request, user_id, contexts, languages, fields)
 
-        if not identity:
-            # Try to find identity with same context but different locale
-            identity = Identity.objects.filter(
-                user=user,
-                context=context,
-                is_active=True
-            ).first()
-
-        if not identity:
-            # Fall back to primary identity
-            identity = Identity.objects.filter(
-                user=user,
-                is_primary=True,
-                is_active=True
-            ).first()
+        # Resolve identity for context (cached, single query on a miss)
+        identity = get_cached_identity(user_id, contexts, languages, fields)
 
         if not identity:
-            return Response({'error': 'No identity found'}, status=status.HTTP_404_NOT_FOUND)
+            return self.not_found(user_id)
 
-        # Log access
-        AccessLog.objects.create(
-            identity=identity,
-            accessed_by=request.user,
+        # Log access (buffered, written in batches)
+        log_access(
+            identity_id=identity.id,
+            accessed_by_id=request.user.id,
             accessed_fields=['contextual_data'],
-            access_context=context,
+            access_context=contexts[0],
             ip_address=self.get_client_ip(request),
             user_agent=request.META.get('HTTP_USER_AGENT', '')
         )
 
+        # Cache hits need no query at all to answer a matching If-None-Match
+        rows = conditional.validators([identity])
+        etag = conditional.compute_etag(
+            rows, 'contextual', contexts, languages, fields, identity.user_id == request.user.id
+        )
+        modified = conditional.last_modified(rows)
+        response = conditional.not_modified(request, etag, modified)
+        if response is not None:
+            return response
+
         # Return contextual data
-        serializer = ContextualIdentitySerializer(identity, context={'request': request})
-        return Response(serializer.data)
+        serializer = ContextualIdentitySerializer(identity, context={'request': request, 'fields': fields})
+        return conditional.add_validators(Response(serializer.data), etag, modified)
+
+    def get_multiple(self, request, user_id, contexts, languages, fields=None):
+        """Resolve every accepted context at once (``?multiple=true``)"""
+        resolved = resolve_contexts(user_id, contexts, languages, fields)
+        identities = list({identity.id: identity for identity in resolved.values() if identity}.values())
+        if not identities:
+            return self.not_found(user_id)
+
+        log_accesses([
+            {
+                'identity_id': identity.id,
+                'accessed_by_id': request.user.id,
+                'accessed_fields': ['contextual_data'],
+                'access_context': identity.context,
+                'ip_address': self.get_client_ip(request),
+                'user_agent': request.META.get('HTTP_USER_AGENT', ''),
+            }
+            for identity in identities
+        ])
+
+        variant = ('contextual-multiple', contexts, languages, fields, int(user_id) == request.user.id)
+        rows = conditional.validators(identities)
+        response = conditional.not_modified(
+            request, conditional.compute_etag(rows, *variant), conditional.last_modified(rows)
+        )
+        if response is not None:
+            return response
+
+        serializer_context = {'request': request, 'fields': fields}
+        data = {
+            context: ContextualIdentitySerializer(identity, context=serializer_context).data if identity else None
+            for context, identity in resolved.items()
+        }
+        return conditional.respond(Response({'identities': data}), identities, *variant)
+
+    @staticmethod
+    def not_found(user_id):
+        if not User.objects.filter(id=user_id).exists():
+            return Response({'error': 'User not found'}, status=status.HTTP_404_NOT_FOUND)
+        return Response({'error': 'No identity found'}, status=status.HTTP_404_NOT_FOUND)
 
     @staticmethod
     def get_client_ip(request):
@@ -109,6 +198,53 @@ class ContextualIdentityView(APIView):
         return ip
 
 
+class ResolveIdentitiesView(APIView):
+    """
+    Resolve contextual identities for many users in one request, using the
+    same fallback rules as ContextualIdentityView
+    """
+    permission_classes = [permissions.IsAuthenticated, ContextBasedPermission]
+
+    def post(self, request):
+        serializer = ResolveIdentitiesSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        user_ids = list(dict.fromkeys(serializer.validated_data['user_ids']))
+        contexts, languages = negotiate(request)
+        if serializer.validated_data.get('context'):
+            contexts = (serializer.validated_data['context'],)
+        if serializer.validated_data.get('locale'):
+            languages = (serializer.validated_data['locale'],)
+        fields = serializer.validated_data.get('fields')
+        fields = tuple(sorted(set(fields))) if fields else projection.parse_fields(request.query_params.get('fields'))
+
+        # Constant number of queries however many users were asked for
+        identities = resolve_identities(user_ids, contexts, languages, fields)
+
+        ip_address = ContextualIdentityView.get_client_ip(request)
+        user_agent = request.META.get('HTTP_USER_AGENT', '')
+        log_accesses([
+            {
+                'identity_id': identity.id,
+                'accessed_by_id': request.user.id,
+                'accessed_fields': ['contextual_data'],
+                'access_context': contexts[0],
+                'ip_address': ip_address,
+                'user_agent': user_agent,
+            }
+            for identity in identities.values()
+        ])
+
+        return Response({
+            'context': contexts[0],
+            'identities': {
+                str(user_id): ContextualIdentitySerializer(identity, context={'request': request, 'fields': fields}).data
+                for user_id, identity in identities.items()
+            },
+            'not_found': [user_id for user_id in user_ids if user_id not in identities],
+        })
+
+
 class UserIdentitiesView(APIView):
     """
     Get all identities for a specific user (with proper permissions)
@@ -133,27 +269,100 @@ class UserIdentitiesView(APIView):
             # User accessing their own identities
             identities = Identity.objects.filter(user=user, is_active=True)
 
-        serializer = ContextualIdentitySerializer(identities, many=True, context={'request': request})
-        return Response(serializer.data)
+        fields = projection.parse_fields(request.query_params.get('fields'))
+        stream_format = streaming.requested_format(request)
+        if stream_format:
+            rows = fastpath.contextual_rows(identities, projection.all_contexts(), fields)
+            response = streaming.stream(
+                rows.order_by(*KeysetCursorPagination.ordering),
+                functools.partial(projection.project_row, requested=fields),
+                stream_format,
+            )
+            # Streamed bodies carry no validators, but still vary like the paged ones
+            patch_vary_headers(response, conditional.VARY_HEADERS)
+            return response
+
+        paginator = KeysetCursorPagination()
+        variant = ('user-identities', user == request.user, request.get_full_path())
+
+        if conditional.is_conditional(request):
+            # Page through narrow rows first; only a changed page loads full rows
+            paginator.paginate_queryset(identities.values('id', 'created_at', 'updated_at'), request, view=self)
+            rows = conditional.validators(paginator.page)
+            etag = conditional.compute_etag(rows, *variant, paginator.page.count)
+            response = conditional.not_modified(request, etag, conditional.last_modified(rows))
+            if response is not None:
+                return response
+
+        # Identities of every context can appear, so read their combined
+        # projection's columns as values() rows and render those directly
+        rows = fastpath.contextual_rows(identities, projection.all_contexts(), fields)
+        page = paginator.paginate_queryset(rows, request, view=self)
+        return conditional.respond(
+            paginator.get_paginated_response(fastpath.serialize_contextual(page, fields)),
+            page, *variant, paginator.page.count
+        )
 
 
 @api_view(['POST'])
 @permission_classes([permissions.IsAuthenticated, WriteScopePermission])
 def set_primary_identity(request, identity_id):
     """Set an identity as primary"""
-    try:
-        identity = Identity.objects.get(id=identity_id, user=request.user)
-    except Identity.DoesNotExist:
+    # Demotes the current primary and bumps updated_at on both, so their ETags change
+    if not Identity.objects.set_primary(request.user.id, identity_id):
         return Response({'error': 'Identity not found'}, status=status.HTTP_404_NOT_FOUND)
 
-    # Remove primary from other identities
-    Identity.objects.filter(user=request.user, is_primary=True).update(is_primary=False)
+    return Response({'success': True, 'message': 'Primary identity updated'})
 
-    # Set this as primary
-    identity.is_primary = True
-    identity.save()
 
-    return Response({'success': True, 'message': 'Primary identity updated'})
+class IdentityAccessStatsView(APIView):
+    """
+    How often, in which contexts and by whom an identity was accessed, per
+    day (``?since=`` and ``?until=`` dates, until exclusive; the last 30 days
+    by default). Answered from the daily rollups alone, so it trails the
+    access log by up to a roll-up interval.
+    """
+    permission_classes = [permissions.IsAuthenticated, ReadScopePermission]
+    default_days = 30
+    max_days = 366
+    max_accessors = 100
+
+    def get(self, request, identity_id):
+        identities = Identity.objects.filter(id=identity_id)
+        if not get_principal(request.user).can_view_all_identities:
+            identities = identities.filter(user=request.user)
+        if not identities.exists():
+            return Response({'error': 'Identity not found'}, status=status.HTTP_404_NOT_FOUND)
+
+        try:
+            until = self.parse_date(request, 'until') or timezone.now().date() + timedelta(days=1)
+            since = self.parse_date(request, 'since') or until - timedelta(days=self.default_days)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if not since < until or (until - since).days > self.max_days:
+            return Response(
+                {'error': f'since must be before until and at most {self.max_days} days earlier'},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        accessors = request.query_params.get('accessors', '10')
+        if not accessors.isdigit() or int(accessors) > self.max_accessors:
+            return Response(
+                {'error': f'accessors must be between 0 and {self.max_accessors}'},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        data = rollups.access_stats(identity_id, since, until, int(accessors))
+        return Response({'identity': identity_id, 'since': since, 'until': until, **data})
+
+    @staticmethod
+    def parse_date(request, name):
+        value = request.query_params.get(name)
+        if not value:
+            return None
+        try:
+            return date.fromisoformat(value)
+        except ValueError:
+            raise ValueError(f'{name} must be a YYYY-MM-DD date')
 
 
 class ContextPriorityView(generics.ListCreateAPIView):
@@ -1,14 +1,10 @@
-from identity.models import UserRole
+from identity.pagination import KeysetPaginator, InvalidCursor
+from identity.principal import get_principal
 
 
 def is_admin_user(user):
     """Check if user has admin privileges"""
-    if user.is_superuser:
-        return True
-    try:
-        return user.profile.is_admin or user.profile.can_manage_users
-    except UserRole.DoesNotExist:
-        return False
+    return get_principal(user).can_access_admin_panel
 
 
 def group_identities_by_context(identities):
@@ -20,3 +16,12 @@ def group_identities_by_context(identities):
             context_groups[context] = []
         context_groups[context].append(identity)
     return context_groups
+
+
+def get_keyset_page(request, queryset, ordering, salt, per_page=20):
+    """Keyset page for the ?cursor= parameter; a bad cursor falls back to the first page"""
+    paginator = KeysetPaginator(queryset, per_page, ordering=ordering, salt=salt, with_count=True)
+    try:
+        return paginator.get_page(request.GET.get('cursor'))
+    except InvalidCursor:
+        return paginator.get_page()
@@ -1,12 +1,13 @@
 import json
 
 from django.contrib.auth.decorators import login_required
+from django.db import transaction
 from django.http import JsonResponse
 from django.shortcuts import render, get_object_or_404, redirect
-from django.contrib.auth.models import User
 
 from .utils import group_identities_by_context
-from ..models import Identity, FieldPermission, ContextPriority, AccessLog
+from .. import stats
+from ..models import Identity, FieldPermission, ContextPriority, VersionConflict
 from .utils import is_admin_user
 
 
@@ -26,38 +27,25 @@ def dashboard(request):
     # Check if user is admin
     is_admin = is_admin_user(user)
 
+    # Evaluated once; the template and the grouping both reuse the list
+    user_identities = list(Identity.objects.filter(user=user))
+    counters = stats.get_counters()
+
+    context = {
+        'identities': user_identities,
+        'context_groups': group_identities_by_context(user_identities),
+        'context_choices': Identity.CONTEXT_CHOICES,
+        'total_identities': len(user_identities),
+        'is_admin': is_admin,
+        'api_calls': counters['access_logs'],
+    }
+
     if is_admin:
-        # Admin sees overview of all users
-        user_identities = Identity.objects.filter(user=request.user)
-        all_identities_count = Identity.objects.count()
-        all_users_count = User.objects.count()
-        unverified_count = Identity.objects.filter(is_verified=False).count()
-        api_calls = AccessLog.objects.all().order_by('-timestamp').count()
-
-        context = {
-            'identities': user_identities,
-            'context_groups': group_identities_by_context(user_identities),
-            'context_choices': Identity.CONTEXT_CHOICES,
-            'total_identities': user_identities.count(),
-            'is_admin': True,
-            'api_calls': api_calls,
-            'admin_stats': {
-                'all_identities': all_identities_count,
-                'all_users': all_users_count,
-                'unverified': unverified_count,
-            }
-        }
-    else:
-        # Regular user sees only their own identities
-        user_identities = Identity.objects.filter(user=request.user)
-        api_calls = AccessLog.objects.all().order_by('-timestamp').count()
-        context = {
-            'identities': user_identities,
-            'context_choices': Identity.CONTEXT_CHOICES,
-            'context_groups': group_identities_by_context(user_identities),
-            'total_identities': user_identities.count(),
-            'is_admin': False,
-            'api_calls': api_calls,
+        # Admin also sees an overview of all users
+        context['admin_stats'] = {
+            'all_identities': counters['identities'],
+            'all_users': counters['users'],
+            'unverified': counters['unverified_identities'],
         }
 
     return render(request, 'dashboard.html', context)
@@ -84,19 +72,44 @@ def identity_form(request, identity_id=None):
         if custom_attrs:
             data['custom_attributes'] = json.dumps(custom_attrs)
 
+        # Becoming primary demotes the current primary, so it goes through
+        # set_primary after the save, and only when the identity is not primary yet
+        is_primary = data.pop('is_primary', None)
+        promote = is_primary is not None and is_primary.lower() in ('1', 't', 'true', 'on')
+
         # Create or update identity
-        if identity:
-            # Update existing
-            for field, value in data.items():
-                if hasattr(identity, field) and field != 'csrfmiddlewaretoken':
-                    setattr(identity, field, value)
-            identity.save()
-        else:
-            # Create new
-            data['user'] = request.user
-            identity = Identity.objects.create(**data)
-
-        return JsonResponse({'success': True, 'identity_id': identity.id})
+        try:
+            with transaction.atomic():
+                if identity:
+                    # Update existing, writing only the changed fields and only
+                    # over the version the form was rendered from, which is
+                    # checked here too since an unchanged save checks nothing
+                    version = data.pop('version', None)
+                    if version and int(version) != identity.version:
+                        raise VersionConflict(f'Identity {identity.id} is no longer at version {version}')
+                    if is_primary is not None and not promote:
+                        identity.is_primary = False
+                    promote = promote and not identity.is_primary
+                    for field, value in data.items():
+                        if hasattr(identity, field) and field != 'csrfmiddlewaretoken':
+                            setattr(identity, field, value)
+                    identity.save()
+                else:
+                    data.pop('version', None)
+                    # Create new
+                    data['user'] = request.user
+                    identity = Identity.objects.create(**data)
+
+                if promote:
+                    Identity.objects.set_primary(request.user.id, identity.id)
+                    identity.refresh_from_db(fields=['version'])
+        except VersionConflict:
+            return JsonResponse({
+                'success': False,
+                'error': 'This identity was changed elsewhere. Reload it and try again.'
+            }, status=409)
+
+        return JsonResponse({'success': True, 'identity_id': identity.id, 'version': identity.version})
 
     context = {
         'identity': identity,
@@ -65,6 +65,13 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# PrincipalBackend loads the session user with their role in one query;
+# ModelBackend stays listed so sessions created before it keep working
+AUTHENTICATION_BACKENDS = [
+    'identity.backends.PrincipalBackend',
+    'django.contrib.auth.backends.ModelBackend',
+]
+
 ROOT_URLCONF = 'settings.urls'
 
 TEMPLATES = [
@@ -96,6 +103,21 @@ DATABASES = {
     }
 }
 
+# A cache shared by every worker process (Redis or Memcached). Without one
+# Django's per-process LocMemCache is used and the identity cache, whose
+# invalidations have to reach every worker, stays off.
+CACHE_BACKEND = config('CACHE_BACKEND', default=None)
+if CACHE_BACKEND:
+    CACHES = {
+        'default': {
+            'BACKEND': CACHE_BACKEND,
+            'LOCATION': config('CACHE_LOCATION', default=''),
+        }
+    }
+
+# Swaps in the test-only overrides in identity/testing.py
+TEST_RUNNER = 'identity.testing.TestRunner'
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -144,6 +166,56 @@ OAUTH2_PROVIDER = {
 }
 
 
+# Contextual identity cache: per-worker LRU in front of the shared CACHES
+# alias above, off (None) without one. Other workers see an invalidation
+# within VERSION_TTL seconds.
+IDENTITY_CACHE = {
+    'ALIAS': 'default' if CACHE_BACKEND else None,
+    'LOCAL_MAXSIZE': config('IDENTITY_CACHE_LOCAL_MAXSIZE', default=1024, cast=int),
+    'TIMEOUT': config('IDENTITY_CACHE_TIMEOUT', default=300, cast=int),
+    'VERSION_TTL': config('IDENTITY_CACHE_VERSION_TTL', default=2.0, cast=float),
+}
+
+# Buffered AccessLog writer (identity/audit.py). The test runner
+# (identity/testing.py) makes it synchronous so rows are visible inside the
+# test transaction.
+IDENTITY_AUDIT = {
+    'SYNCHRONOUS': config('AUDIT_SYNCHRONOUS', default=False, cast=bool),
+    'QUEUE_SIZE': config('AUDIT_QUEUE_SIZE', default=10000, cast=int),
+    'BATCH_SIZE': config('AUDIT_BATCH_SIZE', default=500, cast=int),
+    'FLUSH_INTERVAL': config('AUDIT_FLUSH_INTERVAL', default=1.0, cast=float),
+    # 'block', 'drop' (counted) or 'sync' (write in the request thread)
+    'OVERFLOW': config('AUDIT_OVERFLOW', default='sync'),
+    # Interned user agent ids kept per process (identity/compact.py)
+    'USER_AGENT_CACHE_SIZE': config('AUDIT_USER_AGENT_CACHE_SIZE', default=1024, cast=int),
+    # Seconds over which identical accesses share one row (0: a row per access)
+    'COALESCE_WINDOW': config('AUDIT_COALESCE_WINDOW', default=0, cast=float),
+    'COALESCE_MAX_KEYS': config('AUDIT_COALESCE_MAX_KEYS', default=10000, cast=int),
+    # Seconds between roll-ups from the writer thread (0: leave them to rollup_access_logs)
+    'ROLLUP_INTERVAL': config('AUDIT_ROLLUP_INTERVAL', default=60, cast=float),
+}
+
+# AccessLog retention (identity/retention.py, manage.py prune_access_logs)
+IDENTITY_RETENTION = {
+    'KEEP_MONTHS': config('AUDIT_RETENTION_MONTHS', default=12, cast=int),
+    'BATCH_SIZE': config('AUDIT_RETENTION_BATCH_SIZE', default=5000, cast=int),
+    'PAUSE': config('AUDIT_RETENTION_PAUSE', default=0.0, cast=float),
+    'ARCHIVE_DIR': config('AUDIT_ARCHIVE_DIR', default=None),
+    # Columnar cold archive (manage.py archive_access_logs)
+    'COLD_AFTER_DAYS': config('AUDIT_COLD_AFTER_DAYS', default=90, cast=int),
+    'SEGMENT_DIR': config('AUDIT_SEGMENT_DIR', default=None),
+    'SEGMENT_ROWS': config('AUDIT_SEGMENT_ROWS', default=100000, cast=int),
+    # 'zlib' or 'lzma'
+    'SEGMENT_CODEC': config('AUDIT_SEGMENT_CODEC', default='zlib'),
+}
+
+# Streamed (?stream=json|ndjson) listings and exports (identity/streaming.py)
+IDENTITY_STREAMING = {
+    'CHUNK_SIZE': config('STREAMING_CHUNK_SIZE', default=2000, cast=int),
+    'BATCH_SIZE': config('STREAMING_BATCH_SIZE', default=500, cast=int),
+}
+
+
 # Internationalization
 # https://docs.djangoproject.com/en/5.2/topics/i18n/
 